@@ -1,16 +1,268 @@
-from openai import OpenAI
+import asyncio
+import click
+import gzip
+import hashlib
+import itertools
+import json
+import logging
 import openai
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, Response, abort, g, render_template, request, redirect, send_file, url_for, session, jsonify, stream_with_context
 import os
 import re
 import base64
-import uuid
+import time
+import zlib
 from datetime import datetime
 from typing import List, Optional
 from pydantic import BaseModel, Field
+from session_store import SESSION_MAX_AGE, SQLiteSessionBackend, ServerSessionInterface, StaleSession, build_full_text
+from story_context import ContextManager, estimate_tokens, narrative_stage, narrative_stage_key
+from character_registry import CharacterRegistry, character_list, find_character, index_characters
+from streaming import JsonStringFieldExtractor, sse_event
+from jobs import RUNNING, JobQueue
+from openai_clients import OPENAI_MAX_RETRIES, AsyncClientRegistry, ClientRegistry, key_fingerprint
+from key_validation import KeyValidator
+from image_store import ImageStore, extract_image_hashes
+from prompt_cache import PromptCache, cache_key
+from speculation import Speculator
+from static_assets import AssetManifest
+from opening_pool import OpeningPool
+from save_format import (MAX_SAVE_BYTES, SAVE_FORMAT_VERSION, SaveError, chain_hash_at, decode_characters,
+                         decode_turns, encode_save, image_hashes, parse_save, turn_hash)
+from save_slots import QuotaExceeded, SaveSlotStore
+from model_router import ModelRouter
+from coordination import SharedStore, stable_secret_key
+from turn_guard import (RATE_LIMIT_KEY_BURST, RATE_LIMIT_KEY_PER_MIN, RATE_LIMIT_SESSION_BURST,
+                        RATE_LIMIT_SESSION_PER_MIN, RateLimited, RateLimiter, TurnCoalescer, TurnConflict)
+import metrics
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+
+# ----------- 多进程协调 -----------
+# 多个 worker 进程通过本地 SQLite 共享缓存、租约锁与限流令牌桶（见 coordination.py）；
+# 未配置 SECRET_KEY 时签名密钥在首次启动时生成并保存，所有进程与重启后一致
+COORDINATION_DB_PATH = os.environ.get('COORDINATION_DB_PATH', os.path.join(app.instance_path, 'coordination.db'))
+shared_store = SharedStore(COORDINATION_DB_PATH)
+app.secret_key = stable_secret_key(shared_store, os.environ.get('SECRET_KEY'))
+# 请求体上限（读档是唯一的大请求）
+app.config['MAX_CONTENT_LENGTH'] = MAX_SAVE_BYTES
+
+# ----------- 日志 -----------
+# 模板数据、生成记录等调试输出只在 LOG_LEVEL=DEBUG 时打印
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+if logging.getLogger().getEffectiveLevel() > logging.DEBUG:
+    # httpx 在 INFO 级别为每个 OpenAI 请求打印一行，请求数与耗时已由 /metrics 统计
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# ----------- 服务端 Session -----------
+# Cookie 只保存 session ID，会话与按回合增量存储的历史保存在本地 SQLite 中；
+# 超过 SESSION_MAX_AGE 秒（默认 30 天，0 表示不清理）没有写入的会话定期清理，也可用 purge-sessions 命令执行
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', os.path.join(app.instance_path, 'sessions.db'))
+session_backend = SQLiteSessionBackend(SESSION_DB_PATH)
+app.session_interface = ServerSessionInterface(session_backend)
+
+# ----------- OpenAI 客户端 -----------
+# 同一 API Key 共用一个带连接池的客户端，超时通过环境变量配置。
+# 模型调用都经 model_router，重试与回退由路由在时间预算内完成，客户端不再使用 SDK 自带的重试
+openai_clients = ClientRegistry(max_retries=0)
+
+
+def get_openai_client(api_key):
+    return openai_clients.get(api_key)
+
+# 验证结果按 Key 指纹缓存，默认只查询单个模型（KEY_VALIDATION_MODE=full/light/off）；
+# Key 验证不经路由，保留 OPENAI_MAX_RETRIES 次 SDK 重试
+key_validator = KeyValidator(lambda api_key: get_openai_client(api_key).with_options(max_retries=OPENAI_MAX_RETRIES),
+                             shared=shared_store)
+
+# ----------- 模型路由 -----------
+# 每类调用按 MODEL_ROUTES 选择模型层级，超时与服务端错误时回退，剧情可按叙事阶段使用不同模型
+model_router = ModelRouter()
+
+# ----------- 剧情上下文 -----------
+# 最近几回合保留原文，更早的剧情由后台折叠为滚动摘要，整体受 token 预算约束
+context_manager = ContextManager(get_openai_client, model_router, shared=shared_store)
+
+# ----------- 后台图片任务 -----------
+# 场景图与头像在线程池中生成，完成后写回会话存储，请求线程不再等待图片
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 4))
+image_jobs = JobQueue(workers=IMAGE_WORKERS, name='image-jobs')
+
+# ----------- 异步服务模式 -----------
+# 由 asgi.py 在事件循环启动后开启：剧情请求在循环中完成后经 environ 交给同步路由，
+# 图片与头像任务改用 AsyncOpenAI 直接在循环上执行
+ASYNC_IMAGE_CONCURRENCY = int(os.environ.get('ASYNC_IMAGE_CONCURRENCY', 64))
+PREFETCHED_STORY_ENV = 'ai_adventure.prefetched_story'
+async_openai_clients = None
+
+
+def enable_async_mode(loop):
+    global async_openai_clients
+    async_openai_clients = AsyncClientRegistry(max_retries=0)
+    image_jobs.attach_loop(loop, concurrency=ASYNC_IMAGE_CONCURRENCY)
+    speculator.attach_loop(loop)
+    return async_openai_clients
+
+# 图片推送的最长等待时间（秒），超时后改用占位图
+IMAGE_WAIT_TIMEOUT = float(os.environ.get('IMAGE_WAIT_TIMEOUT', 90))
+# SSE 心跳间隔（秒），防止代理断开空闲连接
+SSE_HEARTBEAT_INTERVAL = 15
+# 图片任务在共享存储中的租约时长（秒）：租约有效时其他 worker 认为任务仍在执行，不重新排队；
+# 提交任务的进程异常退出时租约到期，之后的请求再重新排队（场景图）或改用占位图（头像）
+IMAGE_JOB_LEASE_TTL = 2 * IMAGE_WAIT_TIMEOUT
+
+SCENE_PLACEHOLDER = "/api/placeholder/800/400"
+AVATAR_PLACEHOLDER = "/api/placeholder/100/100"
+
+# ----------- 图片存储 -----------
+# 按内容哈希命名并转存为压缩格式，超出配额时清理无人引用的图片
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', os.path.join(app.instance_path, 'images'))
+# 文件名随内容变化，可以永久缓存
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def referenced_image_hashes():
+    """所有会话（含历史回合与角色头像）引用的图片哈希"""
+    hashes = set()
+    for payload in session_backend.iter_payloads():
+        hashes |= extract_image_hashes(payload)
+    hashes.update(save_slots.iter_image_hashes())
+    return hashes
+
+
+image_store = ImageStore(IMAGE_STORE_DIR, referenced=referenced_image_hashes)
+
+# 图片 prompt 改写与图片生成两个阶段的结果缓存，相同描述不再重复调用 API
+# 服务端存档槽（见 save_slots.py）
+SAVE_SLOTS_DB_PATH = os.environ.get('SAVE_SLOTS_DB_PATH', os.path.join(app.instance_path, 'save_slots.db'))
+save_slots = SaveSlotStore(SAVE_SLOTS_DB_PATH)
+
+PROMPT_CACHE_PATH = os.environ.get('PROMPT_CACHE_PATH', os.path.join(app.instance_path, 'prompt_cache.db'))
+prompt_cache = PromptCache(PROMPT_CACHE_PATH)
+
+# 开场剧情池（实例在剧情请求相关函数之后创建）
+OPENING_POOL_PATH = os.environ.get('OPENING_POOL_PATH', os.path.join(app.instance_path, 'openings.db'))
+
+# ----------- 回合去重与限流 -----------
+# 同一会话同一回合的重复提交只生成一次，回合生成按 API Key 与会话限流（见 turn_guard.py）
+TURN_CLAIM_ENV = 'ai_adventure.turn_claim'
+turn_coalescer = TurnCoalescer(shared=shared_store)
+key_rate_limiter = RateLimiter(RATE_LIMIT_KEY_PER_MIN, RATE_LIMIT_KEY_BURST, shared=shared_store, name='key')
+session_rate_limiter = RateLimiter(RATE_LIMIT_SESSION_PER_MIN, RATE_LIMIT_SESSION_BURST, shared=shared_store,
+                                   name='session')
+
+# ----------- 指标 -----------
+# /metrics 以 Prometheus 文本格式导出；设置 METRICS_TOKEN 后需携带 Bearer Token 访问
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+HTTP_REQUEST_SECONDS = metrics.histogram('http_request_seconds', 'Time spent in Flask views.',
+                                         ['endpoint', 'method', 'status'])
+
+metrics.gauge('image_job_queue_depth', 'Image jobs waiting for a worker.', lambda: image_jobs.stats()['depth'])
+metrics.gauge('image_jobs', 'Tracked image jobs by state.',
+              lambda: {k: v for k, v in image_jobs.stats().items() if k != 'depth'}, ['state'])
+metrics.gauge('openai_clients', 'Cached OpenAI clients.', lambda: openai_clients.stats()['clients'])
+metrics.gauge('key_validation_cache_entries', 'Cached API key validation results.',
+              lambda: key_validator.stats()['entries'])
+metrics.gauge('prompt_cache_hit_ratio', 'Prompt cache hit ratio by stage.',
+              lambda: {stage: s['hit_rate'] for stage, s in prompt_cache.stats()['stages'].items()}, ['stage'])
+metrics.gauge('image_store_bytes', 'Bytes used by stored images.', lambda: image_store.usage())
+metrics.gauge('speculation_inflight', 'Speculative story generations in progress.',
+              lambda: speculator.stats()['inflight'])
+metrics.gauge('speculation_hit_ratio', 'Share of turns served from a speculative result.',
+              lambda: speculator.stats()['hit_rate'])
+metrics.gauge('opening_pool_entries', 'Pre-generated opening scenes ready to serve.',
+              lambda: opening_pool.stats()['entries'])
+metrics.gauge('opening_pool_lookups', 'Opening scene lookups by result.',
+              lambda: {k: v for k, v in opening_pool.stats().items() if k in ('hits', 'misses')}, ['result'])
+metrics.gauge('turns_inflight', 'Turn generations in progress.', lambda: turn_coalescer.stats()['inflight'])
+metrics.gauge('model_demoted', 'Models moved behind the other tiers after recent errors.',
+              lambda: {m: int(s['demoted']) for m, s in model_router.stats().items()}, ['model'])
+metrics.gauge('model_latency_p95_seconds', 'Recent p95 latency of successful model calls.',
+              lambda: {m: s['p95'] for m, s in model_router.stats().items() if s['p95'] is not None}, ['model'])
+TURNS_REJECTED = metrics.counter('turns_rejected_total', 'Turn submissions rejected before generation.', ['reason'])
+TURNS_COALESCED = metrics.counter('turns_coalesced_total',
+                                  'Duplicate turn submissions answered with another request\'s result.')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # 流式响应只统计到响应头发出为止
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint,
+                                     method=request.method, status=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+IMAGE_STYLE = "【画风要求】Japanese anime style or galgame visual novel artwork。"
+AVATAR_STYLE = "日式轻小说的黑白插图风"
+
+# ----------- 图片管线 -----------
+# direct：剧情响应直接给出可用于生图的画面描述，套用按游戏设定生成的本地模板后只调用一次图片接口；
+# rewrite：先用一次对话请求（场景图附带完整故事）改写 prompt，再生成图片
+IMAGE_PIPELINE = os.environ.get('IMAGE_PIPELINE', 'direct')
+SCENE_PROMPT_TEMPLATE = "{prompt}\n【场景设定】题材：{theme}；氛围：{style}。画面中不要出现文字。"
+AVATAR_PROMPT_TEMPLATE = "{desc}\n【头像要求】{theme}题材的角色胸像，人物居中，背景简洁，{avatar_style}。"
+
+
+@app.route('/images/<filename>')
+def stored_image(filename):
+    path = image_store.path_for(filename)
+    if path is None:
+        abort(404)
+    response = send_file(path, etag=image_store.etag_for(filename), max_age=IMMUTABLE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# ----------- 静态资源 -----------
+# 页面引用的 static 文件与按语言生成的界面文本在启动时计算指纹并预先压缩，模板用 asset_url() 引用
+# （见 static_assets.py）；static 中的其他文件（如旧版本写入 static/images 的图片）不读入内存
+STATIC_ASSETS = ('main.js', 'style.css')
+assets = AssetManifest(app.static_folder, STATIC_ASSETS)
+
+
+def asset_url(name):
+    if app.debug:
+        # 开发时修改文件后无需重启
+        assets.refresh()
+    return assets.url(name)
+
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+
+@app.route('/assets/<path:filename>')
+def static_asset(filename):
+    asset = assets.get(filename)
+    if asset is None:
+        abort(404)
+    encoding = asset.negotiate(request.accept_encodings)
+    response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+    response.vary.add('Accept-Encoding')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    # 不同编码的内容不同，ETag 也要区分
+    response.set_etag(asset.etag if encoding == 'identity' else f"{asset.etag}-{encoding}")
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
 
 # ----------- OpenAI API 配置 -----------
 # 默认 Key (用于管理员测试)
@@ -33,13 +285,10 @@ def start_game():
     else:
         api_key = api_key_input
 
-    # 验证 API Key 是否有效
-    try:
-        test_client = OpenAI(api_key=api_key)
-        # 尝试一个简单的请求来验证 Key
-        test_client.models.list()
-    except Exception as e:
-        print(f"API Key validation failed: {e}")
+    # 验证 API Key 是否有效（结果有缓存，重复开始游戏不会再次请求）
+    valid, error = key_validator.validate(api_key)
+    if not valid:
+        logger.info("API Key validation failed: %s", error)
         return jsonify({"success": False, "error": "API Key 验证失败，请检查后重试。"})
 
     # 保存设置到 Session
@@ -53,8 +302,10 @@ def start_game():
         'custom_intro': request.form.get('custom_intro')
     }
     session['history'] = []
-    session['characters'] = []
-    session['story'] = ''
+    session['characters'] = {}
+    session.pop('story_summary', None)
+    context_manager.reset(session.sid)
+    speculator.discard(session.sid)
     session['player_stats'] = {
         'items': [],
         'relationships': {},
@@ -100,7 +351,11 @@ UI_TRANSLATIONS = {
         'delete_confirm': '确定要删除这个存档吗？',
         'delete_btn': '删除',
         'no_saves': '暂无存档',
-        'storage_full': 'localStorage已满，请删除旧存档'
+        'storage_full': 'localStorage已满，请删除旧存档',
+        'server_save': '云端',
+        'local_save': '本地',
+        'export_btn': '📦 导出全部存档',
+        'save_quota': '云端存档已满，请删除旧存档'
     },
     'ja': {
         'title': 'スターデュー・カフェ',
@@ -132,69 +387,222 @@ UI_TRANSLATIONS = {
         'delete_confirm': '本当にこのセーブデータを削除しますか？',
         'delete_btn': '削除',
         'no_saves': 'セーブデータなし',
-        'storage_full': 'localStorageが満杯です。古いセーブを削除してください'
+        'storage_full': 'localStorageが満杯です。古いセーブを削除してください',
+        'server_save': 'クラウド',
+        'local_save': 'ローカル',
+        'export_btn': '📦 すべてエクスポート',
+        'save_quota': 'クラウドセーブが満杯です。古いセーブを削除してください'
     }
 }
 
+# 前端使用的界面文本按语言生成为可缓存的脚本，页面不再内嵌
+for _lang, _translations in UI_TRANSLATIONS.items():
+    assets.add(f'i18n/{_lang}.js', (
+        "window.UI_TRANSLATIONS = " + json.dumps(_translations, ensure_ascii=False, separators=(',', ':')) + ";\n"
+    ).encode('utf-8'))
+
+
 @app.route('/game')
 def game():
     if 'api_key' not in session:
         return redirect(url_for('start'))
 
     if not session.get('history'):
+        claim, response = admit_turn("初始")
+        if response is not None:
+            return response
         try:
-            first_story = generate_story("初始")
-            first_story_record = {
-                "full_text": first_story['text'],
-                "new_text": first_story['text'],
-                "history_text": "",  # 首次没有历史文本
-                "image": first_story.get('image_content'),
-                "image_pending": first_story.get('image_pending', False),
-                "options": first_story['options'],
-                "player_action": "初始"
-            }
-            session['history'] = [first_story_record]
-            session['story'] = first_story['text']
-            if first_story.get('image_pending'):
-                session['pending_image_prompt'] = first_story.get('image_content', '')
+            pooled = take_opening()
+            first_story = story_from_response(pooled) if pooled is not None else generate_story("初始")
+            session['history'] = []
+            commit_turn("初始", first_story, claim)
+        except StaleSession as e:
+            # 同一会话的另一个请求已生成开场剧情
+            claim.fail(e)
+            return redirect(url_for('game'))
         except Exception as e:
+            claim.fail(e)
             # 如果生成失败（例如Key过期），返回错误页或重定向
-            print(f"Error generating first story: {e}")
+            logger.warning("Error generating first story: %s", e)
             return redirect(url_for('start'))
 
+    apply_finished_jobs()
+
+    logger.debug("传递给模板的数据 characters=%s", session.get('characters'))
+
+    return render_game()
+
+
+# ----------- 页面组装 -----------
+def build_story_view():
+    """把最新回合转换为模板可用格式"""
+    history = session.get('history', [])
     # 确保从session获取最新的记录
-    current_record = session['history'][-1] if session.get('history') else {}
+    current_record = history[-1] if history else {}
 
     # 获取最近的历史文本（最多3条，不包括当前记录）
     recent_history = ""
-    if len(session.get('history', [])) > 1:
-        recent_records = session['history'][:-1][-3:]  # 最近的3条历史记录
+    if len(history) > 1:
+        recent_records = history[-4:-1]  # 最近的3条历史记录
         recent_history = "\n\n".join([rec.get('new_text', '') for rec in recent_records])
 
-    # 转换记录格式为模板可用格式
-    story_for_template = {
+    return {
         'text': current_record.get('new_text', ''),
         'history_text': recent_history,
-        'full_text': session.get('story', ''),  # 完整历史
         'image': current_record.get('image'),
         'image_pending': current_record.get('image_pending', False),
-        'options': current_record.get('options', [])
+        'options': current_record.get('options', []),
+        'turn_index': len(history) - 1
     }
 
-    # 打印调试信息
-    print("传递给模板的数据:")
-    print("Story:", story_for_template)
-    print("Characters:", session.get('characters', []))
 
+def render_game():
     lang = session.get('language', 'zh')
-    return render_template('index.html',
-                           story=story_for_template,
-                           characters=session.get('characters', []),
-                           language=lang,
-                           ui=UI_TRANSLATIONS.get(lang, UI_TRANSLATIONS['zh']))
+    ui_lang = lang if lang in UI_TRANSLATIONS else 'zh'
+    with metrics.span('render_template'):
+        return render_template('index.html',
+                               story=build_story_view(),
+                               characters=[client_character(c) for c in character_list(session.get('characters'))],
+                               language=lang,
+                               server_saves=save_slots.enabled,
+                               ui=UI_TRANSLATIONS[ui_lang],
+                               ui_script=asset_url(f'i18n/{ui_lang}.js'))
+
+
+def client_character(c):
+    """发给前端的角色记录：内部的头像任务 ID 换成 avatar_pending 标记"""
+    if 'avatar_job' not in c:
+        return c
+    return dict({k: v for k, v in c.items() if k != 'avatar_job'}, avatar_pending=True)
+
+
+def build_turn_payload(story_record):
+    """只包含新回合内容的 JSON 结构：文本、选项、图片状态与本回合变化的角色"""
+    return {
+        "success": True,
+        "turn_index": len(session['history']) - 1,
+        "text": story_record['new_text'],
+        "options": story_record['options'],
+        "image": story_record.get('image'),
+        "image_pending": story_record.get('image_pending', False),
+        "characters_changed": [client_character(c) for c in character_registry().changed_records()]
+    }
+
+
+def wants_json():
+    """前端局部更新时请求 JSON，普通表单提交仍返回完整页面"""
+    if request.args.get('format') == 'json':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json' and request.accept_mimetypes[best] > request.accept_mimetypes['text/html']
+
+
+# ----------- 回合提交检查 -----------
+def admit_turn(user_action, stream=False):
+    """
+    生成回合前的检查，返回 (claim, 响应)；响应不为 None 时直接返回它，不再生成。
+
+    - 表单中的 turn_index（客户端看到的最后一个回合）落后于当前进度时，该回合刚以相同行动
+      完成则返回那次的结果，否则 409；
+    - 同一回合相同行动正在生成时等待那次的结果，其他行动正在生成时 409；
+    - 按会话与 API Key 限流，超出时 429。
+    通过检查的请求负责生成，之后必须 commit_turn 或 claim.fail。
+    """
+    claim = request.environ.get(TURN_CLAIM_ENV)
+    if claim is not None:
+        # 异步服务模式下已在 asgi.prepare_story 中检查
+        return claim, None
+
+    turn_index = len(session['history']) - 1
+    submitted = request.form.get('turn_index', type=int)
+    if submitted is not None and submitted != turn_index:
+        payload = turn_coalescer.replay(session.sid, submitted, user_action)
+        if payload is not None:
+            TURNS_COALESCED.inc()
+            return None, turn_response(payload, stream)
+        return None, turn_error_response(StaleSession(session.sid))
+
+    try:
+        claim, leader = turn_coalescer.claim(session.sid, turn_index, user_action)
+    except TurnConflict as e:
+        return None, turn_error_response(e)
+    if not leader:
+        TURNS_COALESCED.inc()
+        try:
+            return None, turn_response(claim.wait(), stream)
+        except Exception as e:
+            return None, turn_error_response(e)
+
+    retry_after = check_turn_rate()
+    if retry_after:
+        error = RateLimited(retry_after)
+        claim.fail(error)
+        return None, turn_error_response(error)
+    return claim, None
+
+
+def check_turn_rate():
+    """取会话与 API Key 的令牌，返回 0 或需要等待的秒数"""
+    retry_after = session_rate_limiter.acquire(session.sid)
+    if retry_after:
+        return retry_after
+    retry_after = key_rate_limiter.acquire(key_fingerprint(session['api_key']))
+    if retry_after:
+        session_rate_limiter.refund(session.sid)
+    return retry_after
+
+
+def turn_response(payload, stream=False):
+    """把另一个请求生成的回合结果按本次请求的形式返回"""
+    if stream:
+        return sse_response([sse_event('delta', {"text": payload['text']}), sse_event('done', payload)])
+    if wants_json():
+        return jsonify(payload)
+    return redirect(url_for('game'))
+
+
+def turn_error(error):
+    """回合失败时返回给客户端的 (内容, 状态码)"""
+    if isinstance(error, StaleSession):
+        TURNS_REJECTED.inc(reason='stale')
+        return {"error": "Story has moved on, please reload.", "stale": True}, 409
+    if isinstance(error, TurnConflict):
+        TURNS_REJECTED.inc(reason='busy')
+        return {"error": "Another action for this turn is still being generated.", "busy": True}, 409
+    if isinstance(error, RateLimited):
+        TURNS_REJECTED.inc(reason='rate_limited')
+        return {"error": str(error), "retry_after": round(error.retry_after, 1)}, 429
+    return {"error": str(error)}, 500
+
+
+def turn_error_response(error):
+    body, status = turn_error(error)
+    if status == 409 and not wants_json() and request.endpoint != 'next_step_stream':
+        # 普通表单提交：直接显示当前进度
+        return redirect(url_for('game'))
+    response = jsonify(body)
+    response.status_code = status
+    if isinstance(error, RateLimited):
+        response.headers['Retry-After'] = str(max(1, round(error.retry_after)))
+    return response
+
+
+def commit_turn(user_action, story, claim):
+    """
+    记录回合并立即提交 session，返回回合结果（JSON 与 done 事件的内容）并交给等待中的重复提交。
+
+    写入时检查存储中的回合数，其间另一个请求已提交回合时抛出 StaleSession，本次改动被放弃。
+    流式响应在响应头发出后才调用，同样依靠这里的直接提交。
+    """
+    if app.session_interface.is_stale(session):
+        raise StaleSession(session.sid)
+    story_record = record_story_turn(user_action, story)
+    app.session_interface.persist(session, check_turns=True)
+    payload = build_turn_payload(story_record)
+    claim.resolve(payload)
+    return payload
 
 
-# 修改 next_step 函数中的返回部分
 @app.route('/next_step', methods=['POST'])
 def next_step():
     if 'api_key' not in session:
@@ -204,192 +612,429 @@ def next_step():
     branch_choice = request.form.get('branch_choice')
     user_action = player_input or branch_choice
 
+    claim, response = admit_turn(user_action)
+    if response is not None:
+        return response
+
     # ------- AI 生成 story -------
     try:
         story = generate_story(user_action)  # story 已经包含 text, options, image
+        payload = commit_turn(user_action, story, claim)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        claim.fail(e)
+        return turn_error_response(e)
 
-    # 判断是否需要生成图片
-    if story.get('image_pending'):
-        session['pending_image_prompt'] = story['image_content']
-    else:
-        story['image_content'] = None
-        story['image_pending'] = False
+    logger.debug("生成的回合: %s", payload)
 
-    # ------- AI 可能生成新角色 -------
-    if story.get('new_character'):
-        char = story['new_character']
-        # 自动生成 avatar
-        avatar_url = generate_avatar(char.get('desc', '神秘角色'))
-
-        # 检查是否已存在
-        if not any(c['id'] == char['id'] for c in session['characters']):
-            session['characters'].append({
-                "id": char['id'],
-                "name": char['name'],
-                "avatar": avatar_url,
-                "desc": char['desc'],
-                "detail": char['detail'],
-                "events": [char['event']]
-            })
-        else:
-            # 已存在则追加事件
-            for c in session['characters']:
-                if c['id'] == char['id']:
-                    c['events'].append(char['event'])
+    if wants_json():
+        return jsonify(payload)
+    return render_game()
 
-    # ------- 存入历史 -------
-    session['story'] += story['text'] + "\n"
 
-    # 计算历史文本（不包含最新生成的文本）
-    previous_text = session['story'][:-len(story['text'])] if session['story'] else ""
+# ----------- 流式剧情 (SSE) -----------
+@app.route('/next_step_stream', methods=['POST'])
+def next_step_stream():
+    """以 Server-Sent Events 推送 story_text，结束时发送结构化结果并提交 session"""
+    if 'api_key' not in session:
+        return jsonify({"error": "Session expired"}), 401
 
-    # 创建story记录
-    story_record = {
-        "full_text": session['story'],  # 完整故事历史
-        "new_text": story['text'],  # 只有新生成的文本
-        "history_text": previous_text,  # 历史文本（不含新文本）
-        "image": story['image_content'],
-        "image_pending": story['image_pending'],
-        "options": story['options'],
-        "player_action": user_action
-    }
-    session['history'].append(story_record)
+    player_input = request.form.get('player_input')
+    branch_choice = request.form.get('branch_choice')
+    user_action = player_input or branch_choice
 
-    # 获取最近的历史文本（最多3条，不包括当前记录）
-    recent_history = ""
-    if len(session.get('history', [])) > 1:
-        recent_records = session['history'][:-1][-3:]  # 最近的3条历史记录
-        recent_history = "\n\n".join([rec.get('new_text', '') for rec in recent_records])
+    claim, response = admit_turn(user_action, stream=True)
+    if response is not None:
+        return response
 
-    # 强制保存session
-    session.modified = True
+    def events():
+        try:
+            story = None
+            for kind, payload in generate_story_stream(user_action):
+                if kind == 'delta':
+                    yield sse_event('delta', {"text": payload})
+                else:
+                    story = payload
+
+            yield sse_event('done', commit_turn(user_action, story, claim))
+        except Exception as e:
+            claim.fail(e)
+            logger.warning("Error in next_step_stream: %s", e)
+            yield sse_event('error', turn_error(e)[0])
+        finally:
+            # 客户端断开时生成器被关闭，不让等待中的重复提交一直等下去
+            claim.fail(ConnectionAbortedError('client disconnected'))
 
-    # 打印调试信息
-    print("生成的记录:", story_record)
-    print("当前角色:", session.get('characters', []))
+    return sse_response(stream_with_context(events()))
 
-    # 转换记录格式为模板可用格式
-    story_for_template = {
-        'text': story_record.get('new_text', ''),
-        'history_text': recent_history,
-        'full_text': session.get('story', ''),  # 完整历史
-        'image': story_record.get('image'),
-        'image_pending': story_record.get('image_pending', False),
-        'options': story_record.get('options', [])
-    }
 
-    lang = session.get('language', 'zh')
-    return render_template('index.html',
-                           story=story_for_template,
-                           characters=session.get('characters', []),
-                           language=lang,
-                           ui=UI_TRANSLATIONS.get(lang, UI_TRANSLATIONS['zh']))
+def sse_response(events):
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/get_image')
 def get_image():
-    print("get_image route called")
-
     # 检查 session 是否存在
     if not session or 'api_key' not in session:
-        print("Error: No session or API key found")
+        logger.info("get_image: no session or API key found")
         return jsonify({"image": None, "error": "No session"})
 
     # 检查是否开启了图像生成
     if not session.get('enable_images', True):
         return jsonify({"image": None})
 
-    print("Session keys:", session.keys())
-
-    if 'pending_image_prompt' in session:
-        prompt = session.get('pending_image_prompt')
-        print(f"Found image prompt in session: {prompt}")
+    if not session.get('history'):
+        return jsonify({"image": None})
 
-        # 生成图片
-        try:
-            image_url = generate_image(prompt, session.get('story', ''))
-            print(f"Generated image URL: {image_url}")
-
-            # 更新故事记录
-            if session.get('history'):
-                session['history'][-1]['image'] = image_url
-                session['history'][-1]['image_pending'] = False
-                session.modified = True
-            
-            # 生成成功（或返回了占位符）后再清除 prompt
-            session.pop('pending_image_prompt', None)
-            session.modified = True
+    # 图片由后台任务生成，这里只查询状态，不在请求线程中生成
+    apply_finished_jobs()
+    record = session['history'][-1]
+    if not record.get('image_pending'):
+        return jsonify({"image": record.get('image')})
 
-            return jsonify({"image": image_url})
-        except Exception as e:
-            print(f"Error generating image: {e}")
-            # 出错也清除，避免死循环
-            session.pop('pending_image_prompt', None)
-            session.modified = True
-            return jsonify({"image": None, "error": str(e)})
-    else:
-        print("No pending image prompt found in session")
+    job = ensure_scene_job(len(session['history']) - 1)
+    if job is None and scene_job_elsewhere(record):
+        return jsonify({"image": None, "status": RUNNING})
+    if job is None:
         # 检查并修复不一致状态：前端在轮询但后端没有prompt
-        if session.get('history') and session['history'][-1].get('image_pending'):
-             print("Fixing inconsistent state: history says pending but no prompt.")
-             session['history'][-1]['image_pending'] = False
-             # 返回占位图以停止轮询
-             fallback_url = "/api/placeholder/800/400"
-             session['history'][-1]['image'] = fallback_url
-             session.modified = True
-             return jsonify({"image": fallback_url})
-             
-        return jsonify({"image": None})
+        logger.warning("Fixing inconsistent state: history says pending but no prompt.")
+        # 返回占位图以停止轮询
+        session['history'].update(-1, image=SCENE_PLACEHOLDER, image_pending=False)
+        return jsonify({"image": SCENE_PLACEHOLDER})
+
+    return jsonify({"image": None, "status": job.status})
+
+
+# ----------- 图片任务状态 -----------
+def ensure_scene_job(turn_index):
+    """
+    返回本进程中某回合场景图的任务；任务已丢失（如服务重启）时用保存的 prompt 重新排队。
+
+    任务在其他 worker 中执行时返回 None，调用方从会话存储查看结果。
+    """
+    record = session['history'][turn_index]
+    if not record.get('image_pending'):
+        return None
+    job = image_jobs.get(record.get('image_job'))
+    if (job is None and record.get('image_prompt') and session.get('enable_images', True)
+            and not scene_job_elsewhere(record)):
+        job = enqueue_scene_image(turn_index, record['image_prompt'], chain_hash_at(session['history'], turn_index + 1))
+        session['history'].update(turn_index, image_job=job.id)
+    return job
+
+
+def scene_job_elsewhere(record):
+    """回合的场景图任务是否仍在其他进程中执行（租约未过期）"""
+    job_id = record.get('image_job')
+    return bool(job_id) and image_jobs.get(job_id) is None and shared_store.holder(image_job_lease(job_id)) is not None
+
+
+def image_job_lease(job_id):
+    return f'image_job:{job_id}'
+
+
+@app.route('/image_status/<int:turn_index>')
+def image_status(turn_index):
+    """查询某回合场景图的任务状态"""
+    if 'api_key' not in session:
+        return jsonify({"error": "Session expired"}), 401
+    if not 0 <= turn_index < len(session.get('history', [])):
+        return jsonify({"error": "Invalid turn"}), 404
+
+    apply_finished_jobs()
+    job = ensure_scene_job(turn_index)
+    record = session['history'][turn_index]
+    return jsonify({
+        "turn_index": turn_index,
+        "image": record.get('image'),
+        "image_pending": record.get('image_pending', False),
+        "job": job.to_dict() if job else None
+    })
+
+
+@app.route('/image_events/<int:turn_index>')
+def image_events(turn_index):
+    """
+    订阅某回合的场景图与待生成头像（SSE）。
+
+    图片就绪时推送 image / avatar 事件；超过 IMAGE_WAIT_TIMEOUT 仍未完成则推送占位图，
+    最后发送 end 事件。客户端只需订阅一次，无需定时轮询。
+    """
+    if 'api_key' not in session:
+        return jsonify({"error": "Session expired"}), 401
+    if not 0 <= turn_index < len(session.get('history', [])):
+        return jsonify({"error": "Invalid turn"}), 404
+
+    apply_finished_jobs()
+    sid = session.sid
+    image_job = ensure_scene_job(turn_index)
+    # 旧会话的回合缺少哈希时补算，写回时按哈希确认回合未被替换
+    chain_hash_at(session['history'], turn_index + 1)
+    record = session['history'][turn_index]
+    if (record.get('image_pending') and image_job is None and not record.get('image_prompt')
+            and not scene_job_elsewhere(record)):
+        # 没有任务也没有 prompt，无法再生成，直接使用占位图
+        session['history'].update(turn_index, image=SCENE_PLACEHOLDER, image_pending=False)
+        record = session['history'][turn_index]
+    avatar_jobs = {c['id']: c['avatar_job'] for c in character_list(session.get('characters')) if c.get('avatar_job')}
+
+    # 以下生成器在响应头发出后执行，不访问 session
+    def events():
+        deadline = time.time() + IMAGE_WAIT_TIMEOUT
+        last_sent = time.time()
+        image_done = not record.get('image_pending')
+        if image_done:
+            yield sse_event('image', {"turn_index": turn_index, "image": record.get('image')})
+
+        while (not image_done or avatar_jobs) and time.time() < deadline:
+            if image_job is not None and not image_done:
+                image_job.wait(1)
+            else:
+                time.sleep(1)
+
+            if not image_done:
+                image = None
+                if image_job is not None:
+                    if image_job.finished:
+                        image = image_job.result or SCENE_PLACEHOLDER
+                else:
+                    # 任务在其他进程中执行，直接查看存储中的回合
+                    stored = session_backend.load_turns(sid, turn_index, turn_index + 1)
+                    if not stored or stored[0].get('h') != record.get('h'):
+                        # 回合已被新游戏或读档替换，不再等待
+                        break
+                    if not stored[0].get('image_pending'):
+                        image = stored[0].get('image') or SCENE_PLACEHOLDER
+                if image:
+                    image_done = True
+                    last_sent = time.time()
+                    yield sse_event('image', {"turn_index": turn_index, "image": image})
+
+            for char_id, job_id in list(avatar_jobs.items()):
+                finished, avatar = avatar_job_result(job_id)
+                if finished:
+                    del avatar_jobs[char_id]
+                    last_sent = time.time()
+                    yield sse_event('avatar', {"id": char_id, "avatar": avatar or AVATAR_PLACEHOLDER})
+
+            if time.time() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+
+        if not image_done:
+            # 超时：写入占位图，任务之后完成时仍会覆盖为真实图片
+            if session_backend.update_turn(sid, turn_index, {"image": SCENE_PLACEHOLDER, "image_pending": False},
+                                           expected_hash=record.get('h')):
+                yield sse_event('image', {"turn_index": turn_index, "image": SCENE_PLACEHOLDER, "timeout": True})
+        yield sse_event('end', {})
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 # ----------- 存档导出 -----------
+# 存档格式见 save_format.py；大于 SAVE_GZIP_MIN_BYTES 的存档在客户端支持时压缩传输
+SAVE_GZIP_MIN_BYTES = 1024
+SAVE_PAYLOAD_BYTES = metrics.histogram('save_payload_bytes', 'Uncompressed /save and /load payloads.',
+                                       ['route'], buckets=metrics.BYTES_BUCKETS)
+
+
+def compressed_json(payload):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    SAVE_PAYLOAD_BYTES.observe(len(body), route=request.path)
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if len(body) >= SAVE_GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def read_save_body():
+    """读取读档请求体（可为 gzip 压缩），解压后超过 MAX_SAVE_BYTES 时拒绝"""
+    raw = request.get_data(cache=False)
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        try:
+            raw = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(raw, MAX_SAVE_BYTES + 1)
+        except zlib.error:
+            raise SaveError('invalid gzip body') from None
+    if len(raw) > MAX_SAVE_BYTES:
+        raise SaveError('save data too large')
+    SAVE_PAYLOAD_BYTES.observe(len(raw), route=request.path)
+    try:
+        return json.loads(raw)
+    except ValueError:
+        raise SaveError('save data is not valid JSON') from None
+
+
 @app.route('/save')
 def save():
-    """返回完整的游戏状态用于localStorage存储"""
+    """
+    返回用于 localStorage 的存档与新的检查点。
+
+    带上客户端的检查点 ?since=<回合数>&hash=<哈希> 且与当前进度一致时，只返回之后的回合。
+    """
     if 'api_key' not in session:
         return jsonify({"error": "No active session"}), 401
-    
-    return jsonify({
-        "success": True,
-        "data": {
-            "settings": session.get('settings'),
-            "history": session.get('history', []),
-            "characters": session.get('characters', []),
-            "story": session.get('story', ''),
-            "player_stats": session.get('player_stats', {}),
-            "language": session.get('language', 'zh'),
-            "enable_images": session.get('enable_images', True)
-        }
-    })
+
+    apply_finished_jobs()
+    document, checkpoint = encode_save(session, image_store.url_prefix,
+                                       since=request.args.get('since', 0, type=int),
+                                       since_hash=request.args.get('hash'))
+    return compressed_json({"success": True, "save": document, "checkpoint": checkpoint})
 
 # ----------- 读档功能 -----------
+def restore_save(document):
+    """
+    用校验过的存档替换当前进度。
+
+    存档的 base > 0 时只包含当前进度中第 base 个回合之后的部分：检查点一致则截断并追加，
+    否则不做改动并返回 False。
+    """
+    import_image = lambda data, kind: image_store.put(data, kind=kind)
+    turns = decode_turns(document, image_store.url_prefix, SCENE_PLACEHOLDER, import_image)
+    history = session['history']
+    if document.base:
+        if document.base > len(history) or chain_hash_at(history, document.base) != document.base_hash:
+            return False
+        history.truncate(document.base)
+        history.extend(turns)
+    else:
+        session['history'] = turns
+
+    meta = document.meta
+    session['settings'] = meta.settings
+    session.pop('story_summary', None)
+    context_manager.reset(session.sid)
+    speculator.discard(session.sid)
+    session['characters'] = index_characters(
+        decode_characters(document, image_store.url_prefix, AVATAR_PLACEHOLDER, import_image))
+    session['player_stats'] = meta.player_stats
+    session['language'] = meta.language
+    session['enable_images'] = meta.enable_images
+    session.modified = True
+    return True
+
+
 @app.route('/load', methods=['POST'])
 def load():
-    """从localStorage接收存档数据并恢复到session"""
+    """从 localStorage 的存档恢复进度（也接受旧版存档）；增量存档的检查点不一致时返回 409，客户端改传完整存档"""
     if 'api_key' not in session:
         return jsonify({"error": "No active session"}), 401
-    
+
+    try:
+        document = parse_save(read_save_body())
+    except SaveError as e:
+        logger.info("Rejected save data: %s", e)
+        return jsonify({"error": str(e)}), 400
+
     try:
-        data = request.json
-        save_data = data.get('data', {})
-        
-        # 恢复所有session数据
-        session['settings'] = save_data.get('settings', {})
-        session['history'] = save_data.get('history', [])
-        session['characters'] = save_data.get('characters', [])
-        session['story'] = save_data.get('story', '')
-        session['player_stats'] = save_data.get('player_stats', {})
-        session['language'] = save_data.get('language', 'zh')
-        session['enable_images'] = save_data.get('enable_images', True)
-        
-        session.modified = True
-        
-        return jsonify({"success": True})
+        if not restore_save(document):
+            return jsonify({"error": "Checkpoint mismatch", "resync": True}), 409
+        return jsonify({"success": True, "turns": len(session['history'])})
     except Exception as e:
-        print(f"Error loading game: {e}")
+        logger.warning("Error loading game: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ----------- 服务端存档槽 -----------
+# 按 API Key 区分用户；列表只读元数据，读档只读取一个槽（SAVE_SLOTS_PER_USER=0 时关闭）
+def slot_owner():
+    return key_fingerprint(session['api_key'])
+
+
+def require_save_slots():
+    if 'api_key' not in session:
+        return jsonify({"error": "No active session"}), 401
+    if not save_slots.enabled:
+        return jsonify({"error": "Server saves are disabled"}), 404
+    return None
+
+
+@app.route('/saves')
+def list_save_slots():
+    error = require_save_slots()
+    if error:
+        return error
+    owner = slot_owner()
+    return jsonify({"success": True, "slots": save_slots.list(owner), "usage": save_slots.usage(owner)})
+
+
+@app.route('/saves', methods=['POST'])
+def create_save_slot():
+    """把当前进度存入新槽，或覆盖请求中指定的 slot_id"""
+    error = require_save_slots()
+    if error:
+        return error
+    body = request.get_json(silent=True) or {}
+    apply_finished_jobs()
+    document, _ = encode_save(session, image_store.url_prefix)
+    try:
+        slot = save_slots.put(slot_owner(), body.get('name'), document, slot_id=body.get('slot_id'),
+                              images=image_hashes(document))
+    except KeyError:
+        return jsonify({"error": "Save slot not found"}), 404
+    except QuotaExceeded as e:
+        return jsonify({"error": str(e), "quota": True}), 413
+    return jsonify({"success": True, "slot": slot})
+
+
+@app.route('/saves/<slot_id>')
+def get_save_slot(slot_id):
+    """单个槽的存档内容（与 /save 的 save 字段格式相同）"""
+    error = require_save_slots()
+    if error:
+        return error
+    document = save_slots.get(slot_owner(), slot_id)
+    if document is None:
+        return jsonify({"error": "Save slot not found"}), 404
+    return compressed_json({"success": True, "save": document})
+
+
+@app.route('/saves/<slot_id>/load', methods=['POST'])
+def load_save_slot(slot_id):
+    error = require_save_slots()
+    if error:
+        return error
+    document = save_slots.get(slot_owner(), slot_id)
+    if document is None:
+        return jsonify({"error": "Save slot not found"}), 404
+    try:
+        restore_save(parse_save(document))
+    except SaveError as e:
+        logger.warning("Stored save slot %s is invalid: %s", slot_id, e)
         return jsonify({"error": str(e)}), 500
+    return jsonify({"success": True, "turns": len(session['history'])})
+
+
+@app.route('/saves/<slot_id>', methods=['DELETE'])
+def delete_save_slot(slot_id):
+    error = require_save_slots()
+    if error:
+        return error
+    if not save_slots.delete(slot_owner(), slot_id):
+        return jsonify({"error": "Save slot not found"}), 404
+    return jsonify({"success": True})
+
+
+@app.route('/saves/export')
+def export_save_slots():
+    """以一个 JSON 文件导出全部槽，逐个读取并输出"""
+    error = require_save_slots()
+    if error:
+        return error
+    owner = slot_owner()
+
+    def generate():
+        yield '{"v":%d,"exported_at":%s,"slots":[' % (SAVE_FORMAT_VERSION, json.dumps(datetime.now().isoformat()))
+        for i, (meta, document) in enumerate(save_slots.export(owner)):
+            entry = json.dumps({"slot": meta, "save": document}, ensure_ascii=False, separators=(',', ':'))
+            yield ('' if i == 0 else ',') + entry
+        yield ']}'
+
+    filename = f"ai-adventure-saves-{datetime.now():%Y%m%d-%H%M%S}.json"
+    return Response(generate(), mimetype='application/json',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 # ----------- 游戏状态系统 -----------
 @app.route('/game_status')
@@ -402,18 +1047,271 @@ def game_status():
     })
     return jsonify(player_stats)
 
-# ----------- 获取叙事阶段 -----------
-def get_narrative_stage():
-    # 根据历史长度判断故事阶段
-    history_length = len(session.get('history', []))
-    if history_length < 3:
-        return "开场/介绍"
-    elif history_length < 8:
-        return "发展/冲突"
-    elif history_length < 12:
-        return "高潮/转折"
+# ----------- 故事历史 -----------
+# 历史弹窗打开时才分页读取，页面不再内嵌完整故事。页按 HISTORY_PAGE_SIZE 对齐（[k*n, (k+1)*n)），
+# 同一页的地址固定；回合生成后不再变化，ETag 由回合的链式哈希计算，未变化的页与回合返回 304
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 20))
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+def history_entry(index, record):
+    return {
+        "index": index,
+        "h": record.get('h'),
+        "text": record.get('new_text', ''),
+        "action": record.get('player_action'),
+    }
+
+
+def history_response(payload, hashes):
+    """ETag 只取决于其中回合的哈希（total 只有不带 before 的请求需要，那一页的回合随之变化）"""
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha256(",".join(hashes).encode()).hexdigest()[:32])
+    # 读档或新游戏后同一地址对应不同的回合，每次都要向服务端确认
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/history')
+def story_history():
+    """
+    按回合区间分页返回历史：before 为上一页返回的 next_cursor（不传时返回最后一页），
+    每页为 [start, before) 中的回合，按时间顺序排列；next_cursor 为 null 时已到开头。
+    """
+    if 'api_key' not in session:
+        return jsonify({"error": "Session expired"}), 401
+    history = session.get('history', [])
+    total = len(history)
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    before = request.args.get('before', type=int)
+    if before is None:
+        # 最后一页同样按页大小对齐，之后的翻页地址与回合数无关
+        start = (total - 1) // limit * limit if total else 0
+        stop = total
+    else:
+        stop = min(max(before, 0), total)
+        start = max(stop - limit, 0)
+    # 旧会话的回合缺少哈希时补算一次
+    chain_hash_at(history, stop)
+    records = history[start:stop]
+    turns = [history_entry(start + i, rec) for i, rec in enumerate(records)]
+    payload = {
+        "turns": turns,
+        "start": start,
+        "total": total,
+        "next_cursor": start if start > 0 else None,
+    }
+    return history_response(payload, [t['h'] for t in turns])
+
+
+@app.route('/history/<int:turn_index>')
+def story_history_turn(turn_index):
+    if 'api_key' not in session:
+        return jsonify({"error": "Session expired"}), 401
+    history = session.get('history', [])
+    if not 0 <= turn_index < len(history):
+        return jsonify({"error": "No such turn"}), 404
+    chain_hash_at(history, turn_index + 1)
+    entry = history_entry(turn_index, history[turn_index])
+    return history_response(entry, [entry['h']])
+
+
+# ----------- 记录新回合 -----------
+def record_story_turn(user_action, story):
+    """把生成结果写入 session（图片待生成标记、角色、历史），返回本回合记录"""
+    # 判断是否需要生成图片
+    image_prompt = story['image_content'] if story.get('image_pending') else None
+
+    # 只保存本回合的增量，完整文本在需要时由 get_story_text() 重建
+    story_record = {
+        "new_text": story['text'],  # 只有新生成的文本
+        "image": None,
+        "image_pending": bool(image_prompt),
+        "options": story['options'],
+        "player_action": user_action
+    }
+    # 链式哈希，存档以此作为增量同步的检查点，后台图片任务以此确认写回的仍是同一段历史
+    story_record['h'] = turn_hash(chain_hash_at(session['history'], len(session['history'])), story_record)
+
+    # ------- AI 可能生成新角色 -------
+    if story.get('new_character'):
+        # 已有角色（包括换了 ID 的同一角色）只追加事件
+        character, created = character_registry().upsert(story['new_character'], len(session['history']))
+        if created:
+            character['avatar'] = AVATAR_PLACEHOLDER
+            # 自动生成 avatar（后台任务，完成前显示占位图）
+            if session.get('enable_images', True):
+                character['avatar_job'] = enqueue_avatar(character['id'], character.get('desc') or '神秘角色',
+                                                         story_record['h']).id
+
+    # ------- 存入历史 -------
+    session['history'].append(story_record)
+
+    if image_prompt:
+        job = enqueue_scene_image(len(session['history']) - 1, image_prompt, story_record['h'])
+        session['history'].update(-1, image_prompt=image_prompt, image_job=job.id)
+        story_record = session['history'][-1]
+
+    # 后台把滑出原文窗口的回合折叠进摘要，不阻塞本次响应
+    context_manager.schedule_summary(session.sid, session['api_key'], session['history'], get_story_summary())
+
+    # 为本回合的选项提前生成下一回合（SPECULATIVE_TOP_K > 0 时）
+    if speculator.enabled:
+        speculator.speculate(session.sid, len(session['history']) - 1, session['api_key'],
+                             story_record['options'], story_request)
+
+    # 强制保存session
+    session.modified = True
+    return story_record
+
+
+# ----------- 角色 -----------
+def character_registry():
+    """本次请求的角色登记表（见 character_registry.py）；旧会话中的角色列表在这里转换"""
+    characters = session.get('characters')
+    registry = g.get('character_registry')
+    if registry is None or registry.records is not characters:
+        if not isinstance(characters, dict):
+            characters = index_characters(characters)
+            session['characters'] = characters
+        registry = g.character_registry = CharacterRegistry(characters)
+    return registry
+
+
+# ----------- 图片任务 -----------
+def scene_image_prompt(prompt):
+    settings = session.get('settings', {})
+    return SCENE_PROMPT_TEMPLATE.format(prompt=prompt, theme=settings.get('theme') or '冒险',
+                                        style=settings.get('style') or '神秘')
+
+
+def avatar_image_prompt(desc):
+    settings = session.get('settings', {})
+    return AVATAR_PROMPT_TEMPLATE.format(desc=desc, theme=settings.get('theme') or '冒险', avatar_style=AVATAR_STYLE)
+
+
+def enqueue_scene_image(turn_index, prompt, chain_hash):
+    """
+    提交场景图任务，完成后写回对应回合。
+
+    任务按回合哈希去重、按哈希写回：新游戏或读档后同一会话的回合序号会重新开始，
+    只按序号会复用旧任务，或把旧游戏的图片写到新历史的同一序号上。
+    """
+    sid = session.sid
+    lease = None
+
+    def write_back(job):
+        session_backend.update_turn(sid, turn_index, {"image": job.result or SCENE_PLACEHOLDER, "image_pending": False},
+                                    expected_hash=chain_hash)
+        if lease is not None:
+            shared_store.release(image_job_lease(job.id), lease)
+
+    if IMAGE_PIPELINE == 'rewrite':
+        generate = agenerate_image if async_openai_clients is not None else generate_image
+        args = (prompt, get_story_text(), session['api_key'])
     else:
-        return "结局/收尾"
+        generate = arender_direct if async_openai_clients is not None else render_direct
+        args = (scene_image_prompt(prompt), 'scene', session['api_key'])
+    job = image_jobs.submit('image', ('image', sid, turn_index, chain_hash), generate,
+                            *args, on_done=write_back, defer=True)
+    # 其他 worker 据此判断任务仍在执行，不重复排队（复用已有任务时租约已存在，返回 None）
+    lease = shared_store.acquire(image_job_lease(job.id), IMAGE_JOB_LEASE_TTL, holder=str(os.getpid()))
+    # 回合落库后再开始生成，保证写回时记录已存在
+    session.call_after_persist(lambda: image_jobs.start(job))
+    return job
+
+
+def enqueue_avatar(char_id, desc, chain_hash):
+    """
+    提交头像任务，完成后写回角色记录。
+
+    任务按角色登场回合的哈希去重：新游戏中同 ID 的角色不会复用旧游戏的任务与头像；
+    写回只作用于仍记录着该任务 ID 的角色。
+    """
+    sid = session.sid
+    lease = None
+
+    def write_back(job):
+        avatar = job.result or AVATAR_PLACEHOLDER
+        # 其他请求保存整份会话数据时会覆盖这次写回，结果另存一份，由 apply_finished_jobs 按任务 ID 再合并
+        shared_store.put('avatar_result', job.id, avatar, ttl=SESSION_MAX_AGE)
+
+        def mutate(data):
+            c = find_character(data.get('characters'), char_id)
+            if c is not None and c.get('avatar_job') == job.id:
+                c['avatar'] = avatar
+                del c['avatar_job']
+        session_backend.update_data(sid, mutate)
+        if lease is not None:
+            shared_store.release(image_job_lease(job.id), lease)
+
+    if IMAGE_PIPELINE == 'rewrite':
+        generate = agenerate_avatar if async_openai_clients is not None else generate_avatar
+        args = (desc, session['api_key'])
+    else:
+        generate = arender_direct if async_openai_clients is not None else render_direct
+        args = (avatar_image_prompt(desc), 'avatar', session['api_key'])
+    job = image_jobs.submit('avatar', ('avatar', sid, char_id, chain_hash), generate, *args,
+                            on_done=write_back, defer=True)
+    lease = shared_store.acquire(image_job_lease(job.id), IMAGE_JOB_LEASE_TTL, holder=str(os.getpid()))
+    session.call_after_persist(lambda: image_jobs.start(job))
+    return job
+
+
+def apply_finished_jobs():
+    """
+    把已完成任务的结果合并进当前 session。
+
+    本次请求开始前读取的数据可能早于后台写回，保存时会覆盖写回结果，
+    因此请求侧也按任务 ID 再合并一次；头像结果另存在共享存储中，其他 worker 完成的任务同样能合并。
+    """
+    history = session.get('history')
+    if history and history[-1].get('image_pending'):
+        job = image_jobs.get(history[-1].get('image_job'))
+        if job is not None and job.finished:
+            history.update(-1, image=job.result or SCENE_PLACEHOLDER, image_pending=False)
+
+    for c in character_list(session.get('characters')):
+        if not c.get('avatar_job'):
+            continue
+        finished, avatar = avatar_job_result(c['avatar_job'])
+        if finished:
+            c['avatar'] = avatar or AVATAR_PLACEHOLDER
+            del c['avatar_job']
+            session.modified = True
+
+
+def avatar_job_result(job_id):
+    """
+    返回头像任务的 (是否结束, 结果)。
+
+    任务不在本进程中（在其他 worker 中执行、服务重启或本地结果已过期）时查看共享存储中的结果；
+    既没有结果也没有有效租约时任务已丢失，视为结束，由调用方使用占位图。
+    """
+    job = image_jobs.get(job_id)
+    if job is not None:
+        return job.finished, job.result
+    avatar = shared_store.get('avatar_result', job_id)
+    if avatar is not None:
+        return True, avatar
+    return shared_store.holder(image_job_lease(job_id)) is None, None
+
+
+# ----------- 完整故事文本 -----------
+def get_story_text():
+    """由按回合存储的增量重建完整故事文本，仅在需要时调用"""
+    return build_full_text(session.get('history', []))
+
+# ----------- 剧情摘要 -----------
+def get_story_summary():
+    """取最新的滚动摘要；后台更新过的摘要同步进 session 以便持久化"""
+    stored = session.get('story_summary')
+    # 摘要对应的历史已被替换时返回空摘要
+    summary = context_manager.get_summary(session.sid, session.get('history', []), stored)
+    if summary['upto'] and summary is not stored:
+        session['story_summary'] = summary
+    return summary
 
 # ----------- AI 生成剧情 -----------
 # ----------- Pydantic Models -----------
@@ -424,23 +1322,36 @@ class NewCharacter(BaseModel):
     detail: str
     event: str
 
+IMAGE_PROMPT_DESCRIPTIONS = {
+    'direct': "A self-contained visual description ready for an image model, if a new scene or important event "
+              "occurs: setting, characters' appearance, action, lighting and composition; no plot explanation",
+    'rewrite': "Description for generating an image, if a new scene or important event occurs",
+}
+
+
 class StoryResponse(BaseModel):
     story_text: str = Field(..., description="The main story narrative")
     options: List[str] = Field(..., description="3-4 branching options for the player")
-    image_prompt: Optional[str] = Field(None, description="Description for generating an image, if a new scene or important event occurs")
+    image_prompt: Optional[str] = Field(None, description=IMAGE_PROMPT_DESCRIPTIONS.get(
+        IMAGE_PIPELINE, IMAGE_PROMPT_DESCRIPTIONS['direct']))
     new_character: Optional[NewCharacter] = Field(None, description="Details of a new character if one appears")
 
 
 # ----------- AI 生成剧情 (Structured Outputs) -----------
-def generate_story(user_input):
-    client = OpenAI(api_key=session['api_key'])
-    
+def build_story_messages(user_input):
+    return story_messages(session.get('settings', {}), session.get('language', 'zh'), session.get('history', []),
+                          character_registry().names(), get_story_summary(), user_input)
+
+
+def story_messages(settings, language, history, character_names, summary, user_input):
+    """剧情请求的消息列表；不访问 session，开场剧情池在请求之外也用它组装请求"""
     messages = []
     
     # 1. 系统提示
-    settings = session.get('settings', {})
-    language = session.get('language', 'zh')
     lang_instruction = "请使用中文回复。" if language == 'zh' else "Please respond in Japanese (日本語)."
+    # direct 管线中图片描述不再经过改写，需要由剧情响应直接给出完整画面
+    image_instruction = "" if IMAGE_PIPELINE == 'rewrite' else \
+        "图片描述需能直接用于绘图：写清场景、人物外貌、动作、光线与构图，不要复述剧情。"
     
     messages.append({"role": "system", "content": f"""
                         你是一名 AI DM，负责主持一场文字冒险游戏。
@@ -449,170 +1360,457 @@ def generate_story(user_input):
                         - 难度：{settings.get('difficulty')}
                         
                         请根据前序剧情和用户选项完成续写。
-                        当前处于故事的{get_narrative_stage()}阶段，请据此调整叙事节奏与情节深度。
+                        当前处于故事的{narrative_stage(len(history))}阶段，请据此调整叙事节奏与情节深度。
                         
                         {lang_instruction}
                         
                         请生成 JSON 格式的输出，包含剧情文本、分支选项、图片描述（可选）和新角色信息（可选）。
+                        {image_instruction}
                         """})
 
-    # 2. 最近的故事历史
-    character_names = [c['name'] for c in session.get('characters', [])]
-    messages.append({"role": "user", "content": "已知角色：" + ("，".join(character_names) if character_names else "当前还没有已知角色。")})
-    messages.append({"role": "user", "content": "之前的情节内容为：" + session.get('story', '')})
-    for record in session.get('history', [])[-5:]:
-        messages.append({"role": "user", "content": record.get('player_action', '')})
+    # 2. 已知角色、剧情摘要与最近的故事历史（受 token 预算约束）
+    current_input = {"role": "user", "content": "用户当前选项为：" + user_input}
+    reserved_tokens = estimate_tokens(messages[0]['content']) + estimate_tokens(current_input['content'])
+    messages.extend(context_manager.build_messages(
+        history, character_names, summary, reserved_tokens=reserved_tokens
+    ))
 
     # 3. 当前输入
-    messages.append({"role": "user", "content": "用户当前选项为：" + user_input})
+    messages.append(current_input)
+    return messages
+
+
+def story_from_response(message):
+    """把 StoryResponse 转换为 app 使用的字典"""
+    # 检查是否允许生成图片
+    image_prompt = message.image_prompt
+    if not session.get('enable_images', True):
+        image_prompt = None
+
+    # Construct the return dictionary expected by the app
+    return {
+        "text": message.story_text,
+        "image_content": image_prompt,
+        "image_pending": bool(image_prompt),
+        "options": message.options,
+        "new_character": {
+            "id": message.new_character.id,
+            "name": message.new_character.name,
+            "desc": message.new_character.desc,
+            "detail": message.new_character.detail,
+            "event": message.new_character.event
+        } if message.new_character else None
+    }
+
+
+def story_request(user_input):
+    """剧情请求的参数（同步、流式与异步路径共用），模型由 route 对应的路由选择"""
+    return {
+        "route": model_router.resolve('story', narrative_stage_key(len(session.get('history', [])))),
+        "input": build_story_messages(user_input),
+        "text_format": StoryResponse,
+    }
 
-    print("Sending request to GPT (Structured Output)...")
+
+def split_route(request):
+    """返回 (路由名, 其余请求参数)"""
+    kwargs = dict(request)
+    return kwargs.pop('route'), kwargs
+
+
+def routed_call(route, create, kwargs):
+    """按路由调用 create(**kwargs, model=..., timeout=...)"""
+    return model_router.call(route, lambda model, timeout: create(**kwargs, model=model, timeout=timeout))
+
+
+async def aroute_call(route, create, kwargs):
+    return await model_router.acall(route, lambda model, timeout: create(**kwargs, model=model, timeout=timeout))
+
+
+def parse_story_request(client, request):
+    route, kwargs = split_route(request)
+    return routed_call(route, client.responses.parse, kwargs)
+
+
+async def aparse_story_request(client, request):
+    route, kwargs = split_route(request)
+    return await aroute_call(route, client.responses.parse, kwargs)
+
+
+def generate_story(user_input):
+    # 异步服务模式下剧情已在事件循环中生成
+    prefetched = request.environ.get(PREFETCHED_STORY_ENV)
+    if prefetched is not None:
+        return story_from_response(prefetched)
+    speculative = take_speculative_story(user_input)
+    if speculative is not None:
+        return story_from_response(speculative)
+
+    client = get_openai_client(session['api_key'])
+    story_kwargs = story_request(user_input)
+
+    logger.debug("Sending request to GPT (Structured Output)...")
     
     try:
-        completion = client.responses.parse(
-            model="gpt-4o-mini",
-            input=messages,
-            text_format=StoryResponse,
-        )
-
-        message = completion.output_parsed
-        
-        # 检查是否允许生成图片
-        image_prompt = message.image_prompt
-        if not session.get('enable_images', True):
-            image_prompt = None
-
-        # Construct the return dictionary expected by the app
-        return {
-            "text": message.story_text,
-            "image_content": image_prompt,
-            "image_pending": bool(image_prompt),
-            "options": message.options,
-            "new_character": {
-                "id": message.new_character.id,
-                "name": message.new_character.name,
-                "desc": message.new_character.desc,
-                "detail": message.new_character.detail,
-                "event": message.new_character.event
-            } if message.new_character else None
-        }
+        with metrics.span('generate_story'):
+            completion = parse_story_request(client, story_kwargs)
+        metrics.record_usage('story', completion.usage)
+        return story_from_response(completion.output_parsed)
 
     except Exception as e:
-        print(f"Error in generate_story: {e}")
+        logger.warning("Error in generate_story: %s", e)
         # Fallback or re-raise
         raise e
 
 
-# ----------- AI 生成图片（示例） -----------
-def generate_image(prompt, story):
-    if not session.get('enable_images', True):
+def generate_story_stream(user_input):
+    """
+    generate_story 的流式版本。
+
+    依次产出 ('delta', 新增的 story_text 片段)，最后产出 ('story', 与 generate_story 相同的字典)。
+    """
+    speculative = take_speculative_story(user_input)
+    if speculative is not None:
+        # 已提前生成，整段文本作为一个片段发出
+        story = story_from_response(speculative)
+        yield 'delta', story['text']
+        yield 'story', story
+        return
+
+    client = get_openai_client(session['api_key'])
+    route, kwargs = split_route(story_request(user_input))
+
+    logger.debug("Sending streaming request to GPT (Structured Output)...")
+
+    try:
+        # 耗时包含向客户端推送片段的时间；输出第一个片段之前失败时改用下一层模型
+        with metrics.span('generate_story_stream'):
+            for attempt in model_router.attempts(route):
+                with attempt, client.responses.stream(**kwargs, model=attempt.model, timeout=attempt.timeout) as stream:
+                    extractor = JsonStringFieldExtractor('story_text')
+                    for event in stream:
+                        if event.type == 'response.output_text.delta':
+                            text = extractor.feed(event.delta)
+                            if text:
+                                attempt.started = True
+                                yield 'delta', text
+                    completion = stream.get_final_response()
+                    break
+        metrics.record_usage('story', completion.usage)
+        yield 'story', story_from_response(completion.output_parsed)
+
+    except Exception as e:
+        logger.warning("Error in generate_story_stream: %s", e)
+        raise e
+
+
+# ----------- 预测生成 -----------
+# 回合结束后为前 K 个选项在后台提前生成下一回合，选中已生成的分支时直接使用。
+# 返回完整的响应，未被使用的分支按其 usage 计入浪费的 token
+def parse_story(api_key, kwargs):
+    with metrics.span('speculate_story'):
+        completion = parse_story_request(get_openai_client(api_key), kwargs)
+    metrics.record_usage('story_speculative', completion.usage)
+    return completion
+
+
+async def aparse_story(api_key, kwargs):
+    with metrics.span('speculate_story'):
+        completion = await aparse_story_request(async_openai_clients.get(api_key), kwargs)
+    metrics.record_usage('story_speculative', completion.usage)
+    return completion
+
+
+speculator = Speculator(parse_story, aparse_story)
+
+
+def take_speculative_story(user_action):
+    """玩家选中已预测的分支时返回其结果（StoryResponse），并取消本回合的其余分支"""
+    if not speculator.enabled or not session.get('history'):
         return None
+    completion = speculator.take(session.sid, len(session['history']) - 1, user_action)
+    return completion.output_parsed if completion is not None else None
+
+
+# ----------- 开场剧情池 -----------
+# 相同设定的开场剧情预先生成若干版本，/game 直接取用；配置了 OPENING_POOL_API_KEY 时取用后在后台补充（见 opening_pool.py）
+def opening_request(settings, language):
+    """开场剧情的请求参数，与空历史时的 story_request("初始") 相同"""
+    return {
+        "route": model_router.resolve('story', narrative_stage_key(0)),
+        "input": story_messages(settings, language, [], [], {'upto': 0, 'text': ''}, "初始"),
+        "text_format": StoryResponse,
+    }
+
+
+def opening_key(story_kwargs):
+    """按请求内容计算池的键，提示词改动后旧版本自然不再命中"""
+    return cache_key('opening', story_kwargs['route'], json.dumps(story_kwargs['input'], ensure_ascii=False))
+
+
+def generate_opening(api_key, story_kwargs):
+    with metrics.span('generate_opening'):
+        completion = parse_story_request(get_openai_client(api_key), story_kwargs)
+    metrics.record_usage('story_opening', completion.usage)
+    return completion.output_parsed.model_dump()
+
+
+opening_pool = OpeningPool(OPENING_POOL_PATH, generate_opening, shared=shared_store)
+
+
+def session_opening_key():
+    if not opening_pool.enabled:
+        return None
+    return opening_key(opening_request(session.get('settings', {}), session.get('language', 'zh')))
+
+
+def take_opening():
+    """从池中取出当前设定的一个开场剧情（StoryResponse），并用运营方的 Key 在后台补充；池中没有时返回 None"""
+    key = session_opening_key()
+    if key is None:
+        return None
+    data = opening_pool.take(key)
+    settings, language = session.get('settings', {}), session.get('language', 'zh')
+    opening_pool.refill(key, lambda: opening_request(settings, language))
+    return StoryResponse.model_validate(data) if data is not None else None
+
+
+@app.cli.command('fill-openings')
+@click.option('--api-key', envvar='OPENING_POOL_API_KEY', required=True, help='Key used for generation.')
+@click.option('--theme', multiple=True, required=True)
+@click.option('--style', multiple=True, required=True)
+@click.option('--difficulty', multiple=True, required=True)
+@click.option('--language', multiple=True, default=['zh'], show_default=True)
+@click.option('--count', type=int, default=None, help='Variants per combination (default OPENING_POOL_VARIANTS).')
+def fill_openings(api_key, theme, style, difficulty, language, count):
+    """为热门设定组合预先生成开场剧情（各选项可重复，按笛卡尔积填充）"""
+    for combo in itertools.product(theme, style, difficulty, language):
+        settings = dict(zip(('theme', 'style', 'difficulty'), combo[:3]))
+        story_kwargs = opening_request(settings, combo[3])
+        generated = opening_pool.fill(opening_key(story_kwargs), api_key, story_kwargs, count)
+        click.echo(f"{' / '.join(combo)}: +{generated}")
+
+
+@app.cli.command('purge-sessions')
+@click.option('--max-age', type=float, default=None,
+              help='Seconds since the last write (default SESSION_MAX_AGE).')
+def purge_sessions(max_age):
+    """清理长时间没有写入的会话及其回合"""
+    max_age = SESSION_MAX_AGE if max_age is None else max_age
+    if max_age <= 0:
+        raise click.UsageError('max age must be positive (SESSION_MAX_AGE=0 disables purging)')
+    click.echo(f"purged {session_backend.purge(max_age)} sessions")
+
+
+# ----------- AI 生成图片（示例） -----------
+def scene_rewrite_request(prompt, story):
+    return {
+        "messages": [
+            {"role": "system", "content": "你是一个专业的prompt工程师，需要根据给出的内容生成合适的prompt以让DALL-E生成合适的图像"},
+            {"role": "user", "content": f"在进行一场AI文字冒险游戏，现在需要生成描绘{prompt}的图片。请你根据目前的故事内容，生成一段适合的prompt。"},
+            {"role": "user", "content": f"目前的故事内容是：{story}."}
+        ],
+    }
+
+
+def avatar_rewrite_request(prompt):
+    return {
+        "messages": [
+            {"role": "system", "content": "你是一个专业的prompt工程师，需要根据给出的内容生成合适的prompt以让DALL-E生成合适的人物介绍界面的头像"},
+            {"role": "user", "content": f"在进行一场AI文字冒险游戏，现在需要生成{prompt}的头像，图片风格需要时{AVATAR_STYLE}。请你生成一段适合的prompt。"},
+        ],
+    }
 
-    client = OpenAI(api_key=session['api_key'])
+
+def generate_image(prompt, story, api_key):
+    # 在后台任务线程中执行，不能访问 session / request
+    client = get_openai_client(api_key)
 
     # 简化：直接返回占位图
     # 如果接 DALL·E:
-    print("开始生成图像")
+    logger.debug("开始生成图像")
     try:
-        response = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "你是一个专业的prompt工程师，需要根据给出的内容生成合适的prompt以让DALL-E生成合适的图像"},
-                {"role": "user", "content": f"在进行一场AI文字冒险游戏，现在需要生成描绘{prompt}的图片。请你根据目前的故事内容，生成一段适合的prompt。"},
-                {"role": "user", "content": f"目前的故事内容是：{story}."}
-            ],
-            model="gpt-4o-mini",
-        )
-        img_prompt = response.choices[0].message.content
-        print(f"图像Prompt: {img_prompt}.")
-    
-        response = client.responses.create(
-            model="gpt-4.1-mini",
-            input="【画风要求】Japanese anime style or galgame visual novel artwork。\n" + img_prompt,
-            tools=[{"type": "image_generation"}],
-        )
-        
-        image_data = [
-            output.result
-            for output in response.output
-            if output.type == "image_generation_call"
-        ]
-        
-        if image_data:
-            image_base64 = image_data[0]
-            # 确保 static/images 目录存在
-            save_dir = os.path.join(app.static_folder, 'images')
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-                
-            filename = f"{uuid.uuid4()}.png"
-            filepath = os.path.join(save_dir, filename)
-            
-            with open(filepath, "wb") as f:
-                f.write(base64.b64decode(image_base64))
-                
-            return url_for('static', filename=f'images/{filename}')
-            
-    except Exception as e:
-        print(f"Image generation failed: {e}")
-        return "/api/placeholder/800/400"
+        with metrics.span('generate_image'):
+            # 相同的场景描述复用改写结果（不随故事全文变化，保证重复场景可以命中）
+            rewrite_key = cache_key('scene', prompt, IMAGE_STYLE)
+            img_prompt = prompt_cache.get('rewrite', rewrite_key)
+            if img_prompt is None:
+                response = routed_call('image_prompt', client.chat.completions.create,
+                                       scene_rewrite_request(prompt, story))
+                metrics.record_usage('scene_rewrite', response.usage)
+                img_prompt = response.choices[0].message.content
+                prompt_cache.put('rewrite', rewrite_key, img_prompt)
+            logger.debug("图像Prompt: %s", img_prompt)
+
+            return render_image(client, img_prompt, kind='scene') or SCENE_PLACEHOLDER
 
-    return "/api/placeholder/800/400"
+    except Exception as e:
+        logger.warning("Image generation failed: %s", e)
+        return SCENE_PLACEHOLDER
 
 
-def generate_avatar(prompt):
+def generate_avatar(prompt, api_key):
     # 开发期占位
     if not prompt:
-        return "/api/placeholder/100/100"
-        
-    if not session.get('enable_images', True):
-        return "/api/placeholder/100/100"
+        return AVATAR_PLACEHOLDER
 
-    client = OpenAI(api_key=session['api_key'])
+    # 在后台任务线程中执行，不能访问 session / request
+    client = get_openai_client(api_key)
 
     # 未来可接 OpenAI Image 或 MJ
-    print("开始生成头像")
+    logger.debug("开始生成头像")
     try:
-        response = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "你是一个专业的prompt工程师，需要根据给出的内容生成合适的prompt以让DALL-E生成合适的人物介绍界面的头像"},
-                {"role": "user", "content": f"在进行一场AI文字冒险游戏，现在需要生成{prompt}的头像，图片风格需要时日式轻小说的黑白插图风。请你生成一段适合的prompt。"},
-            ],
-            model="gpt-4o-mini",
-        )
-        img_prompt = response.choices[0].message.content
-        print(f"头像Prompt: {img_prompt}.")
-    
-        response = client.responses.create(
-            model="gpt-4.1-mini",
-            input="【画风要求】Japanese anime style or galgame visual novel artwork。\n" + img_prompt,
-            tools=[{"type": "image_generation"}],
-        )
-        
-        image_data = [
-            output.result
-            for output in response.output
-            if output.type == "image_generation_call"
-        ]
-        
-        if image_data:
-            image_base64 = image_data[0]
-            # 确保 static/images 目录存在
-            save_dir = os.path.join(app.static_folder, 'images')
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-                
-            filename = f"{uuid.uuid4()}.png"
-            filepath = os.path.join(save_dir, filename)
-            
-            with open(filepath, "wb") as f:
-                f.write(base64.b64decode(image_base64))
-                
-            return url_for('static', filename=f'images/{filename}')
-            
+        with metrics.span('generate_avatar'):
+            rewrite_key = cache_key('avatar', prompt, AVATAR_STYLE)
+            img_prompt = prompt_cache.get('rewrite', rewrite_key)
+            if img_prompt is None:
+                response = routed_call('image_prompt', client.chat.completions.create,
+                                       avatar_rewrite_request(prompt))
+                metrics.record_usage('avatar_rewrite', response.usage)
+                img_prompt = response.choices[0].message.content
+                prompt_cache.put('rewrite', rewrite_key, img_prompt)
+            logger.debug("头像Prompt: %s", img_prompt)
+
+            return render_image(client, img_prompt, kind='avatar')
+
+    except Exception as e:
+        logger.warning("Avatar generation failed: %s", e)
+        return AVATAR_PLACEHOLDER
+
+
+def render_direct(img_prompt, kind, api_key):
+    """单次调用的图片管线：prompt 已由剧情响应与本地模板给出，直接生成图片"""
+    client = get_openai_client(api_key)
+    placeholder = SCENE_PLACEHOLDER if kind == 'scene' else AVATAR_PLACEHOLDER
+    try:
+        with metrics.span('generate_image' if kind == 'scene' else 'generate_avatar'):
+            return render_image(client, img_prompt, kind=kind) or placeholder
     except Exception as e:
-        print(f"Avatar generation failed: {e}")
-        return "/api/placeholder/100/100"
+        logger.warning("Image generation failed: %s", e)
+        return placeholder
+
+
+def cached_image(img_prompt, kind):
+    """返回 (缓存键, 仍在存储中的图片 URL 或 None)"""
+    image_key = cache_key(kind, img_prompt, IMAGE_STYLE)
+    cached_url = prompt_cache.get('image', image_key)
+    if cached_url is not None:
+        if image_store.has(cached_url):
+            return image_key, cached_url
+        # 图片已被清理
+        prompt_cache.discard('image', image_key)
+    return image_key, None
+
+
+def image_request(img_prompt):
+    return {
+        "input": IMAGE_STYLE + "\n" + img_prompt,
+        "tools": [{"type": "image_generation"}],
+    }
 
 
+def store_image_response(response, image_key, kind):
+    """保存图片生成结果并写入缓存，返回 URL；响应中没有图片时返回 None"""
+    image_data = [
+        output.result
+        for output in response.output
+        if output.type == "image_generation_call"
+    ]
+
+    if image_data:
+        url = image_store.put(base64.b64decode(image_data[0]), kind=kind)
+        prompt_cache.put('image', image_key, url)
+        return url
+    return None
+
+
+def render_image(client, img_prompt, kind):
+    """
+    调用图片生成并保存，相同 prompt 直接返回缓存的图片；未生成图片时返回 None。
+
+    同一 prompt 同时只在一个进程中生成，其他进程等待后从缓存取得同一张图片。
+    """
+    image_key, cached_url = cached_image(img_prompt, kind)
+    if cached_url is not None:
+        return cached_url
+
+    with shared_store.lock(f'image:{image_key}', IMAGE_WAIT_TIMEOUT, IMAGE_WAIT_TIMEOUT):
+        image_key, cached_url = cached_image(img_prompt, kind)
+        if cached_url is not None:
+            return cached_url
+        response = routed_call('image', client.responses.create, image_request(img_prompt))
+        metrics.record_usage(f'{kind}_image', getattr(response, 'usage', None))
+        return store_image_response(response, image_key, kind)
+
+
+# ----------- 异步版本（asgi.py 模式下由 image_jobs 在事件循环中执行） -----------
+# 缓存读写（SQLite，可能等待写锁）与图片转码都放到线程中，不阻塞事件循环
+async def agenerate_image(prompt, story, api_key):
+    client = async_openai_clients.get(api_key)
+    try:
+        with metrics.span('generate_image'):
+            rewrite_key = cache_key('scene', prompt, IMAGE_STYLE)
+            img_prompt = await asyncio.to_thread(prompt_cache.get, 'rewrite', rewrite_key)
+            if img_prompt is None:
+                response = await aroute_call('image_prompt', client.chat.completions.create,
+                                             scene_rewrite_request(prompt, story))
+                metrics.record_usage('scene_rewrite', response.usage)
+                img_prompt = response.choices[0].message.content
+                await asyncio.to_thread(prompt_cache.put, 'rewrite', rewrite_key, img_prompt)
+
+            return await arender_image(client, img_prompt, kind='scene') or SCENE_PLACEHOLDER
+
+    except Exception as e:
+        logger.warning("Image generation failed: %s", e)
+        return SCENE_PLACEHOLDER
+
+
+async def agenerate_avatar(prompt, api_key):
+    if not prompt:
+        return AVATAR_PLACEHOLDER
+
+    client = async_openai_clients.get(api_key)
+    try:
+        with metrics.span('generate_avatar'):
+            rewrite_key = cache_key('avatar', prompt, AVATAR_STYLE)
+            img_prompt = await asyncio.to_thread(prompt_cache.get, 'rewrite', rewrite_key)
+            if img_prompt is None:
+                response = await aroute_call('image_prompt', client.chat.completions.create,
+                                             avatar_rewrite_request(prompt))
+                metrics.record_usage('avatar_rewrite', response.usage)
+                img_prompt = response.choices[0].message.content
+                await asyncio.to_thread(prompt_cache.put, 'rewrite', rewrite_key, img_prompt)
+
+            return await arender_image(client, img_prompt, kind='avatar')
+
+    except Exception as e:
+        logger.warning("Avatar generation failed: %s", e)
+        return AVATAR_PLACEHOLDER
+
+
+async def arender_direct(img_prompt, kind, api_key):
+    client = async_openai_clients.get(api_key)
+    placeholder = SCENE_PLACEHOLDER if kind == 'scene' else AVATAR_PLACEHOLDER
+    try:
+        with metrics.span('generate_image' if kind == 'scene' else 'generate_avatar'):
+            return await arender_image(client, img_prompt, kind=kind) or placeholder
+    except Exception as e:
+        logger.warning("Image generation failed: %s", e)
+        return placeholder
+
+
+async def arender_image(client, img_prompt, kind):
+    image_key, cached_url = await asyncio.to_thread(cached_image, img_prompt, kind)
+    if cached_url is not None:
+        return cached_url
+
+    async with shared_store.alock(f'image:{image_key}', IMAGE_WAIT_TIMEOUT, IMAGE_WAIT_TIMEOUT):
+        image_key, cached_url = await asyncio.to_thread(cached_image, img_prompt, kind)
+        if cached_url is not None:
+            return cached_url
+        response = await aroute_call('image', client.responses.create, image_request(img_prompt))
+        metrics.record_usage(f'{kind}_image', getattr(response, 'usage', None))
+        return await asyncio.to_thread(store_image_response, response, image_key, kind)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,400 @@
+"""
+ASGI 入口（异步服务模式）
+
+同步模式下玩家在等待剧情生成的几秒内独占一个 worker；这里把等待 LLM 的部分移到事件循环中，
+一个进程即可同时容纳大量进行中的回合：
+- /game（开场剧情）与 /next_step：在线程中读取 session 并组装请求，在事件循环中用 AsyncOpenAI
+  生成剧情，再把解析结果经 environ 交给原有 Flask 路由记录、保存与渲染；
+- /next_step_stream：在事件循环中直接转发流式剧情，结束后在线程中提交回合；
+- 其余路由经内置的 WSGI 适配器在线程池中执行；
+- 每个 API Key 同时进行的剧情请求数有上限，超出的请求排队，等待过久返回 429；
+- 回合的去重、版本检查与限流（app.admit_turn）在生成前完成，通过的请求把 claim 经 environ 交给同步路由；
+- 客户端断开时取消进行中的 OpenAI 请求。
+
+运行：
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker -w 2 asgi:application
+"""
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request, session
+
+import app as adventure
+import metrics
+from openai_clients import key_fingerprint
+from streaming import JsonStringFieldExtractor, sse_event
+
+flask_app = adventure.app
+logger = logging.getLogger(__name__)
+
+# 每个 API Key 同时进行的剧情请求数，以及排队等待的最长时间（秒）
+ASYNC_KEY_CONCURRENCY = int(os.environ.get('ASYNC_KEY_CONCURRENCY', 4))
+ASYNC_KEY_QUEUE_TIMEOUT = float(os.environ.get('ASYNC_KEY_QUEUE_TIMEOUT', 30))
+# 执行 Flask 路由的线程数；/image_events 等长连接会一直占用线程
+ASYNC_WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', 200))
+
+wsgi_executor = ThreadPoolExecutor(max_workers=ASYNC_WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+
+class KeyBusy(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class KeyLimiter:
+    """按 API Key 限制同时进行的请求数；只在事件循环线程中使用，无需加锁"""
+
+    def __init__(self, limit=ASYNC_KEY_CONCURRENCY, timeout=ASYNC_KEY_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self._slots = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, api_key):
+        fp = key_fingerprint(api_key)
+        entry = self._slots.get(fp)
+        if entry is None:
+            entry = self._slots[fp] = [asyncio.Semaphore(self.limit), 0]
+        entry[1] += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                raise KeyBusy("Too many concurrent requests for this API key, please retry later.")
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._slots[fp]
+
+    def stats(self):
+        return {'keys': len(self._slots), 'requests': sum(e[1] for e in self._slots.values())}
+
+
+key_limiter = KeyLimiter()
+
+
+# ----------- ASGI <-> WSGI -----------
+def route_path(scope):
+    """去掉挂载前缀后的路径"""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    return path
+
+
+def build_environ(scope, body):
+    root_path = scope.get('root_path', '')
+    path = route_path(scope)
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    """读取完整请求体；客户端提前断开时返回 None"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def cancel_on_disconnect(receive, coro):
+    """执行 coro 并返回其结果；客户端先断开时取消它并抛出 ClientDisconnected"""
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        raise ClientDisconnected()
+    return task.result()
+
+
+async def send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_flask_response(send, response):
+    await send_response(send, response.status_code, list(response.headers.items()), response.get_data())
+
+
+async def run_wsgi(environ, receive, send):
+    """在线程池中执行 Flask，边迭代边发送响应体；客户端断开后停止迭代"""
+    loop = asyncio.get_running_loop()
+    disconnected = threading.Event()
+
+    def send_sync(message):
+        if disconnected.is_set():
+            raise ClientDisconnected()
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def call():
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        def start():
+            if not response.get('started'):
+                response['started'] = True
+                send_sync({'type': 'http.response.start', 'status': response['status'],
+                           'headers': response['headers']})
+
+        result = flask_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    start()
+                    send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            start()
+            send_sync({'type': 'http.response.body', 'body': b''})
+        except ClientDisconnected:
+            pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def watch():
+        await wait_disconnect(receive)
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await loop.run_in_executor(wsgi_executor, call)
+    finally:
+        watcher.cancel()
+
+
+# ----------- 剧情生成 -----------
+def prepare_story(environ):
+    """
+    在请求上下文中读取 session，返回 (api_key, 剧情请求参数, 玩家行动, claim)。
+
+    与对应的同步路由判断一致；不需要生成剧情（未登录、已有开场剧情、开场剧情池或预测结果可用）时返回 None，
+    由同步路由按原逻辑处理；回合检查未通过（重复提交、过期、限流）时返回要发送的 Flask 响应。
+    重复提交会在这里等待第一次提交的结果，因此在 wsgi_executor 中执行。
+    """
+    with flask_app.request_context(environ):
+        if 'api_key' not in session:
+            return None
+        if request.path == '/game':
+            if session.get('history'):
+                return None
+            # 开场剧情池中有当前设定的版本时由同步路由直接取用
+            key = adventure.session_opening_key()
+            if key is not None and adventure.opening_pool.has(key):
+                return None
+            user_action = "初始"
+        else:
+            user_action = request.form.get('player_input') or request.form.get('branch_choice')
+            # 选中的分支已在预测生成，由同步路由直接取用结果
+            if adventure.speculator.has(session.sid, len(session['history']) - 1, user_action):
+                return None
+        claim, response = adventure.admit_turn(user_action, stream=request.path == '/next_step_stream')
+        if response is not None:
+            return response
+        return session['api_key'], adventure.story_request(user_action), user_action, claim
+
+
+async def run_prepare_story(scope, body):
+    return await asyncio.get_running_loop().run_in_executor(wsgi_executor, prepare_story, build_environ(scope, body))
+
+
+def commit_story(environ, user_action, parsed, claim):
+    with flask_app.request_context(environ):
+        return adventure.commit_turn(user_action, adventure.story_from_response(parsed), claim)
+
+
+async def prefetch_story(scope, receive, send, body):
+    """/game 与 /next_step：在事件循环中生成剧情，其余工作交给同步路由"""
+    prepared = await run_prepare_story(scope, body)
+    if prepared is None:
+        return await run_wsgi(build_environ(scope, body), receive, send)
+    if not isinstance(prepared, tuple):
+        return await send_flask_response(send, prepared)
+    api_key, kwargs, _, claim = prepared
+
+    async def generate():
+        async with key_limiter.slot(api_key):
+            with metrics.span('generate_story'):
+                return await adventure.aparse_story_request(adventure.async_openai_clients.get(api_key), kwargs)
+
+    try:
+        completion = await cancel_on_disconnect(receive, generate())
+    except ClientDisconnected as e:
+        claim.fail(e)
+        logger.info("Client disconnected, cancelled story generation for %s", scope['path'])
+        return
+    except KeyBusy as e:
+        claim.fail(e)
+        return await send_response(send, 429, [('Content-Type', 'application/json')],
+                                   json.dumps({"error": str(e)}).encode())
+    except Exception as e:
+        claim.fail(e)
+        logger.warning("Error in async story generation: %s", e)
+        if route_path(scope) == '/game':
+            return await send_response(send, 302, [('Location', scope.get('root_path', '') + '/')], b'')
+        return await send_response(send, 500, [('Content-Type', 'application/json')],
+                                   json.dumps({"error": str(e)}).encode())
+
+    metrics.record_usage('story', completion.usage)
+    environ = build_environ(scope, body)
+    environ[adventure.PREFETCHED_STORY_ENV] = completion.output_parsed
+    environ[adventure.TURN_CLAIM_ENV] = claim
+    await run_wsgi(environ, receive, send)
+
+
+async def stream_story(scope, receive, send, body):
+    """/next_step_stream：与同步版本相同的事件序列（delta... -> done / error）"""
+    prepared = await run_prepare_story(scope, body)
+    if prepared is None:
+        return await run_wsgi(build_environ(scope, body), receive, send)
+    if not isinstance(prepared, tuple):
+        return await send_flask_response(send, prepared)
+    api_key, story_kwargs, user_action, claim = prepared
+    route, kwargs = adventure.split_route(story_kwargs)
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+
+    async def send_event(event, data):
+        await send({'type': 'http.response.body', 'body': sse_event(event, data).encode(), 'more_body': True})
+
+    async def generate():
+        async with key_limiter.slot(api_key):
+            client = adventure.async_openai_clients.get(api_key)
+            with metrics.span('generate_story_stream'):
+                # 输出第一个片段之前失败时改用下一层模型
+                for attempt in adventure.model_router.attempts(route):
+                    with attempt:
+                        extractor = JsonStringFieldExtractor('story_text')
+                        async with client.responses.stream(**kwargs, model=attempt.model,
+                                                           timeout=attempt.timeout) as stream:
+                            async for event in stream:
+                                if event.type == 'response.output_text.delta':
+                                    text = extractor.feed(event.delta)
+                                    if text:
+                                        attempt.started = True
+                                        await send_event('delta', {"text": text})
+                            completion = await stream.get_final_response()
+                        break
+        metrics.record_usage('story', completion.usage)
+        payload = await asyncio.to_thread(commit_story, build_environ(scope, body), user_action,
+                                          completion.output_parsed, claim)
+        await send_event('done', payload)
+
+    try:
+        await cancel_on_disconnect(receive, generate())
+    except ClientDisconnected as e:
+        claim.fail(e)
+        logger.info("Client disconnected, cancelled streaming story generation")
+        return
+    except Exception as e:
+        claim.fail(e)
+        logger.warning("Error in async next_step_stream: %s", e)
+        await send_event('error', adventure.turn_error(e)[0])
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+ROUTES = {
+    ('GET', '/game'): prefetch_story,
+    ('POST', '/next_step'): prefetch_story,
+    ('POST', '/next_step_stream'): stream_story,
+}
+
+
+# ----------- ASGI 应用 -----------
+def ensure_async_mode():
+    if adventure.async_openai_clients is None:
+        adventure.enable_async_mode(asyncio.get_running_loop())
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            ensure_async_mode()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if adventure.async_openai_clients is not None:
+                await adventure.async_openai_clients.aclose()
+            wsgi_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    ensure_async_mode()
+
+    body = await read_body(receive)
+    if body is None:
+        return
+    handler = ROUTES.get((scope['method'], route_path(scope)))
+    if handler is None:
+        return await run_wsgi(build_environ(scope, body), receive, send)
+    await handler(scope, receive, send, body)
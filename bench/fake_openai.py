@@ -0,0 +1,410 @@
+"""
+本地 OpenAI 替身服务
+
+只实现 app 实际用到的接口，供压测与离线调试使用：
+- GET  /v1/models、/v1/models/<id>           （API Key 验证）
+- POST /v1/responses                          （剧情：text.format 为 json_schema，可 stream；
+                                                图片：tools 含 image_generation）
+- POST /v1/chat/completions                   （图片 prompt 改写、剧情摘要）
+- GET  /_stats、POST /_reset                  （压测脚本读取调用次数与 prompt token 统计）
+
+让 app 使用它只需设置环境变量 OPENAI_BASE_URL=http://127.0.0.1:<port>/v1。
+
+单独运行：
+    python bench/fake_openai.py --port 8765 --story-latency 0.8 --image-latency 3
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from story_context import estimate_tokens  # noqa: E402
+
+SCENES = ["古老的森林", "雨夜的车站", "海边的灯塔", "废弃的教室", "星空下的屋顶", "地下图书馆",
+          "樱花飘落的神社", "喧闹的集市", "沙漠中的遗迹", "雪山上的小屋"]
+
+
+def _input_text(value):
+    """responses.input / chat messages 中的全部文本"""
+    if isinstance(value, str):
+        return value
+    parts = []
+    for item in value or []:
+        content = item.get('content') if isinstance(item, dict) else None
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(c.get('text', '') for c in content if isinstance(c, dict))
+    return '\n'.join(parts)
+
+
+def make_png(width, height, seed=0):
+    """不依赖 Pillow 生成指定尺寸的 PNG；加入噪点让压缩后的体积接近真实图片"""
+    rng = random.Random(seed)
+    row_len = width * 3
+    base = bytes((seed * 37 + i * 11) % 256 for i in range(row_len))
+    rows = []
+    for _ in range(height):
+        noise = rng.randbytes(row_len // 4)
+        rows.append(b'\x00' + base[:row_len - len(noise)] + noise)
+    raw = b''.join(rows)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6))
+            + chunk(b'IEND', b''))
+
+
+class FakeConfig:
+
+    def __init__(self, story_latency=0.5, chat_latency=0.2, image_latency=2.0, models_latency=0.05,
+                 jitter=0.2, story_chars=400, image_size=(1024, 768), image_variants=8,
+                 scene_pool=len(SCENES), new_character_rate=0.3, stream_chunk=16, model_latency=None, seed=0):
+        self.story_latency = story_latency
+        self.chat_latency = chat_latency
+        self.image_latency = image_latency
+        self.models_latency = models_latency
+        self.jitter = jitter  # 延迟的随机浮动比例
+        self.story_chars = story_chars
+        self.image_size = image_size
+        self.image_variants = image_variants  # 预生成的不同图片数，避免每次请求都编码 PNG
+        self.scene_pool = scene_pool  # 场景描述的取值个数，越小图片缓存命中越多
+        self.new_character_rate = new_character_rate
+        self.stream_chunk = stream_chunk
+        self.model_latency = model_latency or {}  # 模型名 -> 延迟，替代该模型的剧情 / 改写 / 图片延迟（模拟卡住的模型）
+        self.seed = seed
+
+
+class FakeOpenAIServer:
+    """在后台线程中运行的替身服务"""
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or FakeConfig()
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._images = [
+            base64.b64encode(make_png(*self.config.image_size, seed=i)).decode()
+            for i in range(max(self.config.image_variants, 1))
+        ]
+        self.reset()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-openai', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # ------- 统计 -------
+    def reset(self):
+        with self._lock:
+            self._counter = 0
+            # story_prompt_tokens 按 API Key 分组，压测时每个玩家使用不同的 Key
+            self._stats = {'calls': {}, 'story_prompt_tokens': {}}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': dict(self._stats['calls']),
+                'story_prompt_tokens': {k: list(v) for k, v in self._stats['story_prompt_tokens'].items()},
+            }
+
+    def _record(self, endpoint, api_key=None, story_tokens=None):
+        with self._lock:
+            self._counter += 1
+            calls = self._stats['calls']
+            calls[endpoint] = calls.get(endpoint, 0) + 1
+            if story_tokens is not None:
+                self._stats['story_prompt_tokens'].setdefault(api_key, []).append(story_tokens)
+            return self._counter
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                factor = 1 + self._rng.uniform(-self.config.jitter, self.config.jitter)
+            time.sleep(seconds * factor)
+
+    def _latency(self, model, default):
+        return self.config.model_latency.get(model, default)
+
+    # ------- 响应内容 -------
+    def _story(self, n):
+        cfg = self.config
+        rng = random.Random(cfg.seed * 100003 + n)
+        scene = rng.randrange(cfg.scene_pool)
+        sentence = "你沿着小路继续前进，周围的景色渐渐发生了变化。"
+        text = (sentence * (cfg.story_chars // len(sentence) + 1))[:cfg.story_chars]
+        story = {
+            "story_text": f"【第{n}段】" + text,
+            "options": [f"选项{i}：继续探索第{n}处线索" for i in range(1, 4)],
+            "image_prompt": f"{SCENES[scene % len(SCENES)]}（{scene}）",
+            "new_character": None,
+        }
+        if rng.random() < cfg.new_character_rate:
+            cid = f"npc_{rng.randrange(20)}"
+            story["new_character"] = {
+                "id": cid, "name": f"角色{cid[4:]}", "desc": "身穿灰色斗篷的旅人",
+                "detail": "沉默寡言，似乎知道很多秘密。", "event": f"在第{n}段与玩家相遇",
+            }
+        return story
+
+    @staticmethod
+    def _usage(input_tokens, output_tokens):
+        return {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        }
+
+    @staticmethod
+    def _response(model, output, usage, body):
+        return {
+            "id": f"resp_{uuid.uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": model,
+            "status": "completed",
+            "output": output,
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": body.get('tools') or [],
+            "text": body.get('text') or {"format": {"type": "text"}},
+            "usage": usage,
+            "error": None,
+            "incomplete_details": None,
+            "instructions": None,
+            "metadata": {},
+            "temperature": 1.0,
+            "top_p": 1.0,
+        }
+
+    @staticmethod
+    def _message(text, status="completed"):
+        return {
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "status": status,
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}] if text is not None else [],
+        }
+
+    def handle_responses(self, body, api_key=None):
+        """返回 (响应字典, 流式事件列表或 None)"""
+        model = body.get('model', 'gpt-4o-mini')
+        prompt = _input_text(body.get('input'))
+        input_tokens = estimate_tokens(prompt)
+
+        if any(t.get('type') == 'image_generation' for t in body.get('tools') or []):
+            n = self._record('responses.image')
+            self._sleep(self._latency(model, self.config.image_latency))
+            output = [{
+                "type": "image_generation_call",
+                "id": f"ig_{uuid.uuid4().hex}",
+                "status": "completed",
+                "result": self._images[n % len(self._images)],
+            }]
+            return self._response(model, output, self._usage(input_tokens, 0), body), None
+
+        stream = bool(body.get('stream'))
+        n = self._record('responses.stream' if stream else 'responses.parse', api_key=api_key,
+                         story_tokens=input_tokens)
+        text = json.dumps(self._story(n), ensure_ascii=False)
+        usage = self._usage(input_tokens, estimate_tokens(text))
+        if not stream:
+            self._sleep(self._latency(model, self.config.story_latency))
+            return self._response(model, [self._message(text)], usage, body), None
+        return self._response(model, [self._message(text)], usage, body), self._stream_events(model, text, usage, body)
+
+    def _stream_events(self, model, text, usage, body):
+        """按 Responses API 的事件顺序逐段产出；首个片段前等待 story_latency 的一半，其余平均分配"""
+        final = self._response(model, [], usage, body)
+        item = self._message(None, status="in_progress")
+        chunks = [text[i:i + self.config.stream_chunk] for i in range(0, len(text), self.config.stream_chunk)]
+        per_chunk = self.config.story_latency / 2 / max(len(chunks), 1)
+        seq = iter(range(1 << 30))
+
+        def event(kind, **fields):
+            return {"type": kind, "sequence_number": next(seq), **fields}
+
+        yield 0, event("response.created", response={**final, "status": "in_progress"})
+        yield self.config.story_latency / 2, event("response.output_item.added", output_index=0, item=item)
+        part = {"type": "output_text", "text": "", "annotations": []}
+        yield 0, event("response.content_part.added", item_id=item["id"], output_index=0, content_index=0, part=part)
+        for chunk in chunks:
+            yield per_chunk, event("response.output_text.delta", item_id=item["id"], output_index=0,
+                                   content_index=0, delta=chunk, logprobs=[])
+        yield 0, event("response.output_text.done", item_id=item["id"], output_index=0, content_index=0,
+                       text=text, logprobs=[])
+        done_part = {"type": "output_text", "text": text, "annotations": []}
+        yield 0, event("response.content_part.done", item_id=item["id"], output_index=0, content_index=0,
+                       part=done_part)
+        done_item = {**item, "status": "completed", "content": [done_part]}
+        yield 0, event("response.output_item.done", output_index=0, item=done_item)
+        yield 0, event("response.completed", response={**final, "output": [done_item]})
+
+    def handle_chat(self, body):
+        prompt = _input_text(body.get('messages'))
+        n = self._record('chat.completions')
+        self._sleep(self._latency(body.get('model'), self.config.chat_latency))
+        content = f"anime style illustration, scene #{n}, soft lighting, detailed background"
+        input_tokens = estimate_tokens(prompt)
+        output_tokens = estimate_tokens(content)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'gpt-4o-mini'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                      "total_tokens": input_tokens + output_tokens},
+        }
+
+    def handle_model(self, model_id=None):
+        self._record('models.retrieve' if model_id else 'models.list')
+        self._sleep(self.config.models_latency)
+        models = [{"id": m, "object": "model", "created": 0, "owned_by": "fake"}
+                  for m in ("gpt-4o-mini", "gpt-4.1-mini")]
+        if model_id is None:
+            return 200, {"object": "list", "data": models}
+        for m in models:
+            if m["id"] == model_id:
+                return 200, m
+        return 404, {"error": {"message": f"The model '{model_id}' does not exist", "type": "invalid_request_error",
+                               "param": None, "code": "model_not_found"}}
+
+    # ------- HTTP -------
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _api_key(self):
+                auth = self.headers.get('Authorization', '')
+                return auth[len('Bearer '):] if auth.startswith('Bearer ') else ''
+
+            def _authorized(self):
+                # 含 invalid 的 Key 视为无效，用于测试验证失败的路径
+                key = self._api_key()
+                if key and 'invalid' not in key:
+                    return True
+                self._send_json(401, {"error": {"message": "Incorrect API key provided.",
+                                                "type": "invalid_request_error", "param": None,
+                                                "code": "invalid_api_key"}})
+                return False
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/_stats':
+                    return self._send_json(200, fake.stats())
+                if not path.startswith('/v1/models'):
+                    return self._send_json(404, {"error": {"message": "not found"}})
+                if not self._authorized():
+                    return
+                model_id = path[len('/v1/models/'):] or None if path.startswith('/v1/models/') else None
+                self._send_json(*fake.handle_model(model_id))
+
+            def do_POST(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/_reset':
+                    fake.reset()
+                    return self._send_json(200, {"ok": True})
+                if path not in ('/v1/responses', '/v1/chat/completions'):
+                    return self._send_json(404, {"error": {"message": "not found"}})
+                body = self._body()
+                if not self._authorized():
+                    return
+                if path == '/v1/chat/completions':
+                    return self._send_json(200, fake.handle_chat(body))
+                response, events = fake.handle_responses(body, api_key=self._api_key())
+                if events is None:
+                    return self._send_json(200, response)
+                self._stream(events)
+
+            def _stream(self, events):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                for delay, event in events:
+                    if delay:
+                        time.sleep(delay)
+                    self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+                    self.wfile.flush()
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 OpenAI 替身服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--story-latency', type=float, default=0.5)
+    parser.add_argument('--chat-latency', type=float, default=0.2)
+    parser.add_argument('--image-latency', type=float, default=2.0)
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--story-chars', type=int, default=400)
+    parser.add_argument('--image-size', default='1024x768')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+    server = FakeOpenAIServer(FakeConfig(
+        story_latency=args.story_latency, chat_latency=args.chat_latency, image_latency=args.image_latency,
+        jitter=args.jitter, story_chars=args.story_chars, image_size=(width, height),
+    ), host=args.host, port=args.port)
+    print(f"Fake OpenAI listening on {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+"""
+离线压测
+
+启动本地 OpenAI 替身服务（bench/fake_openai.py）与 app，模拟 N 个玩家并发游玩 M 回合：
+    /start -> /game -> (/next_step -> /get_image) × M -> /history -> /save -> /load -> /save（增量）
+
+报告各接口 p50/p95/p99 延迟与吞吐，以及每回合的 Cookie 字节数、服务端会话字节数、
+剧情请求的 prompt token 数。每次结果追加到 bench/results/history.jsonl，
+并与相同配置的上一次结果对比，便于发现随回合数增长的退化。
+
+示例：
+    python bench/loadtest.py --players 8 --turns 20
+    python bench/loadtest.py --players 4 --turns 50 --mode stream --story-latency 0.2
+    python bench/loadtest.py --players 200 --turns 5 --asgi                       # 异步服务模式（asgi.py）
+    python bench/loadtest.py --target http://127.0.0.1:5000 --fake-port 8765   # 压测已启动的 app
+
+tests/test_loadtest.py 以较小的规模在 pytest 中调用 run()，检查各接口没有错误。
+"""
+import argparse
+import contextlib
+import gzip
+import html
+import json
+import logging
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_openai import FakeConfig, FakeOpenAIServer  # noqa: E402
+
+RESULTS_PATH = os.path.join(ROOT, 'bench', 'results', 'history.jsonl')
+# p95 比上一次同配置结果高出该比例时提示退化
+REGRESSION_THRESHOLD = 0.2
+
+_OPTION_RE = re.compile(r'name="branch_choice" value="([^"]*)"')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class Recorder:
+    """线程安全地收集每次请求的耗时与每回合指标"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.per_turn = {}
+
+    def timed(self, name, fn):
+        start = time.perf_counter()
+        try:
+            response = fn()
+        except httpx.HTTPError as e:
+            self.error(name, str(e))
+            return None
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+        if response.status_code >= 400:
+            self.error(name, f"HTTP {response.status_code}")
+        return response
+
+    def error(self, name, message):
+        with self._lock:
+            errors = self.errors.setdefault(name, {})
+            errors[message] = errors.get(message, 0) + 1
+
+    def turn_metric(self, metric, turn, value):
+        if value is None:
+            return
+        with self._lock:
+            self.per_turn.setdefault(metric, {}).setdefault(turn, []).append(value)
+
+
+class SessionProbe:
+    """读取服务端会话存储的大小；压测外部 app 时不可用"""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def session_bytes(self, sid):
+        if self.backend is None or not sid:
+            return None
+        conn = self.backend._conn()
+        data = conn.execute('SELECT LENGTH(data) FROM sessions WHERE sid = ?', (sid,)).fetchone()
+        turns = conn.execute('SELECT COALESCE(SUM(LENGTH(record)), 0) FROM turns WHERE sid = ?', (sid,)).fetchone()
+        return (data[0] if data else 0) + turns[0]
+
+
+def cookie_bytes(client):
+    return sum(len(name) + len(value) + 3 for name, value in client.cookies.items())
+
+
+def session_id(client, app_module):
+    """从 Cookie 中解出会话 ID（只在进程内压测时可用）"""
+    if app_module is None:
+        return None
+    value = client.cookies.get(app_module.app.config.get('SESSION_COOKIE_NAME', 'session'))
+    if not value:
+        return None
+    try:
+        return app_module.app.session_interface._signer(app_module.app).unsign(value).decode()
+    except Exception:
+        return None
+
+
+def parse_options(response, mode):
+    """从 /game、/next_step 或 /next_step_stream 的响应中取出本回合选项"""
+    if response is None or not response.is_success:
+        return []
+    if mode == 'stream':
+        done = response.text.rsplit('event: done\ndata: ', 1)
+        return json.loads(done[1].split('\n', 1)[0]).get('options', []) if len(done) == 2 else []
+    if mode == 'json':
+        return response.json().get('options', [])
+    return [html.unescape(v) for v in _OPTION_RE.findall(response.text)]
+
+
+def play(index, args, base_url, recorder, probe, app_module):
+    # 每次运行使用不同的 Key，进程内多次运行时不会复用指向上一个替身服务的客户端
+    api_key = f"sk-bench-{index:04d}-{uuid.uuid4().hex[:12]}"
+    with httpx.Client(base_url=base_url, timeout=args.timeout, follow_redirects=False) as client:
+        response = recorder.timed('/start', lambda: client.post('/start', data={
+            'api_key': api_key,
+            'theme': '奇幻冒险',
+            'style': '轻松',
+            'difficulty': '普通',
+            'language': 'zh',
+            'enable_images': 'on' if args.images else '',
+        }))
+        if response is None or not response.is_success or not response.json().get('success'):
+            return api_key
+
+        options = parse_options(recorder.timed('/game', lambda: client.get('/game')), 'html')
+
+        def record_turn(turn):
+            recorder.turn_metric('cookie_bytes', turn, cookie_bytes(client))
+            recorder.turn_metric('session_bytes', turn, probe.session_bytes(session_id(client, app_module)))
+
+        record_turn(0)
+        for turn in range(1, args.turns + 1):
+            # 轮流选择各个选项，预测生成只覆盖前 K 个时可以看到命中与未命中
+            action = {'branch_choice': options[turn % len(options)] if options else '继续'}
+            if args.mode == 'stream':
+                response = recorder.timed('/next_step_stream', lambda: client.post('/next_step_stream', data=action))
+            elif args.mode == 'json':
+                response = recorder.timed('/next_step', lambda: client.post(
+                    '/next_step', data=action, headers={'Accept': 'application/json'}))
+            else:
+                response = recorder.timed('/next_step', lambda: client.post('/next_step', data=action))
+            options = parse_options(response, args.mode)
+            if args.images:
+                recorder.timed('/get_image', lambda: client.get('/get_image'))
+            record_turn(turn)
+            if args.think_time:
+                time.sleep(args.think_time)
+
+        recorder.timed('/history', lambda: client.get('/history'))
+
+        response = recorder.timed('/save', lambda: client.get('/save'))
+        if response is not None and response.is_success:
+            # 存档字节数按解压后计算（即 localStorage 中的大小），传输字节数另计
+            recorder.turn_metric('save_bytes', args.turns, len(response.content))
+            recorder.turn_metric('save_wire_bytes', args.turns, response.num_bytes_downloaded)
+            data = response.json()
+            payload = gzip.compress(json.dumps(data['save'], ensure_ascii=False).encode('utf-8'))
+            recorder.timed('/load', lambda: client.post('/load', content=payload, headers={
+                'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}))
+            # 检查点之后的增量存档
+            checkpoint = data['checkpoint']
+            response = recorder.timed('/save', lambda: client.get('/save', params={
+                'since': checkpoint['count'], 'hash': checkpoint['hash'] or ''}))
+            if response is not None and response.is_success:
+                recorder.turn_metric('save_delta_bytes', args.turns, len(response.content))
+    return api_key
+
+
+def app_stats(app_module):
+    """进程内压测时附带 app 各组件的统计"""
+    if app_module is None:
+        return None
+    return {
+        'openai_clients': app_module.openai_clients.stats(),
+        'key_validation': app_module.key_validator.stats(),
+        'prompt_cache': app_module.prompt_cache.stats(),
+        'image_jobs': app_module.image_jobs.stats(),
+        'speculation': app_module.speculator.stats(),
+    }
+
+
+def summarize(recorder, fake_stats, keys, elapsed, args):
+    endpoints = {}
+    total_requests = 0
+    for name, values in sorted(recorder.latencies.items()):
+        total_requests += len(values)
+        endpoints[name] = {
+            'count': len(values),
+            'errors': sum(recorder.errors.get(name, {}).values()),
+            'p50_ms': round(percentile(values, 50) * 1000, 1),
+            'p95_ms': round(percentile(values, 95) * 1000, 1),
+            'p99_ms': round(percentile(values, 99) * 1000, 1),
+        }
+
+    per_turn = {}
+    for metric, turns in recorder.per_turn.items():
+        per_turn[metric] = {str(t): round(statistics.mean(v), 1) for t, v in sorted(turns.items())}
+
+    # 第 0 项是 /game 的开场剧情，第 i 项是第 i 回合；开启预测生成时调用次数多于回合数，只统计总量
+    tokens = {}
+    story_calls = prompt_tokens_total = 0
+    for key in keys:
+        series = fake_stats['story_prompt_tokens'].get(key, [])
+        story_calls += len(series)
+        prompt_tokens_total += sum(series)
+        if len(series) != args.turns + 1:
+            continue
+        for turn, value in enumerate(series):
+            tokens.setdefault(turn, []).append(value)
+    per_turn['prompt_tokens'] = {str(t): round(statistics.mean(v), 1) for t, v in sorted(tokens.items())}
+
+    turns_played = len(recorder.latencies.get('/next_step', [])) + len(recorder.latencies.get('/next_step_stream', []))
+    return {
+        'elapsed_s': round(elapsed, 2),
+        'requests': total_requests,
+        'throughput_rps': round(total_requests / elapsed, 2) if elapsed else None,
+        'turns_per_s': round(turns_played / elapsed, 2) if elapsed else None,
+        'endpoints': endpoints,
+        'errors': recorder.errors,
+        'per_turn': per_turn,
+        'openai_calls': fake_stats['calls'],
+        'story_calls': story_calls,
+        'prompt_tokens_total': prompt_tokens_total,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def config_label(args):
+    return (f"{'asgi' if args.asgi else 'wsgi'}-{args.mode}-p{args.players}-t{args.turns}-img{int(args.images)}"
+            f"-s{args.story_latency}-i{args.image_latency}-c{args.story_chars}-k{args.speculate}")
+
+
+def load_previous(label):
+    if not os.path.exists(RESULTS_PATH):
+        return None
+    previous = None
+    with open(RESULTS_PATH, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('label') == label:
+                previous = entry
+    return previous
+
+
+def save_result(entry):
+    os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+    with open(RESULTS_PATH, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def _last(series):
+    if not series:
+        return None
+    return series[max(series, key=int)]
+
+
+def print_report(result, previous):
+    print(f"\n{result['elapsed_s']}s, {result['requests']} requests, "
+          f"{result['throughput_rps']} req/s, {result['turns_per_s']} turns/s")
+    print(f"{'endpoint':<20}{'count':>7}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'Δp95':>9}")
+    for name, e in result['endpoints'].items():
+        delta = ''
+        prev = previous and previous['result']['endpoints'].get(name)
+        if prev and prev['p95_ms']:
+            change = (e['p95_ms'] - prev['p95_ms']) / prev['p95_ms']
+            delta = f"{change:+.0%}" + (' !' if change > REGRESSION_THRESHOLD else '')
+        print(f"{name:<20}{e['count']:>7}{e['errors']:>5}{e['p50_ms']:>10}{e['p95_ms']:>10}{e['p99_ms']:>10}{delta:>9}")
+
+    per_turn = result['per_turn']
+    turns = sorted({int(t) for series in per_turn.values() for t in series})
+    if turns:
+        step = max(len(turns) // 10, 1)
+        shown = turns[::step] + ([turns[-1]] if turns[-1] not in turns[::step] else [])
+        metrics = [m for m in ('prompt_tokens', 'cookie_bytes', 'session_bytes') if per_turn.get(m)]
+        print(f"\n{'turn':>6}" + ''.join(f"{m:>16}" for m in metrics))
+        for t in shown:
+            print(f"{t:>6}" + ''.join(f"{per_turn[m].get(str(t), ''):>16}" for m in metrics))
+    print(f"\nstory calls: {result['story_calls']}, prompt tokens: {result['prompt_tokens_total']}")
+    print("openai calls: " + ", ".join(f"{k}={v}" for k, v in sorted(result['openai_calls'].items())))
+    if per_turn.get('save_bytes'):
+        print(f"/save payload: {_last(per_turn['save_bytes'])} bytes "
+              f"({_last(per_turn.get('save_wire_bytes'))} on the wire), "
+              f"incremental: {_last(per_turn.get('save_delta_bytes'))} bytes")
+    if previous:
+        for metric in ('prompt_tokens', 'session_bytes'):
+            before, after = _last(previous['result']['per_turn'].get(metric)), _last(per_turn.get(metric))
+            if before and after:
+                print(f"{metric} at last turn: {before} -> {after} ({(after - before) / before:+.0%})")
+        print(f"compared with {previous['revision']} @ {previous['timestamp']}")
+    speculation = (result.get('app') or {}).get('speculation')
+    if speculation and speculation['started']:
+        print(f"speculation: {speculation['hits']} hits / {speculation['misses']} misses, "
+              f"{speculation['started']} started, {speculation['cancelled']} cancelled, "
+              f"{speculation['wasted']} generated but unused")
+    if result['errors']:
+        print(f"\nerrors: {json.dumps(result['errors'], ensure_ascii=False)}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(fake, tmpdir, use_asgi=False, speculate=0):
+    """在当前进程中启动 app（存储放在临时目录），返回 (base_url, app 模块, 会话存储)"""
+    os.environ['OPENAI_BASE_URL'] = fake.base_url
+    os.environ['SPECULATIVE_TOP_K'] = str(speculate)
+    os.environ.setdefault('SESSION_DB_PATH', os.path.join(tmpdir, 'sessions.db'))
+    os.environ.setdefault('IMAGE_STORE_DIR', os.path.join(tmpdir, 'images'))
+    os.environ.setdefault('PROMPT_CACHE_PATH', os.path.join(tmpdir, 'prompt_cache.db'))
+    # 压测的回合间隔远小于真人，默认关闭回合限流（显式设置时保留）
+    os.environ.setdefault('RATE_LIMIT_KEY_PER_MIN', '0')
+    os.environ.setdefault('RATE_LIMIT_SESSION_PER_MIN', '0')
+    # 开场剧情池会让各玩家的剧情调用次数不一致（按回合统计 token 时被跳过），默认关闭
+    os.environ.setdefault('OPENING_POOL_VARIANTS', '0')
+    os.environ.setdefault('OPENING_POOL_PATH', os.path.join(tmpdir, 'openings.db'))
+    os.environ.setdefault('COORDINATION_DB_PATH', os.path.join(tmpdir, 'coordination.db'))
+    os.environ.setdefault('SAVE_SLOTS_DB_PATH', os.path.join(tmpdir, 'save_slots.db'))
+    import app as app_module
+
+    if use_asgi:
+        import uvicorn
+        import asgi
+
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(asgi.application, host='127.0.0.1', port=port, log_level='warning'))
+        threading.Thread(target=server.run, name='bench-app', daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        return f"http://127.0.0.1:{port}", app_module, app_module.session_backend
+
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-app', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", app_module, app_module.session_backend
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='使用本地 OpenAI 替身对 app 做离线压测')
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--mode', choices=['json', 'html', 'stream'], default='json',
+                        help='/next_step 的调用方式：JSON 局部更新、完整页面或 SSE 流')
+    parser.add_argument('--asgi', action='store_true', help='以异步服务模式（asgi.py + uvicorn）启动 app')
+    parser.add_argument('--speculate', type=int, default=0, metavar='K',
+                        help='开启预测生成，为前 K 个选项提前生成下一回合（仅进程内启动的 app）')
+    parser.add_argument('--no-images', dest='images', action='store_false')
+    parser.add_argument('--think-time', type=float, default=0.0, help='每回合之间的停顿秒数')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--story-latency', type=float, default=0.3)
+    parser.add_argument('--chat-latency', type=float, default=0.1)
+    parser.add_argument('--image-latency', type=float, default=1.0)
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--story-chars', type=int, default=400)
+    parser.add_argument('--image-size', default='1024x768')
+    parser.add_argument('--target', help='压测已启动的 app（此时替身服务需与 app 的 OPENAI_BASE_URL 一致）')
+    parser.add_argument('--fake-port', type=int, default=0)
+    parser.add_argument('--no-save', dest='save', action='store_false', help='不写入结果历史')
+    parser.add_argument('--verbose', action='store_true', help='保留 app 的调试输出')
+    return parser
+
+
+def run(args):
+    """启动替身服务（未指定 --target 时还有 app）并运行压测，返回结果"""
+    if not args.verbose:
+        # app 导入时按 LOG_LEVEL 配置日志，默认只保留警告以免淹没报告
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+    fake = FakeOpenAIServer(FakeConfig(
+        story_latency=args.story_latency, chat_latency=args.chat_latency, image_latency=args.image_latency,
+        jitter=args.jitter, story_chars=args.story_chars, image_size=(width, height),
+    ), port=args.fake_port).start()
+
+    with tempfile.TemporaryDirectory(prefix='ai-adventure-bench-') as tmpdir:
+        if args.target:
+            base_url, app_module, backend = args.target.rstrip('/'), None, None
+        else:
+            base_url, app_module, backend = start_app(fake, tmpdir, use_asgi=args.asgi, speculate=args.speculate)
+        print(f"app: {base_url}  fake OpenAI: {fake.base_url}  "
+              f"players: {args.players}  turns: {args.turns}  mode: {args.mode}")
+
+        recorder = Recorder()
+        probe = SessionProbe(backend)
+        keys = []
+        threads = []
+        # 屏蔽 app 与依赖库可能直接写到标准输出的内容
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+        with quiet:
+            start = time.perf_counter()
+            for i in range(args.players):
+                def player(i=i):
+                    keys.append(play(i, args, base_url, recorder, probe, app_module))
+                t = threading.Thread(target=player, name=f'player-{i}')
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+
+        result = summarize(recorder, fake.stats(), keys, elapsed, args)
+        result['app'] = app_stats(app_module)
+        fake.stop()
+        if not args.verbose:
+            # 临时目录即将删除，仍在进行的后台图片任务会失败，这些告警与结果无关
+            logging.disable(logging.WARNING)
+    return result
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    result = run(args)
+    label = config_label(args)
+    previous = load_previous(label)
+    print_report(result, previous)
+    if args.save:
+        save_result({
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'label': label,
+            'config': vars(args),
+            'result': result,
+        })
+        print(f"\nresult appended to {os.path.relpath(RESULTS_PATH, ROOT)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+角色登记表
+
+session['characters'] 保存为 {角色 ID: 角色记录}（按首次出场排序），CharacterRegistry 在其上提供：
+- 按 ID / 别名直接查找；模型给同一角色换了 ID 时按名称模糊匹配到已有角色并记为别名，
+  不会再生成第二个头像；
+- 每个角色的事件只追加，超过 CHARACTER_EVENT_CAP 条时把较早的一半折叠进 event_summary，
+  角色记录（以及模板、存档中的角色数据）不会随游戏进行无限增长；
+- 记录本次请求中改动过的角色，回合结果只向客户端发送这些角色。
+
+旧会话中的列表在第一次访问时转换。
+"""
+import os
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+# 每个角色保留的事件条数，超出后较早的事件折叠进摘要
+CHARACTER_EVENT_CAP = int(os.environ.get('CHARACTER_EVENT_CAP', 12))
+# 事件摘要的最大长度（字符），超出时保留最近的部分
+CHARACTER_SUMMARY_CHARS = int(os.environ.get('CHARACTER_SUMMARY_CHARS', 400))
+# 名称相似度达到该值时视为同一角色
+CHARACTER_MATCH_RATIO = float(os.environ.get('CHARACTER_MATCH_RATIO', 0.85))
+
+_SEPARATORS = re.compile(r'[\s·・•\-_.,，、()（）「」“”"\']+')
+
+
+def normalize_name(name):
+    """比较用的名称：全角转半角、忽略大小写与分隔符"""
+    name = unicodedata.normalize('NFKC', name or '').casefold()
+    return _SEPARATORS.sub('', name)
+
+
+def _name_parts(name):
+    name = unicodedata.normalize('NFKC', name or '').casefold()
+    return [p for p in _SEPARATORS.split(name) if p]
+
+
+def similar_names(a, b):
+    """
+    两个名称是否指同一角色：规范化后相同、一方是另一方的姓或名（如「艾米丽」与「艾米丽·史密斯」），
+    或足够相似（拼写差异，只比较较长的名称，短名称差一个字往往就是另一个人）。
+    """
+    na, nb = normalize_name(a), normalize_name(b)
+    if not na or not nb:
+        return False
+    if na == nb:
+        return True
+    short, full = sorted((a, b), key=lambda n: len(normalize_name(n)))
+    parts = _name_parts(full)
+    if len(parts) > 1 and len(normalize_name(short)) >= 2 and normalize_name(short) in (parts[0], parts[-1]):
+        return True
+    if min(len(na), len(nb)) < 4:
+        return False
+    return SequenceMatcher(None, na, nb).ratio() >= CHARACTER_MATCH_RATIO
+
+
+def index_characters(characters):
+    """旧版角色列表转换为 {ID: 记录}；重复 ID 的事件合并到第一次出现的记录"""
+    if isinstance(characters, dict):
+        return characters
+    records = {}
+    for c in characters or []:
+        existing = records.get(c['id'])
+        if existing is None:
+            records[c['id']] = dict(c, events=list(c.get('events') or []))
+        else:
+            existing['events'].extend(c.get('events') or [])
+    return records
+
+
+def character_list(characters):
+    """按出场顺序返回角色记录（兼容旧版列表）"""
+    if isinstance(characters, dict):
+        return list(characters.values())
+    return list(characters or [])
+
+
+def find_character(characters, char_id):
+    """在会话数据的角色中按 ID 查找（供后台写回使用，兼容旧版列表）"""
+    if isinstance(characters, dict):
+        return characters.get(char_id)
+    return next((c for c in characters or [] if c['id'] == char_id), None)
+
+
+class CharacterRegistry:
+
+    def __init__(self, records, event_cap=CHARACTER_EVENT_CAP, summary_chars=CHARACTER_SUMMARY_CHARS):
+        self.records = records
+        self.event_cap = max(event_cap, 2)
+        self.summary_chars = summary_chars
+        self.changed = []
+        self._ids = {}
+        self._names = {}
+        for char_id, record in records.items():
+            self._index(char_id, record)
+
+    def _index(self, char_id, record):
+        self._ids[char_id] = char_id
+        for alias in record.get('aliases', ()):
+            self._ids[alias] = char_id
+        self._names.setdefault(normalize_name(record['name']), char_id)
+
+    # ------- 查找 -------
+    def get(self, char_id):
+        canonical = self._ids.get(char_id)
+        return self.records[canonical] if canonical is not None else None
+
+    def match(self, char_id, name):
+        """按 ID、别名、规范化名称、模糊名称的顺序查找已有角色"""
+        record = self.get(char_id)
+        if record is not None:
+            return record
+        canonical = self._names.get(normalize_name(name))
+        if canonical is not None:
+            return self.records[canonical]
+        for record in self.records.values():
+            if similar_names(record['name'], name):
+                return record
+        return None
+
+    def names(self):
+        """角色名称，最近有事件的角色排在最后（供剧情上下文按预算截取）"""
+        ordered = sorted(self.records.values(), key=lambda c: c.get('turn', 0))
+        return [c['name'] for c in ordered]
+
+    # ------- 修改 -------
+    def upsert(self, char, turn):
+        """
+        登记模型返回的角色，返回 (角色记录, 是否新角色)。
+
+        已有角色（含换了 ID 的同一角色）只追加事件；新 ID 记为别名。
+        """
+        record = self.match(char['id'], char['name'])
+        if record is None:
+            record = {
+                "id": char['id'],
+                "name": char['name'],
+                "desc": char['desc'],
+                "detail": char['detail'],
+                "events": [],
+                "turn": turn,
+            }
+            self.records[record['id']] = record
+            self._index(record['id'], record)
+            created = True
+        else:
+            created = False
+            if char['id'] not in self._ids:
+                record.setdefault('aliases', []).append(char['id'])
+                self._ids[char['id']] = record['id']
+            if not record.get('detail') and char.get('detail'):
+                record['detail'] = char['detail']
+        self.add_event(record, char.get('event'), turn)
+        self.mark_changed(record)
+        return record, created
+
+    def add_event(self, record, event, turn):
+        event = (event or '').strip()
+        record['turn'] = turn
+        if not event or (record['events'] and record['events'][-1] == event):
+            return
+        record['events'].append(event)
+        if len(record['events']) > self.event_cap:
+            folded = len(record['events']) - self.event_cap // 2
+            self._fold(record, record['events'][:folded])
+            del record['events'][:folded]
+
+    def _fold(self, record, events):
+        summary = "；".join(filter(None, [record.get('event_summary')] + events))
+        if len(summary) > self.summary_chars:
+            summary = "…" + summary[-(self.summary_chars - 1):]
+        record['event_summary'] = summary
+
+    def mark_changed(self, record):
+        if record['id'] not in self.changed:
+            self.changed.append(record['id'])
+
+    def changed_records(self):
+        return [self.records[char_id] for char_id in self.changed]
@@ -0,0 +1,208 @@
+"""
+多进程协调
+
+gunicorn 等多 worker 部署中各进程的内存状态互不可见。本模块用一个本地 SQLite（WAL）文件在
+同一台机器的进程之间共享状态，不依赖外部服务：
+- 键值缓存：带过期时间，按命名空间区分（签名密钥、Key 验证结果、剧情摘要、回合结果等）；
+- 租约锁：同一项生成（回合、图片、摘要）同时只在一个进程中进行，持有者异常退出时租约到期自动释放；
+- 令牌桶：限流在所有进程间共用同一个桶。
+
+值以 JSON 保存。图片 prompt 缓存、开场剧情池、会话与图片文件本身已在共享的 SQLite / 文件中。
+"""
+import asyncio
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+# 等待其他进程释放租约时的轮询间隔（秒）
+COORDINATION_POLL_INTERVAL = float(os.environ.get('COORDINATION_POLL_INTERVAL', 0.2))
+
+
+class SharedStore:
+
+    def __init__(self, path, poll_interval=COORDINATION_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS shared_cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL,
+                    PRIMARY KEY (namespace, key)
+                );
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    token TEXT NOT NULL,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS token_buckets (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # ------- 键值缓存 -------
+    def get(self, namespace, key):
+        row = self._conn().execute(
+            'SELECT value FROM shared_cache WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO shared_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+        self._maybe_prune()
+
+    def delete(self, namespace, key):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM shared_cache WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def get_or_create(self, namespace, key, factory):
+        """不存在时写入 factory() 的结果；多个进程同时调用时都得到第一次写入的值"""
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO shared_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, NULL)',
+                (namespace, key, json.dumps(factory(), ensure_ascii=False))
+            )
+        return self.get(namespace, key)
+
+    def _maybe_prune(self):
+        with self._lock:
+            self._writes += 1
+            if self._writes % 200:
+                return
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute('DELETE FROM shared_cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+            conn.execute('DELETE FROM leases WHERE expires_at <= ?', (now,))
+
+    # ------- 租约 -------
+    def acquire(self, name, ttl, holder=''):
+        """取得租约时返回令牌（释放时使用），已被持有时返回 None"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+            if row is not None and row[0] > now:
+                return None
+            conn.execute('INSERT OR REPLACE INTO leases (name, token, holder, expires_at) VALUES (?, ?, ?, ?)',
+                         (name, token, holder, now + ttl))
+        return token
+
+    def release(self, name, token):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM leases WHERE name = ? AND token = ?', (name, token))
+
+    def holder(self, name):
+        """租约有效时返回取得时记录的 holder，否则返回 None"""
+        row = self._conn().execute(
+            'SELECT holder FROM leases WHERE name = ? AND expires_at > ?', (name, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    @contextmanager
+    def lock(self, name, ttl, timeout):
+        """
+        跨进程互斥：等待至多 timeout 秒，返回是否取得了锁。
+
+        等待超时（持有者仍在运行）时不再阻塞调用方，以不加锁的方式继续。
+        """
+        deadline = time.monotonic() + timeout
+        token = self.acquire(name, ttl)
+        while token is None and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            token = self.acquire(name, ttl)
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                self.release(name, token)
+
+    @asynccontextmanager
+    async def alock(self, name, ttl, timeout):
+        """
+        lock 的协程版本。
+
+        取得与释放都要写锁（BEGIN IMMEDIATE），其他进程正在写入时最多阻塞 10 秒，放到线程中执行，
+        不阻塞事件循环上的其他请求。
+        """
+        deadline = time.monotonic() + timeout
+        token = await asyncio.to_thread(self.acquire, name, ttl)
+        while token is None and time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            token = await asyncio.to_thread(self.acquire, name, ttl)
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                await asyncio.to_thread(self.release, name, token)
+
+    # ------- 令牌桶 -------
+    def take_token(self, name, rate, burst):
+        """
+        取一个令牌；成功返回 0，否则返回需要等待的秒数（不消耗令牌）。
+
+        name 为 "<桶的类别>:<键>"，同一类别的桶使用相同的 rate / burst。
+        """
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT tokens, updated_at FROM token_buckets WHERE name = ?', (name,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(now - row[1], 0) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            conn.execute('INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                         (name, tokens - 1 if not wait else tokens, now))
+        if row is None:
+            self._maybe_prune_buckets(name.split(':', 1)[0] + ':', now - burst / rate)
+        return wait
+
+    def refund_token(self, name, burst):
+        with self._conn() as conn:
+            conn.execute('UPDATE token_buckets SET tokens = MIN(?, tokens + 1) WHERE name = ?', (burst, name))
+
+    def _maybe_prune_buckets(self, prefix, full_before):
+        # 已经补满的桶与新桶等价，可以丢弃
+        with self._lock:
+            self._writes += 1
+            if self._writes % 200:
+                return
+        with self._conn() as conn:
+            conn.execute("DELETE FROM token_buckets WHERE name >= ? AND name < ? AND updated_at < ?",
+                         (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1), full_before))
+
+
+def stable_secret_key(store, env_value=None):
+    """会话签名密钥：优先使用配置的值，否则使用共享存储中首次生成的随机密钥（所有进程与重启后一致）"""
+    if env_value:
+        return env_value
+    return store.get_or_create('config', 'secret_key', lambda: secrets.token_hex(32))
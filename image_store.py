@@ -0,0 +1,191 @@
+"""
+生成图片的内容寻址存储
+
+- 文件按内容哈希命名，相同图片只保存一份；
+- 安装了 Pillow 时转存为压缩的 WebP（不支持时用 JPEG），头像另存缩略图；
+- 文件名即内容哈希，可以配合 immutable 缓存头与 ETag 长期缓存；
+- 超出磁盘配额时清理没有任何会话 / 存档引用的旧图片。
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow 为可选依赖，缺失时直接保存原始 PNG
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_STORE_QUOTA_MB = float(os.environ.get('IMAGE_STORE_QUOTA_MB', 2048))
+# 清理时跳过较新的图片：浏览器本地存档中的引用服务端看不到
+IMAGE_GC_MIN_AGE = float(os.environ.get('IMAGE_GC_MIN_AGE', 7 * 24 * 3600))
+IMAGE_GC_INTERVAL = 600
+
+SCENE_MAX_SIZE = (1280, 1280)
+AVATAR_THUMB_SIZE = (200, 200)  # 100×100 头像位的 2 倍，兼顾高分屏
+
+_HASH_LEN = 40
+_NAME_RE = re.compile(r'^([0-9a-f]{%d})(\.thumb)?\.(png|webp|jpg)$' % _HASH_LEN)
+_REF_RE = re.compile(r'/images/([0-9a-f]{%d})' % _HASH_LEN)
+
+
+def is_image_name(filename):
+    """是否为存储中的文件名（内容哈希 + 扩展名）"""
+    return bool(filename) and _NAME_RE.match(filename) is not None
+
+
+def extract_image_hashes(text):
+    """从任意文本（如会话 JSON）中提取引用的图片哈希"""
+    return set(_REF_RE.findall(text or ''))
+
+
+class ImageStore:
+
+    def __init__(self, root, url_prefix='/images', quota_bytes=IMAGE_STORE_QUOTA_MB * 1024 * 1024,
+                 min_age=IMAGE_GC_MIN_AGE, referenced=None):
+        self.root = root
+        self.url_prefix = url_prefix
+        self.quota_bytes = quota_bytes
+        self.min_age = min_age
+        # referenced() 返回当前被引用的图片哈希集合，由 app 提供
+        self.referenced = referenced
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self._lock = threading.Lock()
+        self._gc_lock = threading.Lock()
+        self._last_gc = 0
+        self._size = sum(e.stat().st_size for e in os.scandir(root) if e.is_file())
+        if Image is not None and features.check('webp'):
+            self._format, self._ext = 'WEBP', 'webp'
+        else:
+            self._format, self._ext = 'JPEG', 'jpg'
+
+    # ------- 写入 -------
+    def put(self, data, kind='scene'):
+        """保存图片并返回 URL；kind 为 'avatar' 时返回缩略图地址"""
+        digest = hashlib.sha256(data).hexdigest()[:_HASH_LEN]
+        url = None
+        if Image is not None:
+            try:
+                url = self._put_variants(data, digest, kind)
+            except Exception as e:
+                logger.warning("Image conversion failed, storing original: %s", e)
+        if url is None:
+            self._write(f"{digest}.png", lambda: data)
+            url = f"{self.url_prefix}/{digest}.png"
+        self._maybe_collect()
+        return url
+
+    def _put_variants(self, data, digest, kind):
+        self._write(f"{digest}.{self._ext}", lambda: self._encode(data, SCENE_MAX_SIZE))
+        if kind == 'avatar':
+            name = f"{digest}.thumb.{self._ext}"
+            self._write(name, lambda: self._encode(data, AVATAR_THUMB_SIZE, crop=True))
+            return f"{self.url_prefix}/{name}"
+        return f"{self.url_prefix}/{digest}.{self._ext}"
+
+    def _write(self, name, render):
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            # 已有相同内容，刷新时间避免被当作旧文件清理
+            os.utime(path)
+            return
+        payload = render()
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp, path)
+        with self._lock:
+            self._size += len(payload)
+
+    def _encode(self, data, size, crop=False):
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert('RGB')
+            if crop:
+                # 居中裁成正方形再缩放，适配头像位
+                side = min(img.size)
+                left = (img.width - side) // 2
+                top = (img.height - side) // 2
+                img = img.crop((left, top, left + side, top + side))
+            img.thumbnail(size)
+            out = io.BytesIO()
+            if self._format == 'WEBP':
+                img.save(out, 'WEBP', quality=82, method=4)
+            else:
+                img.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+            return out.getvalue()
+
+    # ------- 读取 -------
+    def path_for(self, filename):
+        """校验文件名并返回磁盘路径，非法或不存在时返回 None"""
+        if not is_image_name(filename):
+            return None
+        path = os.path.join(self.root, filename)
+        return path if os.path.exists(path) else None
+
+    def has(self, url):
+        """URL 指向的图片是否仍在存储中"""
+        prefix = self.url_prefix + '/'
+        return bool(url) and url.startswith(prefix) and self.path_for(url[len(prefix):]) is not None
+
+    @staticmethod
+    def etag_for(filename):
+        return filename.split('.', 1)[0] + ('-thumb' if '.thumb.' in filename else '')
+
+    # ------- 清理 -------
+    def usage(self):
+        with self._lock:
+            return self._size
+
+    def _maybe_collect(self):
+        if self.usage() <= self.quota_bytes or self.referenced is None:
+            return
+        if time.time() - self._last_gc < IMAGE_GC_INTERVAL:
+            return
+        self.collect()
+
+    def collect(self):
+        """
+        超出配额时删除未被引用的图片（从最久未使用的开始），直到回到配额以内。
+
+        返回删除的文件数。
+        """
+        if not self._gc_lock.acquire(blocking=False):
+            return 0
+        try:
+            self._last_gc = time.time()
+            referenced = self.referenced() if self.referenced else set()
+            cutoff = time.time() - self.min_age
+            candidates = []
+            total = 0
+            for entry in os.scandir(self.root):
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                total += stat.st_size
+                m = _NAME_RE.match(entry.name)
+                if m and m.group(1) not in referenced and stat.st_mtime < cutoff:
+                    candidates.append((stat.st_mtime, entry.path, stat.st_size))
+
+            removed = 0
+            for _, path, size in sorted(candidates):
+                if total <= self.quota_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            with self._lock:
+                self._size = total
+            if removed:
+                logger.info("Image store GC removed %d files", removed)
+            return removed
+        finally:
+            self._gc_lock.release()
@@ -0,0 +1,188 @@
+"""
+后台任务队列
+
+头像与场景图片的生成从请求线程移到本地线程池中执行。
+任务按 key 去重：同一 key 的任务在排队、执行中或结果仍有效时直接复用，
+完成后通过 on_done 回调把结果写回会话存储。
+
+异步模式下（attach_loop）协程任务直接在事件循环上执行，不占用线程，
+并发数仍受 workers 限制。
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+import uuid
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, kind, key, fn, args, kwargs, on_done):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._on_done = on_done
+        self._enqueued = False
+        self._event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def wait(self, timeout=None):
+        """等待任务结束，返回是否已结束"""
+        return self._event.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    线程池 + 本地队列。
+
+    工作线程在第一次提交任务时才启动，避免 gunicorn --preload 时在 fork 前创建线程。
+    """
+
+    def __init__(self, workers=4, result_ttl=3600, name='jobs'):
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self.name = name
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self.loop = None
+        self._slots = None
+
+    def attach_loop(self, loop, concurrency=None):
+        """在该事件循环上执行协程任务（fn 为 async 函数时），同时执行的数量默认同 workers"""
+        self.loop = loop
+        self._slots = asyncio.Semaphore(concurrency or self.workers)
+
+    def _start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, kind, key, fn, *args, on_done=None, defer=False, **kwargs):
+        """
+        提交任务；同一 key 已有未过期任务（非失败）时直接返回该任务。
+
+        defer=True 时只登记任务不入队，由调用方稍后调用 start(job)，
+        用于等会话数据落库后再开始执行，保证写回时目标记录已存在。
+        """
+        with self._lock:
+            self._prune()
+            existing = self._jobs.get(self._by_key.get(key)) if key is not None else None
+            # 登记后从未入队的任务（会话写入被拒绝而未 start）不再复用
+            if existing is not None and existing.status != FAILED and existing._enqueued:
+                return existing
+            job = Job(kind, key, fn, args, kwargs, on_done)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._by_key[key] = job.id
+        if not defer:
+            self.start(job)
+        return job
+
+    def start(self, job):
+        """把登记过的任务放入队列（重复调用无副作用）"""
+        with self._lock:
+            if job._enqueued:
+                return
+            job._enqueued = True
+            if self.loop is not None and asyncio.iscoroutinefunction(job._fn):
+                asyncio.run_coroutine_threadsafe(self._run_async(job), self.loop)
+                return
+            self._start()
+        self._queue.put(job)
+
+    def get(self, job_id):
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        counts['depth'] = self._queue.qsize()
+        return counts
+
+    def _prune(self):
+        # 调用方需持有锁
+        cutoff = time.time() - self.result_ttl
+        expired = [
+            j for j in self._jobs.values()
+            if (j.finished and j.finished_at < cutoff) or (not j._enqueued and j.created_at < cutoff)
+        ]
+        for job in expired:
+            del self._jobs[job.id]
+            if self._by_key.get(job.key) == job.id:
+                del self._by_key[job.key]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.status = RUNNING
+            try:
+                self._finish(job, job._fn(*job._args, **job._kwargs))
+            except Exception as e:
+                self._finish(job, error=e)
+            self._queue.task_done()
+
+    async def _run_async(self, job):
+        async with self._slots:
+            job.status = RUNNING
+            try:
+                result = await job._fn(*job._args, **job._kwargs)
+            except Exception as e:
+                # 写回会访问 SQLite，放到线程中执行以免阻塞事件循环
+                await asyncio.to_thread(self._finish, job, error=e)
+            else:
+                await asyncio.to_thread(self._finish, job, result)
+
+    def _finish(self, job, result=None, error=None):
+        if error is not None:
+            logger.warning("Job %s %s failed: %s", job.kind, job.id, error)
+            job.error = str(error)
+            status = FAILED
+        else:
+            job.result = result
+            status = DONE
+        job.finished_at = time.time()
+        job.status = status
+        if job._on_done:
+            try:
+                job._on_done(job)
+            except Exception as e:
+                logger.exception("Job %s %s write-back failed: %s", job.kind, job.id, e)
+        job._event.set()
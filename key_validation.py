@@ -0,0 +1,133 @@
+"""
+API Key 验证缓存
+
+start_game 不再每次都调用 models.list() 下载完整模型列表：
+- 按 Key 指纹缓存验证结果，成功与失败（认证错误）分别有各自的 TTL；
+- 同一 Key 的并发验证只发起一次请求，其余调用等待结果；
+- 轻量模式只查询单个模型，off 模式完全跳过网络验证；
+- 传入 shared（coordination.SharedStore）时结果同时写入共享缓存，其他 worker 进程可以直接使用。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import openai
+
+from openai_clients import key_fingerprint
+
+# full: models.list()；light: models.retrieve(单个模型)；off: 不验证
+KEY_VALIDATION_MODE = os.environ.get('KEY_VALIDATION_MODE', 'light')
+KEY_VALIDATION_MODEL = os.environ.get('KEY_VALIDATION_MODEL', 'gpt-4o-mini')
+KEY_VALID_TTL = float(os.environ.get('KEY_VALID_TTL', 3600))
+KEY_INVALID_TTL = float(os.environ.get('KEY_INVALID_TTL', 300))
+
+
+class KeyValidator:
+    """client_factory(api_key) 返回 OpenAI 客户端"""
+
+    def __init__(self, client_factory, mode=KEY_VALIDATION_MODE, valid_ttl=KEY_VALID_TTL,
+                 invalid_ttl=KEY_INVALID_TTL, max_entries=4096, shared=None):
+        self.client_factory = client_factory
+        self.shared = shared
+        self.mode = mode
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'shared_hits': 0, 'network_checks': 0}
+
+    def validate(self, api_key):
+        """返回 (是否有效, 错误信息)"""
+        if self.mode == 'off':
+            return True, None
+
+        fp = key_fingerprint(api_key)
+        with self._lock:
+            cached = self._results.get(fp)
+            if cached is not None and cached[0] > time.time():
+                self._stats['hits'] += 1
+                self._results.move_to_end(fp)
+                return cached[1], cached[2]
+            self._stats['misses'] += 1
+            event = self._inflight.get(fp)
+            leader = event is None
+            if leader:
+                event = self._inflight[fp] = threading.Event()
+
+        if leader and self.shared is not None:
+            entry = self.shared.get('key_validation', fp)
+            if entry is not None:
+                # 其他进程已验证过；本地缓存到共享条目的过期时间为止
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+                    self._remember(fp, entry['expires_at'], entry['ok'], entry['error'])
+                    self._inflight.pop(fp, None)
+                event.set()
+                return entry['ok'], entry['error']
+
+        if not leader:
+            # 同一 Key 已有验证在进行，等待其结果
+            event.wait()
+            with self._lock:
+                cached = self._results.get(fp)
+            if cached is not None:
+                return cached[1], cached[2]
+            # 领头请求遇到临时错误未缓存，自行验证一次
+            return self._check(api_key)[:2]
+
+        try:
+            ok, error, cacheable = self._check(api_key)
+            if cacheable:
+                ttl = self.valid_ttl if ok else self.invalid_ttl
+                expires_at = time.time() + ttl
+                with self._lock:
+                    self._remember(fp, expires_at, ok, error)
+                if self.shared is not None:
+                    self.shared.put('key_validation', fp, {'ok': ok, 'error': error, 'expires_at': expires_at}, ttl=ttl)
+            return ok, error
+        finally:
+            with self._lock:
+                self._inflight.pop(fp, None)
+            event.set()
+
+    def _remember(self, fp, expires_at, ok, error):
+        # 调用方需持有锁
+        self._results[fp] = (expires_at, ok, error)
+        self._results.move_to_end(fp)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def _check(self, api_key):
+        """返回 (是否有效, 错误信息, 结果是否可缓存)"""
+        with self._lock:
+            self._stats['network_checks'] += 1
+        client = self.client_factory(api_key)
+        try:
+            if self.mode == 'full':
+                client.models.list()
+            else:
+                client.models.retrieve(KEY_VALIDATION_MODEL)
+            return True, None, True
+        except openai.NotFoundError:
+            # 认证已通过，只是该模型不可见
+            return True, None, True
+        except (openai.AuthenticationError, openai.PermissionDeniedError) as e:
+            return False, str(e), True
+        except Exception as e:
+            # 网络错误、限流等临时问题不缓存
+            return False, str(e), False
+
+    def invalidate(self, api_key):
+        with self._lock:
+            self._results.pop(key_fingerprint(api_key), None)
+        if self.shared is not None:
+            self.shared.delete('key_validation', key_fingerprint(api_key))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._results)
+        return stats
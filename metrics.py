@@ -0,0 +1,218 @@
+"""
+进程内指标与 Prometheus 文本格式导出
+
+不依赖 prometheus_client，只实现本项目用到的部分：
+- Counter / Histogram（可带标签），以及按需读取当前值的 Gauge 回调；
+- span(name)：记录代码段耗时与异常次数；
+- record_usage(call, usage)：累计 OpenAI 调用的输入 / 输出 token。
+
+多进程部署（gunicorn 多 worker）时每个进程各自计数，由 Prometheus 按实例汇总。
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = 'ai_adventure_'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = self.header()
+        lines.extend(f'{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}' for k, v in items)
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def collect(self):
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = self.header()
+        for key, (counts, count, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_count{labels} {count}')
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        return lines
+
+
+class GaugeCallback(_Metric):
+    """读取时调用 fn：返回数值，或 {标签值元组: 数值}"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def collect(self):
+        lines = self.header()
+        try:
+            values = self.fn()
+        except Exception as e:
+            lines.append(f'# {self.name} unavailable: {_escape(e)}')
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # 重复注册（如模块被重新导入）时沿用已有的指标
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+def gauge(name, help, fn, labelnames=()):
+    return REGISTRY.register(GaugeCallback(name, help, fn, labelnames))
+
+
+def render():
+    return REGISTRY.render()
+
+
+# ----------- 通用指标 -----------
+SPAN_SECONDS = histogram('span_seconds', 'Duration of instrumented code paths.', ['span'])
+SPAN_ERRORS = counter('span_errors_total', 'Instrumented code paths that raised.', ['span'])
+LLM_TOKENS = counter('llm_tokens_total', 'Tokens reported by OpenAI usage, by call type.', ['call', 'direction'])
+LLM_CALLS = counter('llm_calls_total', 'OpenAI calls by call type.', ['call'])
+
+
+@contextmanager
+def span(name):
+    """记录 with 块的耗时；异常照常抛出并计数"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        SPAN_ERRORS.inc(span=name)
+        raise
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - start, span=name)
+
+
+def usage_tokens(usage):
+    """返回 (输入, 输出) token 数；兼容 Responses（input/output）与 Chat Completions（prompt/completion）"""
+    if usage is None:
+        return 0, 0
+    input_tokens = getattr(usage, 'input_tokens', None)
+    if input_tokens is None:
+        input_tokens = getattr(usage, 'prompt_tokens', 0)
+    output_tokens = getattr(usage, 'output_tokens', None)
+    if output_tokens is None:
+        output_tokens = getattr(usage, 'completion_tokens', 0)
+    return input_tokens or 0, output_tokens or 0
+
+
+def record_usage(call, usage):
+    """累计一次调用的 token"""
+    LLM_CALLS.inc(call=call)
+    if usage is None:
+        return
+    input_tokens, output_tokens = usage_tokens(usage)
+    LLM_TOKENS.inc(input_tokens, call=call, direction='input')
+    LLM_TOKENS.inc(output_tokens, call=call, direction='output')
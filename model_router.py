@@ -0,0 +1,398 @@
+"""
+模型路由
+
+每类调用（剧情、图片 prompt 改写、图片、剧情摘要）按路由选择模型，剧情路由可按叙事阶段细分
+（story:intro / story:rising / story:climax / story:ending）。MODEL_ROUTES 为 JSON，未写的字段沿用默认值，
+细分路由继承同类路由：
+    MODEL_ROUTES='{"story": {"models": ["gpt-4o-mini", "gpt-4.1-nano"], "hedge_after": 10},
+                   "story:climax": {"models": ["gpt-4.1-mini", "gpt-4o-mini"]}}'
+
+- models 是按优先级排列的层级：超时、5xx、限流等错误时改用下一层，整个调用不超过 timeout 秒；
+  除最后一次尝试外每层最多用 timeout / 层数 秒，首选模型卡住时仍给下一层留出时间；
+  参数错误、鉴权失败等换模型也不会成功的错误直接抛出；
+- 重试由路由负责（调用方的客户端应关闭 SDK 自带的重试，否则一次尝试会超出分配的时间）：
+  所有层级都失败后，预算内再用最后一层重试 ROUTER_RETRIES 次；
+- hedge_after > 0 时，首选模型超过该时间仍未返回就并行请求下一层，先返回的结果生效；首选模型样本足够时
+  提前到其最近的 p95 延迟。流式请求无法对冲，只在输出第一个片段之前回退；
+- 每个模型最近的延迟与结果记入统计并导出到 /metrics；最近错误率过高的模型在冷却期内排到其他层之后。
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MODEL_ROUTES = os.environ.get('MODEL_ROUTES', '')
+# 每个模型保留的最近调用数，以及判定为不健康的最少样本数与错误率
+ROUTER_STATS_WINDOW = int(os.environ.get('ROUTER_STATS_WINDOW', 50))
+ROUTER_MIN_SAMPLES = int(os.environ.get('ROUTER_MIN_SAMPLES', 5))
+ROUTER_ERROR_THRESHOLD = float(os.environ.get('ROUTER_ERROR_THRESHOLD', 0.5))
+# 不健康的模型排到后面的时间（秒）
+ROUTER_COOLDOWN = float(os.environ.get('ROUTER_COOLDOWN', 60))
+# 所有层级都失败后用最后一层重试的次数（在 timeout 预算内）
+ROUTER_RETRIES = int(os.environ.get('ROUTER_RETRIES', 1))
+# 同步模式下对冲请求使用的线程数
+ROUTER_HEDGE_THREADS = int(os.environ.get('ROUTER_HEDGE_THREADS', 32))
+
+DEFAULT_ROUTES = {
+    'story': {'models': ['gpt-4o-mini', 'gpt-4.1-nano'], 'timeout': 60, 'hedge_after': 20},
+    'image_prompt': {'models': ['gpt-4o-mini', 'gpt-4.1-nano'], 'timeout': 30, 'hedge_after': 0},
+    'image': {'models': ['gpt-4.1-mini'], 'timeout': 120, 'hedge_after': 0},
+    'story_summary': {'models': [os.environ.get('STORY_SUMMARY_MODEL', 'gpt-4o-mini')], 'timeout': 60,
+                      'hedge_after': 0},
+}
+
+MODEL_CALL_SECONDS = metrics.histogram('model_call_seconds', 'Model calls made through the router.',
+                                       ['route', 'model', 'outcome'])
+MODEL_FALLBACKS = metrics.counter('model_fallbacks_total', 'Requests sent to a lower routing tier.',
+                                  ['route', 'reason'])
+
+
+def load_routes(text):
+    """解析 MODEL_ROUTES，格式错误时记录日志并使用默认路由"""
+    if not text:
+        return {}
+    try:
+        routes = json.loads(text)
+        if not isinstance(routes, dict) or not all(isinstance(v, dict) for v in routes.values()):
+            raise ValueError('expected {"route": {...}}')
+        return routes
+    except ValueError as e:
+        logger.error("Ignoring invalid MODEL_ROUTES: %s", e)
+        return {}
+
+
+def classify_error(error):
+    """timeout / rate_limited / error 会回退到下一层；client_error 直接抛出"""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, openai.APITimeoutError)):
+        return 'timeout'
+    status = getattr(error, 'status_code', None)
+    if status == 429:
+        return 'rate_limited'
+    if status is not None and status < 500:
+        return 'client_error'
+    return 'error'
+
+
+def attempt_timeout(deadline, share=None):
+    """一次尝试可用的秒数：剩余预算，share 不为 None 时不超过 share"""
+    remaining = max(deadline - time.monotonic(), 0.001)
+    return remaining if share is None else min(remaining, share)
+
+
+class Route:
+    __slots__ = ('name', 'models', 'timeout', 'hedge_after')
+
+    def __init__(self, name, models, timeout, hedge_after=0):
+        if not models:
+            raise ValueError(f"route {name} has no models")
+        self.name = name
+        self.models = list(models)
+        self.timeout = float(timeout)
+        self.hedge_after = float(hedge_after or 0)
+
+
+class Attempt:
+    """
+    流式请求的一次尝试（见 ModelRouter.attempts）。
+
+    开始输出后设置 started = True；之前失败且还有下一层时，退出 with 块时吞掉异常。
+    """
+
+    def __init__(self, router, route, model, deadline, last, share=None):
+        self.router = router
+        self.route = route
+        self.model = model
+        self.deadline = deadline
+        self.last = last
+        self.share = share
+        self.started = False
+
+    @property
+    def timeout(self):
+        return attempt_timeout(self.deadline, None if self.last else self.share)
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.monotonic() - self._start
+        if exc_type is None:
+            self.router.record(self.route.name, self.model, elapsed, 'ok')
+            return False
+        if not issubclass(exc_type, Exception):
+            # 客户端断开（GeneratorExit）或任务取消，不计入模型统计
+            return False
+        outcome = classify_error(exc)
+        self.router.record(self.route.name, self.model, elapsed, outcome)
+        if self.started or outcome == 'client_error' or self.last or time.monotonic() >= self.deadline:
+            return False
+        logger.warning("Model %s failed for %s (%s), falling back: %s", self.model, self.route.name, outcome, exc)
+        MODEL_FALLBACKS.inc(route=self.route.name, reason=outcome)
+        return True
+
+
+class ModelRouter:
+
+    def __init__(self, routes=None, window=ROUTER_STATS_WINDOW, min_samples=ROUTER_MIN_SAMPLES,
+                 error_threshold=ROUTER_ERROR_THRESHOLD, cooldown=ROUTER_COOLDOWN, retries=ROUTER_RETRIES,
+                 hedge_threads=ROUTER_HEDGE_THREADS):
+        config = {name: dict(route) for name, route in DEFAULT_ROUTES.items()}
+        overrides = load_routes(MODEL_ROUTES) if routes is None else routes
+        # 先合并同类路由，细分路由再继承合并后的结果
+        for name in sorted(overrides, key=lambda n: ':' in n):
+            base = config.get(name) or config.get(name.split(':', 1)[0]) or {}
+            config[name] = dict(base, **overrides[name])
+        self.routes = {name: Route(name, **route) for name, route in config.items()}
+        self.window = window
+        self.min_samples = min_samples
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.retries = retries
+        self.hedge_threads = hedge_threads
+        self._samples = {}  # model -> deque[(耗时, 是否成功)]
+        self._demoted = {}  # model -> 冷却结束时间
+        self._lock = threading.Lock()
+        self._executor = None
+
+    # ------- 选择模型 -------
+    def resolve(self, call_type, stage=None):
+        """路由名：配置了 call_type:stage 时使用细分路由"""
+        name = f"{call_type}:{stage}"
+        return name if stage and name in self.routes else call_type
+
+    def plan(self, name):
+        """路由的模型层级，冷却中的模型排到最后（仍作为最后的退路）"""
+        models = self.routes[name].models
+        now = time.monotonic()
+        with self._lock:
+            demoted = {m for m in models if self._demoted.get(m, 0) > now}
+        return [m for m in models if m not in demoted] + [m for m in models if m in demoted]
+
+    def primary(self, name):
+        return self.plan(name)[0]
+
+    def sequence(self, name):
+        """实际的尝试顺序：各层级之后是最后一层的重试"""
+        models = self.plan(name)
+        return models + models[-1:] * self.retries
+
+    @staticmethod
+    def share(route, models):
+        """非最后一次尝试可用的秒数"""
+        return route.timeout / len(set(models))
+
+    def hedge_delay(self, route, model):
+        if not route.hedge_after:
+            return None
+        p95 = self.latency_quantile(model, 0.95)
+        return min(route.hedge_after, p95) if p95 else route.hedge_after
+
+    # ------- 统计 -------
+    def record(self, route, model, seconds, outcome):
+        MODEL_CALL_SECONDS.observe(seconds, route=route, model=model, outcome=outcome)
+        if outcome in ('client_error', 'rate_limited'):
+            # 与具体 API Key 有关，不代表模型本身的状态
+            return
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append((seconds, outcome == 'ok'))
+            errors = sum(1 for _, ok in samples if not ok)
+            if len(samples) >= self.min_samples and errors / len(samples) >= self.error_threshold:
+                logger.warning("Model %s demoted for %.0fs: %d/%d recent calls failed",
+                               model, self.cooldown, errors, len(samples))
+                self._demoted[model] = time.monotonic() + self.cooldown
+                samples.clear()
+
+    def latency_quantile(self, model, q):
+        """最近成功调用的延迟分位数，样本不足时返回 None"""
+        with self._lock:
+            latencies = sorted(s for s, ok in self._samples.get(model, ()) if ok)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            models = {m: list(s) for m, s in self._samples.items()}
+            demoted = {m for m, until in self._demoted.items() if until > now}
+        result = {}
+        for model in set(models) | demoted:
+            samples = models.get(model, [])
+            result[model] = {
+                'samples': len(samples),
+                'error_rate': sum(1 for _, ok in samples if not ok) / len(samples) if samples else 0.0,
+                'p50': self.latency_quantile(model, 0.5),
+                'p95': self.latency_quantile(model, 0.95),
+                'demoted': model in demoted,
+            }
+        return result
+
+    # ------- 调用 -------
+    def call(self, name, fn):
+        """
+        按路由调用 fn(model, timeout)（同步）并返回其结果。
+
+        全部层级失败时抛出最后一个错误，超出预算时抛出 TimeoutError。
+        """
+        route = self.routes[name]
+        models = self.sequence(name)
+        deadline = time.monotonic() + route.timeout
+        if len(set(models)) > 1 and self.hedge_delay(route, models[0]) is not None:
+            return self._call_hedged(route, models, deadline, fn)
+
+        error = None
+        share = self.share(route, models)
+        for i, model in enumerate(models):
+            if time.monotonic() >= deadline:
+                break
+            if error is not None:
+                MODEL_FALLBACKS.inc(route=name, reason=classify_error(error))
+            try:
+                return self._attempt(route, model, fn, deadline, None if i == len(models) - 1 else share)
+            except Exception as e:
+                if classify_error(e) == 'client_error':
+                    raise
+                error = e
+        raise error or TimeoutError(f"{name}: no model answered within {route.timeout:g}s")
+
+    def _attempt(self, route, model, fn, deadline, share=None):
+        start = time.monotonic()
+        try:
+            result = fn(model, attempt_timeout(deadline, share))
+        except Exception as e:
+            self.record(route.name, model, time.monotonic() - start, classify_error(e))
+            raise
+        self.record(route.name, model, time.monotonic() - start, 'ok')
+        return result
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_threads, thread_name_prefix='model-hedge')
+            return self._executor
+
+    def _call_hedged(self, route, models, deadline, fn):
+        # 未被采用的请求无法中断，在线程中跑完后丢弃结果（其耗时仍计入统计）
+        queue = list(models)
+        pending = set()
+        error = None
+        hedged = False
+
+        def launch():
+            pending.add(self._pool().submit(self._attempt, route, queue.pop(0), fn, deadline))
+
+        launch()
+        hedge_at = time.monotonic() + self.hedge_delay(route, models[0])
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            can_hedge = queue and not hedged
+            until = min(deadline, hedge_at) if can_hedge else deadline
+            done, _ = wait(pending, timeout=max(until - now, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    if classify_error(e) == 'client_error':
+                        raise
+                    error = e
+            if not done and can_hedge and time.monotonic() >= hedge_at:
+                hedged = True
+                MODEL_FALLBACKS.inc(route=route.name, reason='hedge')
+                launch()
+            elif done and not pending and queue:
+                MODEL_FALLBACKS.inc(route=route.name, reason=classify_error(error))
+                launch()
+        raise error or TimeoutError(f"{route.name}: no model answered within {route.timeout:g}s")
+
+    async def acall(self, name, fn):
+        """call 的协程版本，fn(model, timeout) 返回 awaitable；未被采用的请求会被取消"""
+        route = self.routes[name]
+        models = self.sequence(name)
+        deadline = time.monotonic() + route.timeout
+        delay = self.hedge_delay(route, models[0]) if len(set(models)) > 1 else None
+        queue = list(models)
+        pending = set()
+        error = None
+        hedged = delay is None
+        # 对冲时下一层并行启动，各层不必让出时间
+        share = self.share(route, models) if hedged else None
+
+        def launch():
+            model = queue.pop(0)
+            pending.add(asyncio.ensure_future(self._aattempt(route, model, fn, deadline, share if queue else None)))
+
+        launch()
+        hedge_at = time.monotonic() + (delay or 0)
+        try:
+            while pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                can_hedge = queue and not hedged
+                until = min(deadline, hedge_at) if can_hedge else deadline
+                done, _ = await asyncio.wait(pending, timeout=max(until - now, 0), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.discard(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        if classify_error(e) == 'client_error':
+                            raise
+                        error = e
+                if not done and can_hedge and time.monotonic() >= hedge_at:
+                    hedged = True
+                    MODEL_FALLBACKS.inc(route=name, reason='hedge')
+                    launch()
+                elif done and not pending and queue:
+                    MODEL_FALLBACKS.inc(route=name, reason=classify_error(error))
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error or TimeoutError(f"{name}: no model answered within {route.timeout:g}s")
+
+    async def _aattempt(self, route, model, fn, deadline, share=None):
+        start = time.monotonic()
+        try:
+            result = await fn(model, attempt_timeout(deadline, share))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.record(route.name, model, time.monotonic() - start, classify_error(e))
+            raise
+        self.record(route.name, model, time.monotonic() - start, 'ok')
+        return result
+
+    def attempts(self, name):
+        """
+        流式请求的逐层尝试：
+
+            for attempt in router.attempts(name):
+                with attempt:
+                    ...  # 以 attempt.model / attempt.timeout 发起请求，输出第一个片段时设置 attempt.started
+                    break
+        """
+        route = self.routes[name]
+        models = self.sequence(name)
+        deadline = time.monotonic() + route.timeout
+        share = self.share(route, models)
+        # 超出预算时 Attempt 不再吞掉异常，循环不会在没有结果时静默结束
+        for i, model in enumerate(models):
+            yield Attempt(self, route, model, deadline, last=i == len(models) - 1, share=share)
@@ -0,0 +1,216 @@
+"""
+OpenAI 客户端注册表
+
+同一个 API Key 在进程内共用一个 OpenAI 客户端（及其 keep-alive 连接池），
+避免每次调用都新建连接、重新握手。客户端按 LRU + 空闲 TTL 淘汰，
+超时与重试次数可配置，并统计命中率与连接复用情况。
+
+AsyncClientRegistry 是异步服务模式（asgi.py）使用的 AsyncOpenAI 版本。
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', 60))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 10))
+# openai SDK 自带指数退避重试；经 model_router 的调用由路由重试，其客户端以 max_retries=0 创建
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 2))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', 20))
+OPENAI_CLIENT_TTL = float(os.environ.get('OPENAI_CLIENT_TTL', 1800))
+OPENAI_MAX_CLIENTS = int(os.environ.get('OPENAI_MAX_CLIENTS', 256))
+
+OPENAI_REQUESTS = metrics.counter('openai_requests_total', 'HTTP requests sent to OpenAI, including retries.')
+OPENAI_RETRIES = metrics.counter('openai_retries_total', 'OpenAI HTTP requests that were SDK retries.')
+OPENAI_CONNECTIONS = metrics.counter('openai_connections_opened_total', 'New TCP connections opened to OpenAI.')
+
+
+_ssl_context = None
+
+
+def shared_ssl_context():
+    """所有客户端共用一个 SSL 上下文；每次新建要重新加载 CA 证书，约几十毫秒"""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
+
+
+def key_fingerprint(api_key):
+    """API Key 的不可逆指纹，用作缓存键和日志标识"""
+    return hashlib.sha256((api_key or '').encode()).hexdigest()[:32]
+
+
+class _Entry:
+    __slots__ = ('client', 'last_used')
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.time()
+
+
+class ClientRegistry:
+
+    def __init__(self, max_clients=OPENAI_MAX_CLIENTS, ttl=OPENAI_CLIENT_TTL, timeout=OPENAI_TIMEOUT,
+                 connect_timeout=OPENAI_CONNECT_TIMEOUT, max_retries=OPENAI_MAX_RETRIES,
+                 max_connections=OPENAI_MAX_CONNECTIONS):
+        self.max_clients = max_clients
+        self.ttl = ttl
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'requests': 0,
+            'connections_opened': 0,
+        }
+
+    def get(self, api_key):
+        """返回该 Key 对应的共享客户端，不存在则创建"""
+        fp = key_fingerprint(api_key)
+        expired = []
+        with self._lock:
+            entry = self._clients.get(fp)
+            if entry is not None and time.time() - entry.last_used > self.ttl:
+                expired.append(self._clients.pop(fp).client)
+                self._stats['evictions'] += 1
+                entry = None
+            if entry is not None:
+                self._stats['hits'] += 1
+                self._clients.move_to_end(fp)
+            else:
+                self._stats['misses'] += 1
+                entry = _Entry(self._create(api_key))
+                self._clients[fp] = entry
+                expired.extend(self._evict())
+            entry.last_used = time.time()
+            client = entry.client
+        for old in expired:
+            self._close(old)
+        return client
+
+    def _create(self, api_key):
+        http_client = httpx.Client(
+            verify=shared_ssl_context(),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_connections),
+            event_hooks={'request': [self._on_request]},
+        )
+        return OpenAI(api_key=api_key, http_client=http_client, max_retries=self.max_retries,
+                      timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout))
+
+    def _evict(self):
+        # 调用方需持有锁；返回需要关闭的客户端
+        now = time.time()
+        evicted = [fp for fp, e in self._clients.items() if now - e.last_used > self.ttl]
+        overflow = len(self._clients) - len(evicted) - self.max_clients
+        if overflow > 0:
+            evicted.extend([fp for fp in self._clients if fp not in evicted][:overflow])
+        closing = []
+        for fp in evicted:
+            entry = self._clients.pop(fp)
+            self._stats['evictions'] += 1
+            # 仍可能有请求在用的客户端交给 GC 回收，空闲足够久的直接关闭连接
+            if now - entry.last_used > self.timeout:
+                closing.append(entry.client)
+        return closing
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except Exception as e:
+            logger.warning("Failed to close OpenAI client: %s", e)
+
+    def _on_request(self, request):
+        # 通过 httpcore trace 统计新建连接数，请求数减去新建连接即为复用次数
+        with self._lock:
+            self._stats['requests'] += 1
+        OPENAI_REQUESTS.inc()
+        # SDK 在每次重试的请求头中带上已重试次数
+        if request.headers.get('x-stainless-retry-count', '0') != '0':
+            OPENAI_RETRIES.inc()
+        request.extensions['trace'] = self._trace
+
+    def _trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self._stats['connections_opened'] += 1
+            OPENAI_CONNECTIONS.inc()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['clients'] = len(self._clients)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['connections_reused'] = max(stats['requests'] - stats['connections_opened'], 0)
+        return stats
+
+    def clear(self):
+        with self._lock:
+            clients = [e.client for e in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            self._close(client)
+
+
+class AsyncClientRegistry(ClientRegistry):
+    """
+    AsyncOpenAI 客户端注册表。
+
+    客户端绑定创建时所在的事件循环，只能在同一个循环中使用；get() 本身不做网络操作，
+    可以在循环中直接调用。
+    """
+
+    def _create(self, api_key):
+        http_client = httpx.AsyncClient(
+            verify=shared_ssl_context(),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_connections),
+            event_hooks={'request': [self._on_async_request]},
+        )
+        return AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=self.max_retries,
+                           timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout))
+
+    @staticmethod
+    def _close(client):
+        try:
+            asyncio.get_running_loop().create_task(client.close())
+        except RuntimeError:
+            # 不在事件循环中（如关闭阶段），交给 GC 回收
+            pass
+
+    async def _on_async_request(self, request):
+        self._on_request(request)
+        request.extensions['trace'] = self._async_trace
+
+    async def _async_trace(self, event_name, info):
+        self._trace(event_name, info)
+
+    async def aclose(self):
+        with self._lock:
+            clients = [e.client for e in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning("Failed to close AsyncOpenAI client: %s", e)
@@ -0,0 +1,182 @@
+"""
+开场剧情池
+
+第一回合只取决于游戏设定与语言（历史为空），选择相同设定的玩家发出的是同一个请求。
+开场剧情池按请求内容的哈希保存每种设定的若干个预先生成的版本：
+- /game 直接取出一个版本作为第一回合，池中没有时才实时生成；
+- 每次取用（命中或未命中）后在后台补充，保持每个键 OPENING_POOL_VARIANTS 个版本；
+- 热门设定组合可以用 `flask --app app fill-openings` 批量预先生成；
+- 版本取出后即删除，不会发给两个玩家；超过 OPENING_POOL_TTL 的版本不再使用。
+
+池中的版本会发给其他玩家，因此只用运营方的 Key 生成：后台补充只在配置了 OPENING_POOL_API_KEY 时进行，
+未配置时池中只有用 fill-openings 命令生成的版本，玩家的 Key 只用于自己的开场剧情。
+传入 shared（coordination.SharedStore）时同一个键同时只有一个进程在补充，多个 worker 不会超量生成。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 每种设定保留的版本数，0 表示关闭
+OPENING_POOL_VARIANTS = int(os.environ.get('OPENING_POOL_VARIANTS', 3))
+# 版本的有效期（秒）
+OPENING_POOL_TTL = float(os.environ.get('OPENING_POOL_TTL', 7 * 24 * 3600))
+# 后台补充使用的 Key（未配置时不在后台补充）与线程数
+OPENING_POOL_API_KEY = os.environ.get('OPENING_POOL_API_KEY', '')
+OPENING_POOL_WORKERS = int(os.environ.get('OPENING_POOL_WORKERS', 2))
+# 跨进程补充租约的时长（秒），应长于一轮补充
+OPENING_POOL_LEASE = float(os.environ.get('OPENING_POOL_LEASE', 300))
+
+
+class OpeningPool:
+    """
+    generate(api_key, request) 同步生成开场剧情，返回可 JSON 序列化的字典；
+    request 由调用方组装，池只保存与返回 generate 的结果。
+    """
+
+    def __init__(self, path, generate, variants=OPENING_POOL_VARIANTS, ttl=OPENING_POOL_TTL,
+                 api_key=OPENING_POOL_API_KEY, workers=OPENING_POOL_WORKERS, shared=None):
+        self.path = path
+        self.shared = shared
+        self.generate = generate
+        self.variants = variants
+        self.ttl = ttl
+        self.api_key = api_key
+        self.workers = workers
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._filling = {}  # key -> 进行中的补充个数
+        self._leases = {}  # key -> 跨进程租约令牌
+        self._stats = {'hits': 0, 'misses': 0, 'generated': 0, 'failed': 0}
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS opening_pool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS opening_pool_key ON opening_pool (key, created_at)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @property
+    def enabled(self):
+        return self.variants > 0
+
+    # ------- 取用 -------
+    def count(self, key):
+        row = self._conn().execute(
+            'SELECT COUNT(*) FROM opening_pool WHERE key = ? AND created_at > ?', (key, time.time() - self.ttl)
+        ).fetchone()
+        return row[0]
+
+    def has(self, key):
+        return self.enabled and self.count(key) > 0
+
+    def take(self, key):
+        """取出并删除该键最早的一个版本，没有时返回 None"""
+        if not self.enabled:
+            return None
+        conn = self._conn()
+        with conn:
+            # 取出与删除在同一个写事务中，多个进程同时取用也不会拿到同一个版本
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT id, data FROM opening_pool WHERE key = ? AND created_at > ? ORDER BY created_at LIMIT 1',
+                (key, time.time() - self.ttl)
+            ).fetchone()
+            if row is not None:
+                conn.execute('DELETE FROM opening_pool WHERE id = ?', (row[0],))
+        with self._lock:
+            self._stats['hits' if row else 'misses'] += 1
+        return json.loads(row[1]) if row else None
+
+    def put(self, key, data):
+        with self._conn() as conn:
+            conn.execute('INSERT INTO opening_pool (key, data, created_at) VALUES (?, ?, ?)',
+                         (key, json.dumps(data, ensure_ascii=False), time.time()))
+            conn.execute('DELETE FROM opening_pool WHERE created_at <= ?', (time.time() - self.ttl,))
+
+    # ------- 补充 -------
+    def refill(self, key, build_request):
+        """
+        用 api_key 在后台把该键补充到 variants 个版本，返回发起的生成个数；未配置 api_key 时不补充。
+
+        build_request() 在调用线程中组装请求。
+        """
+        if not self.enabled or not self.api_key:
+            return 0
+        with self._lock:
+            filling = self._filling.get(key, 0)
+        missing = self.variants - filling - self.count(key)
+        if missing <= 0:
+            return 0
+        if self.shared is not None and not filling:
+            token = self.shared.acquire(f"opening:{key}", OPENING_POOL_LEASE)
+            if token is None:
+                # 其他进程正在补充这个键
+                return 0
+            with self._lock:
+                self._leases[key] = token
+        request = build_request()
+        with self._lock:
+            self._filling[key] = self._filling.get(key, 0) + missing
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='opening-pool')
+            executor = self._executor
+        for _ in range(missing):
+            executor.submit(self._generate_one, key, self.api_key, request)
+        return missing
+
+    def _generate_one(self, key, api_key, request):
+        try:
+            self.put(key, self.generate(api_key, request))
+            outcome = 'generated'
+        except Exception as e:
+            logger.warning("Opening pool generation failed: %s", e)
+            outcome = 'failed'
+        with self._lock:
+            self._stats[outcome] += 1
+            self._filling[key] -= 1
+            token = None
+            if not self._filling[key]:
+                del self._filling[key]
+                token = self._leases.pop(key, None)
+        if token is not None:
+            self.shared.release(f"opening:{key}", token)
+
+    def fill(self, key, api_key, request, count=None):
+        """同步补充到 count（默认 variants）个版本，返回新生成的个数（供批量命令使用）"""
+        missing = (self.variants if count is None else count) - self.count(key)
+        generated = 0
+        for _ in range(max(missing, 0)):
+            self.put(key, self.generate(api_key, request))
+            generated += 1
+        return generated
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['filling'] = sum(self._filling.values())
+        stats['entries'] = self._conn().execute(
+            'SELECT COUNT(*) FROM opening_pool WHERE created_at > ?', (time.time() - self.ttl,)
+        ).fetchone()[0]
+        return stats
@@ -0,0 +1,131 @@
+"""
+图片生成的结果缓存
+
+图片流程的两个阶段分别缓存在本地 SQLite 中：
+- rewrite：场景描述 / 角色描述 + 画风 -> 改写后的图片 prompt
+- image：图片 prompt + 画风 -> 图片 URL
+键由规范化后的文本计算，按最近使用时间（LRU）与总大小淘汰，并统计各阶段命中率。
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', 20000))
+PROMPT_CACHE_MAX_MB = float(os.environ.get('PROMPT_CACHE_MAX_MB', 64))
+
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_prompt(text):
+    """统一全半角、大小写与空白，使仅有格式差异的描述命中同一条缓存"""
+    text = unicodedata.normalize('NFKC', text or '')
+    text = _SPACE_RE.sub(' ', text).strip().lower()
+    return text.strip(' .。!！?？,，')
+
+
+def cache_key(*parts):
+    joined = '\x1f'.join(normalize_prompt(p) for p in parts)
+    return hashlib.sha256(joined.encode()).hexdigest()
+
+
+class PromptCache:
+
+    def __init__(self, path, max_entries=PROMPT_CACHE_MAX_ENTRIES, max_bytes=PROMPT_CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._puts = 0
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS prompt_cache (
+                    stage TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (stage, key)
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS prompt_cache_last_used ON prompt_cache (last_used)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, stage, hit):
+        with self._lock:
+            stats = self._stats.setdefault(stage, {'hits': 0, 'misses': 0})
+            stats['hits' if hit else 'misses'] += 1
+
+    def get(self, stage, key):
+        with self._conn() as conn:
+            row = conn.execute(
+                'SELECT value FROM prompt_cache WHERE stage = ? AND key = ?', (stage, key)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE prompt_cache SET last_used = ? WHERE stage = ? AND key = ?',
+                    (time.time(), stage, key)
+                )
+        self._count(stage, row is not None)
+        return row[0] if row else None
+
+    def put(self, stage, key, value):
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO prompt_cache (stage, key, value, size, last_used) VALUES (?, ?, ?, ?, ?)',
+                (stage, key, value, len(value.encode()), time.time())
+            )
+        with self._lock:
+            self._puts += 1
+            check = self._puts % 50 == 0
+        if check:
+            self.evict()
+
+    def discard(self, stage, key):
+        """缓存的值已失效（如图片文件被清理）时删除"""
+        with self._conn() as conn:
+            conn.execute('DELETE FROM prompt_cache WHERE stage = ? AND key = ?', (stage, key))
+
+    def evict(self):
+        """按最近使用时间淘汰，直到条目数与总大小都在限制以内"""
+        with self._conn() as conn:
+            count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM prompt_cache').fetchone()
+            if count <= self.max_entries and total <= self.max_bytes:
+                return 0
+            removed = 0
+            for stage, key, size in conn.execute(
+                    'SELECT stage, key, size FROM prompt_cache ORDER BY last_used').fetchall():
+                if count <= self.max_entries and total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM prompt_cache WHERE stage = ? AND key = ?', (stage, key))
+                count -= 1
+                total -= size
+                removed += 1
+            return removed
+
+    def stats(self):
+        with self._lock:
+            stages = {stage: dict(s) for stage, s in self._stats.items()}
+        for s in stages.values():
+            lookups = s['hits'] + s['misses']
+            s['hit_rate'] = s['hits'] / lookups if lookups else 0.0
+        count, total = self._conn().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM prompt_cache'
+        ).fetchone()
+        return {'stages': stages, 'entries': count, 'bytes': total}
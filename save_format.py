@@ -0,0 +1,295 @@
+"""
+存档格式（v2）
+
+/save 返回、/load 接收的存档结构，浏览器原样保存在 localStorage 中：
+- 回合按元组 [哈希, 文本, 选项, 玩家行动, 图片] 保存，不含可重建的完整文本与图片任务等内部字段；
+  图片仍在生成中的回合在末尾附带图片描述，读档后重新生成；
+- 图片只保存存储中的文件名（引用）；旧版存档中内联的 data: 图片在读档时转存，改为引用；
+- 每个回合带链式哈希（由上一回合的哈希与本回合内容计算）。客户端以 (回合数, 哈希) 作为检查点，
+  存档时只下载、读档时只上传检查点之后的回合；
+- 结构由 pydantic 校验，哈希链在服务端重新计算，对不上的存档被拒绝。
+
+旧版（v1）存档是 {"data": {"history": [...], "story": ..., ...}}，读档时自动转换。
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+from typing import List, Literal, Optional, Tuple, Union
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, model_validator
+
+from character_registry import character_list
+from image_store import is_image_name
+
+SAVE_FORMAT_VERSION = 2
+# 读档请求体（解压后）的上限
+MAX_SAVE_BYTES = int(os.environ.get('MAX_SAVE_BYTES', 8 * 1024 * 1024))
+
+_HASH_LEN = 16
+_DATA_URI_RE = re.compile(r'^data:image/[\w.+-]+;base64,(.*)$', re.S)
+
+
+class SaveError(ValueError):
+    """存档无法解析或与当前进度不匹配"""
+
+
+# ----------- 校验模型 -----------
+# [哈希, 文本, 选项, 玩家行动, 图片引用]；图片仍在生成中时末尾附带图片描述
+TurnTuple = Union[
+    Tuple[str, str, List[str], Optional[str], Optional[str]],
+    Tuple[str, str, List[str], Optional[str], Optional[str], str],
+]
+
+
+class SaveCharacter(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
+    id: str
+    name: str
+    avatar: Optional[str] = None
+    desc: str = ''
+    detail: str = ''
+    events: List[str] = Field(default_factory=list)
+    event_summary: str = ''
+    aliases: List[str] = Field(default_factory=list)
+
+
+class SaveMeta(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
+    settings: dict = Field(default_factory=dict)
+    language: str = 'zh'
+    enable_images: bool = True
+    player_stats: dict = Field(default_factory=dict)
+    characters: List[SaveCharacter] = Field(default_factory=list)
+
+
+class SaveDocument(BaseModel):
+    """
+    base / base_hash：turns 之前已有的回合数及最后一个回合的哈希（完整存档为 0 / None）；
+    count / head：存档的总回合数及最后一个回合的哈希。
+    """
+    v: Literal[2]
+    meta: SaveMeta
+    base: int = Field(0, ge=0)
+    base_hash: Optional[str] = None
+    count: int = Field(ge=0)
+    head: Optional[str] = None
+    turns: List[TurnTuple] = Field(default_factory=list)
+
+    @model_validator(mode='after')
+    def _check_chain(self):
+        if self.base + len(self.turns) != self.count:
+            raise ValueError('count does not match base + len(turns)')
+        if (self.base > 0) != (self.base_hash is not None):
+            raise ValueError('base_hash is required exactly when base > 0')
+        prev = self.base_hash
+        for turn in self.turns:
+            expected = turn_hash(prev, {'new_text': turn[1], 'options': turn[2], 'player_action': turn[3]})
+            if turn[0] != expected:
+                raise ValueError('turn hash chain is broken')
+            prev = expected
+        if prev != self.head:
+            raise ValueError('head does not match the last turn')
+        return self
+
+
+# ----------- 哈希链 -----------
+def turn_hash(prev, record):
+    """回合的链式哈希，只覆盖生成后不再变化的字段（图片会在之后写回）"""
+    content = json.dumps([prev, record.get('new_text', ''), record.get('options', []), record.get('player_action')],
+                         ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:_HASH_LEN]
+
+
+def ensure_chain(history):
+    """
+    为缺少哈希的回合（本格式之前创建的会话）补算并写回，返回最后一个回合的哈希。
+
+    新回合在记录时已带哈希，只有旧会话第一次存档时需要读取全部回合。
+    """
+    if not len(history):
+        return None
+    if history[-1].get('h'):
+        return history[-1]['h']
+    prev = None
+    for i, record in enumerate(history):
+        if record.get('h'):
+            prev = record['h']
+            continue
+        prev = turn_hash(prev, record)
+        history.update(i, h=prev)
+    return prev
+
+
+def chain_hash_at(history, count):
+    """前 count 个回合的哈希（即第 count - 1 个回合的哈希），count 为 0 时返回 None"""
+    if count == 0:
+        return None
+    record = history[count - 1]
+    return record.get('h') or (ensure_chain(history) and history[count - 1]['h'])
+
+
+# ----------- 图片引用 -----------
+def image_ref(url, url_prefix):
+    """存储中的图片只保存文件名，其他地址（占位图等）原样保留"""
+    prefix = url_prefix + '/'
+    if url and url.startswith(prefix):
+        return url[len(prefix):]
+    return url
+
+
+def image_hashes(document):
+    """存档（encode_save 的结果）引用的存储中图片的哈希"""
+    refs = [turn[4] for turn in document['turns']] + [c.get('avatar') for c in document['meta']['characters']]
+    return {ref.split('.', 1)[0] for ref in refs if ref and '/' not in ref and ':' not in ref}
+
+
+def image_url(ref, url_prefix, import_image=None, kind='scene'):
+    """
+    image_ref 的逆操作；旧存档中的 data: 图片交给 import_image(bytes, kind) 转存。
+
+    存档来自客户端，只接受图片存储中的文件名（或带 url_prefix 的完整地址），其他地址返回 None。
+    """
+    if not ref:
+        return None
+    match = _DATA_URI_RE.match(ref)
+    if match:
+        if import_image is None:
+            return None
+        try:
+            return import_image(base64.b64decode(match.group(1)), kind)
+        except Exception:
+            return None
+    prefix = url_prefix + '/'
+    name = ref[len(prefix):] if ref.startswith(prefix) else ref
+    return f"{prefix}{name}" if is_image_name(name) else None
+
+
+# ----------- 编码 -----------
+def settled_count(history, base):
+    """从 base 起第一个仍在等待图片的回合之前的回合数，作为客户端的下一个检查点"""
+    for i in range(base, len(history)):
+        if history[i].get('image_pending'):
+            return i
+    return len(history)
+
+
+def encode_save(session, url_prefix, since=0, since_hash=None):
+    """
+    把会话编码为存档。
+
+    since / since_hash 为客户端的检查点，与当前进度一致时只包含之后的回合，否则返回完整存档。
+    返回 (存档, 检查点)。
+    """
+    history = session.get('history', [])
+    head = ensure_chain(history)
+    base = 0
+    if 0 < since <= len(history) and since_hash and chain_hash_at(history, since) == since_hash:
+        base = since
+
+    turns = []
+    for record in history[base:]:
+        turn = [record['h'], record.get('new_text', ''), record.get('options', []), record.get('player_action'),
+                image_ref(record.get('image'), url_prefix)]
+        if record.get('image_pending') and record.get('image_prompt'):
+            turn[4] = None
+            turn.append(record['image_prompt'])
+        turns.append(turn)
+
+    characters = []
+    for c in character_list(session.get('characters')):
+        character = dict({k: c.get(k) for k in ('id', 'name', 'desc', 'detail')},
+                         avatar=image_ref(c.get('avatar'), url_prefix), events=c.get('events', []))
+        # 只在有内容时写入，旧版客户端与存档不受影响
+        for key in ('event_summary', 'aliases'):
+            if c.get(key):
+                character[key] = c[key]
+        characters.append(character)
+    document = {
+        'v': SAVE_FORMAT_VERSION,
+        'meta': {
+            'settings': session.get('settings') or {},
+            'language': session.get('language', 'zh'),
+            'enable_images': session.get('enable_images', True),
+            'player_stats': session.get('player_stats', {}),
+            'characters': characters,
+        },
+        'base': base,
+        'base_hash': chain_hash_at(history, base),
+        'count': len(history),
+        'head': head,
+        'turns': turns,
+    }
+    checkpoint_count = settled_count(history, base)
+    checkpoint = {'count': checkpoint_count, 'hash': chain_hash_at(history, checkpoint_count)}
+    return document, checkpoint
+
+
+# ----------- 解码 -----------
+def parse_save(payload):
+    """校验存档（v2 或旧版 v1）并返回 SaveDocument，失败时抛出 SaveError"""
+    if not isinstance(payload, dict):
+        raise SaveError('save data must be an object')
+    if 'v' not in payload:
+        payload = upgrade_v1(payload.get('data', payload))
+    try:
+        return SaveDocument.model_validate(payload)
+    except ValidationError as e:
+        raise SaveError(f"invalid save data: {e.error_count()} error(s), first: {e.errors()[0]['msg']}") from None
+
+
+def upgrade_v1(data):
+    """旧版存档（完整 history 记录 + 冗余全文）转换为 v2 结构；图片地址原样保留，读档时再转存"""
+    if not isinstance(data, dict):
+        raise SaveError('save data must be an object')
+    turns = []
+    prev = None
+    for record in data.get('history') or []:
+        if not isinstance(record, dict):
+            raise SaveError('history records must be objects')
+        prev = turn_hash(prev, record)
+        turn = [prev, record.get('new_text', ''), record.get('options', []), record.get('player_action'),
+                None if record.get('image_pending') else record.get('image')]
+        if record.get('image_pending') and record.get('image_prompt'):
+            turn.append(record['image_prompt'])
+        turns.append(turn)
+    return {
+        'v': SAVE_FORMAT_VERSION,
+        'meta': {k: data[k] for k in ('settings', 'language', 'enable_images', 'player_stats', 'characters')
+                 if data.get(k) is not None},
+        'count': len(turns),
+        'head': prev,
+        'turns': turns,
+    }
+
+
+def decode_turns(document, url_prefix, image_placeholder, import_image=None):
+    """把存档中的回合还原为会话的回合记录；无法使用的图片地址换成 image_placeholder"""
+    records = []
+    for turn in document.turns:
+        h, text, options, action, image = turn[:5]
+        prompt = turn[5] if len(turn) > 5 else None
+        record = {
+            'new_text': text,
+            'image': (image_url(image, url_prefix, import_image) or image_placeholder) if image else None,
+            'image_pending': bool(prompt),
+            'options': list(options),
+            'player_action': action,
+            'h': h,
+        }
+        if prompt:
+            record['image_prompt'] = prompt
+        records.append(record)
+    return records
+
+
+def decode_characters(document, url_prefix, avatar_placeholder, import_image=None):
+    characters = []
+    for c in document.meta.characters:
+        character = c.model_dump()
+        character['avatar'] = image_url(c.avatar, url_prefix, import_image, kind='avatar') or avatar_placeholder
+        characters.append(character)
+    return characters
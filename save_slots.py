@@ -0,0 +1,166 @@
+"""
+服务端存档槽
+
+存档按用户（API Key 指纹）保存在本地 SQLite 中，浏览器 localStorage 存档仍然可用：
+- save_slots 表只存元数据（名称、回合数、时间、主题、语言、大小、引用的图片），
+  列出存档只查这张表，不读取存档内容；
+- 存档内容（v2 存档，见 save_format）压缩后单独存放，读档时只读取一个槽；
+- 每个用户的槽数与总字节数有上限，写入在同一事务中检查；
+- export 逐个读取全部槽，内存占用与槽数无关。
+"""
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
+
+# 每个用户的存档槽数上限，0 表示关闭服务端存档
+SAVE_SLOTS_PER_USER = int(os.environ.get('SAVE_SLOTS_PER_USER', 20))
+# 每个用户所有存档（压缩后）的总大小上限
+SAVE_SLOTS_USER_MB = float(os.environ.get('SAVE_SLOTS_USER_MB', 20))
+
+SLOT_NAME_MAX_LEN = 100
+_META_COLUMNS = ('slot_id', 'name', 'turn_count', 'theme', 'language', 'created_at', 'updated_at', 'size')
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class SaveSlotStore:
+
+    def __init__(self, path, max_slots=SAVE_SLOTS_PER_USER, max_bytes=SAVE_SLOTS_USER_MB * 1024 * 1024):
+        self.path = path
+        self.max_slots = max_slots
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS save_slots (
+                    owner TEXT NOT NULL,
+                    slot_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    turn_count INTEGER NOT NULL,
+                    theme TEXT,
+                    language TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    images TEXT NOT NULL DEFAULT '',
+                    PRIMARY KEY (owner, slot_id)
+                );
+                CREATE INDEX IF NOT EXISTS save_slots_owner_updated ON save_slots (owner, updated_at);
+                CREATE TABLE IF NOT EXISTS save_slot_bodies (
+                    owner TEXT NOT NULL,
+                    slot_id TEXT NOT NULL,
+                    body BLOB NOT NULL,
+                    PRIMARY KEY (owner, slot_id)
+                );
+            """)
+
+    @property
+    def enabled(self):
+        return self.max_slots > 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # ------- 列表 -------
+    def list(self, owner):
+        """按更新时间倒序返回元数据，不读取存档内容"""
+        rows = self._conn().execute(
+            f'SELECT {", ".join(_META_COLUMNS)} FROM save_slots WHERE owner = ? ORDER BY updated_at DESC',
+            (owner,)
+        ).fetchall()
+        return [dict(zip(_META_COLUMNS, row)) for row in rows]
+
+    def usage(self, owner):
+        count, size = self._conn().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM save_slots WHERE owner = ?', (owner,)
+        ).fetchone()
+        return {'slots': count, 'bytes': size, 'max_slots': self.max_slots, 'max_bytes': int(self.max_bytes)}
+
+    # ------- 读写 -------
+    def put(self, owner, name, document, slot_id=None, images=()):
+        """
+        写入存档（slot_id 已存在时覆盖），返回元数据。
+
+        指定的 slot_id 不存在时抛出 KeyError，超出槽数或总大小上限时抛出 QuotaExceeded。
+        """
+        body = zlib.compress(json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 6)
+        meta = document.get('meta', {})
+        now = time.time()
+        overwrite = slot_id is not None
+        slot_id = slot_id or secrets.token_urlsafe(9)
+        name = (name or '').strip()[:SLOT_NAME_MAX_LEN] or time.strftime('%Y-%m-%d %H:%M')
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            existing = conn.execute(
+                'SELECT size, created_at FROM save_slots WHERE owner = ? AND slot_id = ?', (owner, slot_id)
+            ).fetchone()
+            if overwrite and existing is None:
+                raise KeyError(slot_id)
+            count, total = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM save_slots WHERE owner = ?', (owner,)
+            ).fetchone()
+            if existing is None and count >= self.max_slots:
+                raise QuotaExceeded(f"at most {self.max_slots} save slots")
+            if total - (existing[0] if existing else 0) + len(body) > self.max_bytes:
+                raise QuotaExceeded(f"save slots exceed {self.max_bytes / 1024 / 1024:g} MB")
+            row = {
+                'slot_id': slot_id,
+                'name': name,
+                'turn_count': document.get('count', 0),
+                'theme': (meta.get('settings') or {}).get('theme'),
+                'language': meta.get('language'),
+                'created_at': existing[1] if existing else now,
+                'updated_at': now,
+                'size': len(body),
+            }
+            conn.execute(
+                'INSERT OR REPLACE INTO save_slots (owner, slot_id, name, turn_count, theme, language, '
+                'created_at, updated_at, size, images) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (owner, *(row[c] for c in _META_COLUMNS), ' '.join(sorted(images)))
+            )
+            conn.execute('INSERT OR REPLACE INTO save_slot_bodies (owner, slot_id, body) VALUES (?, ?, ?)',
+                         (owner, slot_id, body))
+        return row
+
+    def get(self, owner, slot_id):
+        """读取单个存档，不存在时返回 None"""
+        row = self._conn().execute(
+            'SELECT body FROM save_slot_bodies WHERE owner = ? AND slot_id = ?', (owner, slot_id)
+        ).fetchone()
+        return None if row is None else json.loads(zlib.decompress(row[0]))
+
+    def delete(self, owner, slot_id):
+        with self._conn() as conn:
+            deleted = conn.execute(
+                'DELETE FROM save_slots WHERE owner = ? AND slot_id = ?', (owner, slot_id)
+            ).rowcount
+            conn.execute('DELETE FROM save_slot_bodies WHERE owner = ? AND slot_id = ?', (owner, slot_id))
+        return bool(deleted)
+
+    def export(self, owner):
+        """逐个产出 (元数据, 存档)"""
+        for meta in self.list(owner):
+            document = self.get(owner, meta['slot_id'])
+            if document is not None:
+                yield meta, document
+
+    # ------- 图片引用 -------
+    def iter_image_hashes(self):
+        """所有存档引用的图片哈希，供图片存储清理时保留"""
+        for (images,) in self._conn().execute("SELECT images FROM save_slots WHERE images != ''"):
+            yield from images.split()
@@ -0,0 +1,532 @@
+"""
+服务端 Session 存储
+
+Cookie 中只保存签名后的 session ID，会话数据保存在本地后端（默认 SQLite）中。
+故事历史按回合增量单独存放（new_text / options / player_action / image），
+每次请求只读取用到的回合、只写回改动过的回合，请求开销不随游戏进行而增长。
+
+超过 SESSION_MAX_AGE 秒没有写入的会话（连同回合）会被清理：写回会话时每个进程每隔
+SESSION_PURGE_INTERVAL 秒检查一次，也可以用 `flask --app app purge-sessions` 手动执行。
+被清理会话引用的图片随后可由图片存储的配额清理回收。
+"""
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections.abc import MutableSequence
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 会话最长保留时间（秒），0 表示不清理
+SESSION_MAX_AGE = float(os.environ.get('SESSION_MAX_AGE', 30 * 24 * 3600))
+# 自动清理的检查间隔（秒）
+SESSION_PURGE_INTERVAL = float(os.environ.get('SESSION_PURGE_INTERVAL', 3600))
+
+SESSION_DATA_BYTES = metrics.histogram('session_data_bytes', 'Serialized session data written per save.',
+                                       buckets=metrics.BYTES_BUCKETS)
+SESSION_TURN_BYTES = metrics.histogram('session_turn_bytes', 'Serialized turn records written per save.',
+                                       buckets=metrics.BYTES_BUCKETS)
+
+class StaleSession(Exception):
+    """存储中的回合数已被其他请求改变，本次写入被拒绝"""
+
+
+# 回合记录中可由 new_text 重建的冗余字段，不再持久化
+DERIVED_TURN_FIELDS = ('full_text', 'history_text')
+
+
+def compact_turn(record):
+    """去掉回合记录中的冗余字段，只保留增量"""
+    return {k: v for k, v in record.items() if k not in DERIVED_TURN_FIELDS}
+
+
+def build_full_text(history):
+    """由回合增量重建完整故事文本（即旧版的 session['story']）"""
+    return "".join(rec.get('new_text', '') + "\n" for rec in history)
+
+
+# ----------- 回合日志 -----------
+class TurnLog(MutableSequence):
+    """
+    session['history'] 的惰性实现。
+
+    只记录回合总数，具体回合在第一次访问时按区间从后端读取；
+    新增或修改的回合会被标记，保存时只写回这些回合。
+    注意：直接修改取出的 dict 不会被跟踪，请使用 update()。
+    """
+
+    def __init__(self, loader=None, count=0):
+        self._loader = loader
+        self._count = count
+        # 存储中的回合数（打开或上次写入时），用于写入时的版本检查
+        self.stored_count = count
+        self._cache = {}
+        self._dirty = set()
+        self._rewrite = False
+
+    @classmethod
+    def from_list(cls, records):
+        log = cls()
+        log._cache = {i: compact_turn(rec) for i, rec in enumerate(records)}
+        log._count = len(records)
+        log._rewrite = True
+        return log
+
+    def _index(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('turn index out of range')
+        return i
+
+    def _ensure(self, start, stop):
+        missing = [i for i in range(start, stop) if i not in self._cache]
+        if missing and self._loader:
+            first = missing[0]
+            for offset, rec in enumerate(self._loader(first, missing[-1] + 1)):
+                self._cache.setdefault(first + offset, rec)
+
+    def _ensure_all(self):
+        self._ensure(0, self._count)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            indices = range(*i.indices(self._count))
+            if not indices:
+                return []
+            self._ensure(min(indices), max(indices) + 1)
+            return [self._cache[j] for j in indices]
+        i = self._index(i)
+        self._ensure(i, i + 1)
+        return self._cache[i]
+
+    def __iter__(self):
+        self._ensure_all()
+        for i in range(self._count):
+            yield self._cache[i]
+
+    def __setitem__(self, i, record):
+        if isinstance(i, slice):
+            records = list(self)
+            records[i] = record
+            self._reset(records)
+            return
+        i = self._index(i)
+        self._cache[i] = compact_turn(record)
+        self._dirty.add(i)
+
+    def __delitem__(self, i):
+        records = list(self)
+        del records[i]
+        self._reset(records)
+
+    def insert(self, i, record):
+        if i >= self._count:
+            self._cache[self._count] = compact_turn(record)
+            self._dirty.add(self._count)
+            self._count += 1
+            return
+        records = list(self)
+        records.insert(i, record)
+        self._reset(records)
+
+    def _reset(self, records):
+        self._cache = {i: compact_turn(rec) for i, rec in enumerate(records)}
+        self._count = len(records)
+        self._dirty.clear()
+        self._rewrite = True
+
+    def truncate(self, count):
+        """只保留前 count 个回合；保存时删除其后的记录，不重写保留的回合"""
+        if count >= self._count:
+            return
+        self._cache = {i: rec for i, rec in self._cache.items() if i < count}
+        self._dirty = {i for i in self._dirty if i < count}
+        self._count = count
+
+    def update(self, i, **fields):
+        """修改某一回合的字段并标记为需要写回"""
+        i = self._index(i)
+        self._ensure(i, i + 1)
+        self._cache[i] = dict(self._cache[i], **fields)
+        self._dirty.add(i)
+
+    def changes(self):
+        """返回 (需要写回的回合 {index: record}, 是否整体重写)；写入成功后调用 mark_saved() 清除标记"""
+        if self._rewrite:
+            return {i: self._cache[i] for i in range(self._count)}, True
+        return {i: self._cache[i] for i in self._dirty}, False
+
+    def mark_saved(self):
+        self._dirty.clear()
+        self._rewrite = False
+        self.stored_count = self._count
+
+    def discard_changes(self):
+        """放弃未写入的改动，之后的访问重新从后端读取"""
+        self._cache = {}
+        self._dirty.clear()
+        self._rewrite = False
+        self._count = self.stored_count
+
+    def __repr__(self):
+        return f"<TurnLog turns={self._count} loaded={len(self._cache)}>"
+
+
+# ----------- 后端 -----------
+class SessionBackend:
+    """会话后端接口，可替换为其他实现（如 Redis）"""
+
+    def open(self, sid):
+        """返回 (data, turn_count)，不存在时返回 None"""
+        raise NotImplementedError
+
+    def load_turns(self, sid, start, stop):
+        raise NotImplementedError
+
+    def save(self, sid, data, turn_count, turns, rewrite=False, expected_turn_count=None):
+        """
+        data 为 None 时表示基础数据未改动，只写回回合。
+
+        expected_turn_count 不为 None 时，存储中的回合数与之不同则抛出 StaleSession，不做任何写入。
+        """
+        raise NotImplementedError
+
+    def turn_count(self, sid):
+        """存储中的回合数，会话不存在时为 0"""
+        raise NotImplementedError
+
+    def update_turn(self, sid, index, fields, expected_hash=None):
+        """
+        更新单个回合的字段（供后台任务写回），回合不存在时返回 False。
+
+        expected_hash 不为 None 时，只在该回合的链式哈希（h）仍与之相同时写入：新游戏、读档后
+        同一序号的回合已是另一段历史，迟到的结果直接丢弃。
+        """
+        raise NotImplementedError
+
+    def update_data(self, sid, mutate):
+        """在事务中读取-修改-写回会话基础数据，mutate(data) 原地修改；会话不存在时返回 False"""
+        raise NotImplementedError
+
+    def iter_payloads(self):
+        """逐条返回所有会话数据与回合的原始 JSON 文本（用于统计图片引用等离线任务）"""
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def purge(self, max_age):
+        """清理超过 max_age 秒未写入的会话，返回清理的会话数"""
+        raise NotImplementedError
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """本地 SQLite 实现，每个线程一个连接，开启 WAL 以支持多进程并发读写"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    turn_count INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS turns (
+                    sid TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    record TEXT NOT NULL,
+                    PRIMARY KEY (sid, idx)
+                );
+                CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def open(self, sid):
+        row = self._conn().execute(
+            'SELECT data, turn_count FROM sessions WHERE sid = ?', (sid,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def load_turns(self, sid, start, stop):
+        rows = self._conn().execute(
+            'SELECT record FROM turns WHERE sid = ? AND idx >= ? AND idx < ? ORDER BY idx',
+            (sid, start, stop)
+        ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def turn_count(self, sid):
+        row = self._conn().execute('SELECT turn_count FROM sessions WHERE sid = ?', (sid,)).fetchone()
+        return row[0] if row else 0
+
+    def save(self, sid, data, turn_count, turns, rewrite=False, expected_turn_count=None):
+        now = time.time()
+        payload = None if data is None else json.dumps(data, ensure_ascii=False)
+        rows = [(sid, i, json.dumps(rec, ensure_ascii=False)) for i, rec in turns.items()]
+        if payload is not None:
+            SESSION_DATA_BYTES.observe(len(payload))
+        if rows:
+            SESSION_TURN_BYTES.observe(sum(len(r[2]) for r in rows))
+        with self._conn() as conn:
+            if expected_turn_count is not None:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT turn_count FROM sessions WHERE sid = ?', (sid,)).fetchone()
+                if (row[0] if row else 0) != expected_turn_count:
+                    raise StaleSession(sid)
+            if payload is None:
+                conn.execute(
+                    'UPDATE sessions SET turn_count = ?, updated_at = ? WHERE sid = ?',
+                    (turn_count, now, sid)
+                )
+            else:
+                conn.execute(
+                    'INSERT INTO sessions (sid, data, turn_count, updated_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(sid) DO UPDATE SET data = excluded.data, '
+                    'turn_count = excluded.turn_count, updated_at = excluded.updated_at',
+                    (sid, payload, turn_count, now)
+                )
+            if rewrite:
+                conn.execute('DELETE FROM turns WHERE sid = ?', (sid,))
+            else:
+                conn.execute('DELETE FROM turns WHERE sid = ? AND idx >= ?', (sid, turn_count))
+            conn.executemany('INSERT OR REPLACE INTO turns (sid, idx, record) VALUES (?, ?, ?)', rows)
+
+    def update_turn(self, sid, index, fields, expected_hash=None):
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT record FROM turns WHERE sid = ? AND idx = ?', (sid, index)
+            ).fetchone()
+            if row is None:
+                return False
+            record = json.loads(row[0])
+            if expected_hash is not None and record.get('h') != expected_hash:
+                return False
+            record.update(fields)
+            conn.execute(
+                'UPDATE turns SET record = ? WHERE sid = ? AND idx = ?',
+                (json.dumps(record, ensure_ascii=False), sid, index)
+            )
+            return True
+
+    def update_data(self, sid, mutate):
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM sessions WHERE sid = ?', (sid,)).fetchone()
+            if row is None:
+                return False
+            data = json.loads(row[0])
+            mutate(data)
+            conn.execute(
+                'UPDATE sessions SET data = ? WHERE sid = ?',
+                (json.dumps(data, ensure_ascii=False), sid)
+            )
+            return True
+
+    def iter_payloads(self):
+        conn = self._conn()
+        for (data,) in conn.execute('SELECT data FROM sessions'):
+            yield data
+        for (record,) in conn.execute('SELECT record FROM turns'):
+            yield record
+
+    def delete(self, sid):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM turns WHERE sid = ?', (sid,))
+            conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def purge(self, max_age):
+        cutoff = time.time() - max_age
+        with self._conn() as conn:
+            conn.execute(
+                'DELETE FROM turns WHERE sid IN (SELECT sid FROM sessions WHERE updated_at < ?)',
+                (cutoff,)
+            )
+            return conn.execute('DELETE FROM sessions WHERE updated_at < ?', (cutoff,)).rowcount
+
+
+# ----------- Flask Session 接口 -----------
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self._after_persist = []
+        if not isinstance(self.get('history'), TurnLog):
+            dict.__setitem__(self, 'history', TurnLog.from_list(self.get('history') or []))
+
+    def discard_changes(self):
+        """放弃本次请求对会话的改动（写入被拒绝时），之后的保存不再写入"""
+        self.get('history').discard_changes()
+        self._after_persist = []
+        self.modified = False
+
+    def call_after_persist(self, callback):
+        """登记在本次改动写入后端之后执行的回调（如启动依赖这些记录的后台任务）"""
+        self._after_persist.append(callback)
+
+    def __setitem__(self, key, value):
+        if key == 'history' and not isinstance(value, TurnLog):
+            value = TurnLog.from_list(value)
+            previous = self.get('history')
+            if isinstance(previous, TurnLog):
+                # 整体替换回合时存储中的内容不变，版本检查仍以原来的回合数为准
+                value.stored_count = previous.stored_count
+        super().__setitem__(key, value)
+
+    def __bool__(self):
+        # 只有空的回合日志时视为空会话，避免给匿名访问者写入数据库
+        return any(k != 'history' for k in self) or len(self.get('history', ())) > 0
+
+
+class ServerSessionInterface(SessionInterface):
+    """把会话数据保存到服务端后端，Cookie 中仅保留签名后的 session ID"""
+
+    salt = 'ai-adventure-session'
+
+    def __init__(self, backend, max_age=SESSION_MAX_AGE, purge_interval=SESSION_PURGE_INTERVAL):
+        self.backend = backend
+        self.max_age = max_age
+        self.purge_interval = purge_interval
+        self._purge_lock = threading.Lock()
+        self._last_purge = time.time()
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        with metrics.span('session_open'):
+            return self._open_session(app, request)
+
+    def _open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            stored = self.backend.open(sid) if sid else None
+            if stored is not None:
+                data, turn_count = stored
+                data['history'] = TurnLog(
+                    loader=lambda start, stop: self.backend.load_turns(sid, start, stop),
+                    count=turn_count
+                )
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        new, modified = session.new, session.modified
+        self.persist(session)
+
+        if new or modified or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    def persist(self, session, check_turns=False):
+        """
+        把会话改动写回后端，不涉及 Cookie。
+
+        流式响应在响应头发出后才修改会话，结束时直接调用此方法提交。
+        check_turns=True 时，若存储中的回合数已被其他请求改变，放弃本次改动并抛出 StaleSession。
+        """
+        with metrics.span('session_save'):
+            try:
+                self._write(session, check_turns)
+            except StaleSession:
+                session.discard_changes()
+                raise
+
+        callbacks, session._after_persist = session._after_persist, []
+        for callback in callbacks:
+            callback()
+        self._maybe_purge()
+
+    def _maybe_purge(self):
+        if not self.max_age or time.time() - self._last_purge < self.purge_interval:
+            return
+        if not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_purge = time.time()
+            removed = self.backend.purge(self.max_age)
+            if removed:
+                logger.info("Purged %d sessions idle for more than %.0fs", removed, self.max_age)
+        except sqlite3.Error as e:
+            logger.warning("Session purge failed: %s", e)
+        finally:
+            self._purge_lock.release()
+
+    def is_stale(self, session):
+        """本次请求读取会话之后，存储中的回合数是否已被其他请求改变"""
+        history = session.get('history')
+        return isinstance(history, TurnLog) and not session.new \
+            and self.backend.turn_count(session.sid) != history.stored_count
+
+    def _write(self, session, check_turns=False):
+        history = session.get('history')
+        if not isinstance(history, TurnLog):
+            history = TurnLog.from_list(history or [])
+            dict.__setitem__(session, 'history', history)
+        turns, rewrite = history.changes()
+
+        data = None
+        if session.modified or session.new:
+            data = {k: v for k, v in session.items() if k != 'history'}
+        if data is not None or turns or rewrite:
+            # 写入失败（如数据库被锁）时保留改动标记，之后的保存仍会写入这些回合
+            self.backend.save(session.sid, data, len(history), turns, rewrite=rewrite,
+                              expected_turn_count=history.stored_count if check_turns else None)
+            history.mark_saved()
+        session.new = False
+        session.modified = False
@@ -0,0 +1,221 @@
+"""
+下一回合的预测生成
+
+回合结束后，为前 K 个选项在后台提前生成后续剧情，玩家点击已生成的分支时直接使用结果。
+- 结果按 (会话, 回合序号, 选项) 缓存，超过 TTL 后丢弃；
+- 每个会话在时间窗口内的预测次数有上限，全局同时进行的预测数有上限，超出时跳过而不排队；
+- 玩家做出选择（或开始新游戏 / 读档）后，同一回合其余未用的分支被取消；
+- 选中的分支仍在生成时最多等待 SPECULATIVE_WAIT 秒，之后改为正常生成，玩家的回合不会被预测拖慢太多。
+
+同步模式在本模块的线程池中执行，attach_loop 后改为在事件循环上执行协程，取消会中断进行中的请求。
+同步模式下已经开始的请求无法中断：未被选中的分支照常生成完毕并消耗 token。这些生成完却没有使用的
+分支（以及过期未用的结果）计入 speculative_wasted_total 与 speculative_wasted_tokens_total，
+用于评估 SPECULATIVE_TOP_K 的成本。
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 预测的选项个数，0 表示关闭
+SPECULATIVE_TOP_K = int(os.environ.get('SPECULATIVE_TOP_K', 0))
+# 每个会话在 SPECULATIVE_BUDGET_WINDOW 秒内最多发起的预测次数
+SPECULATIVE_SESSION_BUDGET = int(os.environ.get('SPECULATIVE_SESSION_BUDGET', 30))
+SPECULATIVE_BUDGET_WINDOW = float(os.environ.get('SPECULATIVE_BUDGET_WINDOW', 3600))
+# 全局同时进行的预测数
+SPECULATIVE_MAX_INFLIGHT = int(os.environ.get('SPECULATIVE_MAX_INFLIGHT', 8))
+# 预测结果的有效期（秒）
+SPECULATIVE_TTL = float(os.environ.get('SPECULATIVE_TTL', 600))
+# 玩家选中仍在生成中的分支时最多等待的秒数，超时后改为正常生成
+SPECULATIVE_WAIT = float(os.environ.get('SPECULATIVE_WAIT', 5))
+
+SPECULATIVE_WASTED = metrics.counter('speculative_wasted_total',
+                                     'Speculative branches that finished generating but were never used.')
+SPECULATIVE_WASTED_TOKENS = metrics.counter('speculative_wasted_tokens_total',
+                                            'Tokens spent on speculative branches that were never used.',
+                                            ['direction'])
+
+
+class Speculator:
+    """
+    generate(api_key, request) 同步生成并返回结果（带 usage 属性时用于统计浪费的 token）；
+    agenerate 为其协程版本，attach_loop 后使用。
+    """
+
+    def __init__(self, generate, agenerate=None, top_k=SPECULATIVE_TOP_K, session_budget=SPECULATIVE_SESSION_BUDGET,
+                 budget_window=SPECULATIVE_BUDGET_WINDOW, max_inflight=SPECULATIVE_MAX_INFLIGHT,
+                 ttl=SPECULATIVE_TTL, wait=SPECULATIVE_WAIT):
+        self.generate = generate
+        self.agenerate = agenerate
+        self.top_k = top_k
+        self.session_budget = session_budget
+        self.budget_window = budget_window
+        self.max_inflight = max_inflight
+        self.ttl = ttl
+        self.wait = wait
+        self.loop = None
+        self._executor = None
+        self._entries = {}  # (sid, turn_index, option) -> (future, created_at)
+        self._budget = {}  # sid -> deque[开始时间]
+        self._lock = threading.Lock()
+        self._stats = {'started': 0, 'hits': 0, 'misses': 0, 'cancelled': 0, 'expired': 0, 'wasted': 0,
+                       'skipped_budget': 0, 'skipped_capacity': 0}
+
+    @property
+    def enabled(self):
+        return self.top_k > 0
+
+    def attach_loop(self, loop):
+        if self.agenerate is not None:
+            self.loop = loop
+
+    def _submit(self, api_key, request):
+        if self.loop is not None:
+            return asyncio.run_coroutine_threadsafe(self.agenerate(api_key, request), self.loop)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_inflight, thread_name_prefix='speculate')
+        return self._executor.submit(self.generate, api_key, request)
+
+    # ------- 发起 -------
+    def speculate(self, sid, turn_index, api_key, options, build_request):
+        """
+        为前 K 个选项发起预测；build_request(option) 在调用线程中组装请求参数
+        （需要访问 session 时由请求线程调用）。返回实际发起的个数。
+        """
+        if not self.enabled:
+            return 0
+        now = time.time()
+        started = 0
+        with self._lock:
+            expired = self._prune(now)
+        for future in expired:
+            self._drop(future)
+        for option in options[:self.top_k]:
+            key = (sid, turn_index, option)
+            with self._lock:
+                if key in self._entries:
+                    continue
+                inflight = sum(1 for f, _ in self._entries.values() if not f.done())
+                if inflight >= self.max_inflight:
+                    self._stats['skipped_capacity'] += 1
+                    break
+                used = self._budget.setdefault(sid, deque())
+                if len(used) >= self.session_budget:
+                    self._stats['skipped_budget'] += 1
+                    break
+                used.append(now)
+                self._stats['started'] += 1
+                # 先占位，避免并发请求重复发起同一分支
+                placeholder = _Pending()
+                self._entries[key] = (placeholder, now)
+            try:
+                future = self._submit(api_key, build_request(option))
+            except Exception as e:
+                logger.warning("Speculative generation not started: %s", e)
+                with self._lock:
+                    self._entries.pop(key, None)
+                continue
+            with self._lock:
+                cancelled = self._entries.get(key, (None,))[0] is not placeholder
+                if not cancelled:
+                    self._entries[key] = (future, now)
+            if cancelled:
+                # 占位期间已被取消
+                self._drop(future)
+            started += 1
+        return started
+
+    # ------- 使用 -------
+    def has(self, sid, turn_index, option):
+        with self._lock:
+            return (sid, turn_index, option) in self._entries
+
+    def take(self, sid, turn_index, option):
+        """
+        取出玩家所选分支的预测结果（生成中则等待），并取消该回合的其余分支。
+
+        没有可用结果时返回 None，由调用方正常生成。
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.pop((sid, turn_index, option), None)
+            self._stats['hits' if entry else 'misses'] += 1
+        self.discard(sid, turn_index)
+        if entry is None or isinstance(entry[0], _Pending):
+            return None
+        future, _ = entry
+        try:
+            return future.result(timeout=self.wait)
+        except FutureTimeoutError:
+            self._drop(future)
+            logger.info("Speculative generation too slow, generating normally")
+        except Exception as e:
+            logger.warning("Speculative generation failed: %s", e)
+        return None
+
+    # ------- 取消与清理 -------
+    def discard(self, sid, turn_index=None):
+        """取消会话的预测（指定 turn_index 时只取消该回合）"""
+        with self._lock:
+            keys = [k for k in self._entries if k[0] == sid and (turn_index is None or k[1] == turn_index)]
+            entries = [self._entries.pop(k) for k in keys]
+            self._stats['cancelled'] += len(entries)
+        for future, _ in entries:
+            self._drop(future)
+
+    def _drop(self, future):
+        """取消不再使用的分支；无法取消（已在线程中运行或已完成）时在完成后计入浪费"""
+        if not future.cancel():
+            future.add_done_callback(self._count_wasted)
+
+    def _count_wasted(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            self._stats['wasted'] += 1
+        SPECULATIVE_WASTED.inc()
+        input_tokens, output_tokens = metrics.usage_tokens(getattr(future.result(), 'usage', None))
+        SPECULATIVE_WASTED_TOKENS.inc(input_tokens, direction='input')
+        SPECULATIVE_WASTED_TOKENS.inc(output_tokens, direction='output')
+
+    def _prune(self, now):
+        # 调用方需持有锁；返回过期的分支，由调用方在锁外 _drop（已完成的分支会立即回调 _count_wasted）
+        keys = [k for k, (_, created_at) in self._entries.items() if now - created_at > self.ttl]
+        expired = [self._entries.pop(key)[0] for key in keys]
+        self._stats['expired'] += len(expired)
+        cutoff = now - self.budget_window
+        for sid in list(self._budget):
+            used = self._budget[sid]
+            while used and used[0] < cutoff:
+                used.popleft()
+            if not used:
+                del self._budget[sid]
+        return expired
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['inflight'] = sum(1 for f, _ in self._entries.values() if not f.done())
+        used = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / used if used else 0.0
+        return stats
+
+
+class _Pending:
+    """发起请求前的占位，接口与 Future 中用到的部分一致"""
+
+    def done(self):
+        return False
+
+    def cancel(self):
+        return True
@@ -1,6 +1,8 @@
 // 全局变量
 let characters = [];
 let uiTranslations = {}; // Store translations
+let serverSaves = false; // 服务端是否开启存档槽
+let currentTurnIndex = null; // 当前显示的回合序号，随行动提交供服务端检查进度
 
 // 打字机效果函数
 function typeWriterEffect(element, text, speed = 30) {
@@ -36,6 +38,7 @@ function openCharacterModal(characterId) {
             </div>
             <p style="margin-bottom: 1rem; color: var(--text-color);">${c.detail || noDetail}</p>
             <h4 style="color: var(--primary-color); border-bottom: 2px dashed var(--primary-color); padding-bottom: 0.5rem; margin-bottom: 0.5rem;">${eventsTitle}</h4>
+            ${c.event_summary ? `<p style="text-align: left; color: #666; margin-bottom: 0.5rem;">${c.event_summary}</p>` : ''}
             <ul style="text-align: left; padding-left: 1.5rem; color: #666;">
                 ${c.events && c.events.length ? c.events.map(e => `<li>${e}</li>`).join('') : `<li>${noEvents}</li>`}
             </ul>
@@ -58,19 +61,178 @@ function closeGameMenu() {
 }
 
 // 历史记录模态框控制
+// 打开时才从 /history 分页加载：每页一个占位元素，只有滚动到附近的页才请求并渲染，
+// 远离可见区域的页清空内容、保留高度。页地址固定，浏览器按 ETag 重新验证。
+const HISTORY_PAGE_SIZE = 20;
+let historyState = null; // { total, observer }
+
 function toggleHistory() {
     document.getElementById('history-modal').style.display = 'flex';
+    openHistory();
 }
 
 function closeHistoryModal() {
     document.getElementById('history-modal').style.display = 'none';
 }
 
+function fetchHistoryPage(before) {
+    const query = before === null ? `limit=${HISTORY_PAGE_SIZE}` : `before=${before}&limit=${HISTORY_PAGE_SIZE}`;
+    return fetch(`/history?${query}`, { credentials: 'same-origin' }).then(res => {
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        return res.json();
+    });
+}
+
+function openHistory() {
+    if (historyState && currentTurnIndex !== null && historyState.total === currentTurnIndex + 1) return;
+    resetHistory();
+    const list = document.getElementById('history-list');
+    list.textContent = uiTranslations.loading_text || '...';
+    const state = historyState = { total: 0, observer: null };
+
+    fetchHistoryPage(null).then(page => {
+        if (historyState !== state) return;
+        state.total = page.total;
+        list.textContent = '';
+        if (!page.total) {
+            list.textContent = '...';
+            return;
+        }
+        for (let start = 0; start < page.total; start += HISTORY_PAGE_SIZE) {
+            const el = document.createElement('div');
+            el.className = 'history-page';
+            el.dataset.start = start;
+            el.style.minHeight = '60vh'; // 未加载的页先按大致高度占位
+            list.appendChild(el);
+        }
+        renderHistoryPage(list.lastElementChild, page.turns);
+        list.scrollTop = list.scrollHeight;
+
+        state.observer = new IntersectionObserver(entries => {
+            entries.forEach(entry => {
+                if (entry.isIntersecting) loadHistoryPage(entry.target, state);
+                else unloadHistoryPage(entry.target);
+            });
+        }, { root: list, rootMargin: '100% 0px' });
+        list.querySelectorAll('.history-page').forEach(el => state.observer.observe(el));
+    }).catch(err => {
+        console.error('Failed to load history:', err);
+        if (historyState === state) historyState = null;
+        list.textContent = '...';
+    });
+}
+
+function loadHistoryPage(el, state) {
+    if (el.dataset.loaded || el.dataset.loading) return;
+    el.dataset.loading = '1';
+    const before = Math.min(Number(el.dataset.start) + HISTORY_PAGE_SIZE, state.total);
+    fetchHistoryPage(before).then(page => {
+        if (historyState !== state) return;
+        // 在可见区域上方插入内容时保持当前阅读位置
+        const list = el.parentElement;
+        const above = el.getBoundingClientRect().bottom <= list.getBoundingClientRect().top;
+        const previousHeight = el.offsetHeight;
+        renderHistoryPage(el, page.turns);
+        if (above) list.scrollTop += el.offsetHeight - previousHeight;
+    }).catch(err => {
+        console.error('Failed to load history page:', err);
+    }).finally(() => {
+        delete el.dataset.loading;
+    });
+}
+
+function renderHistoryPage(el, turns) {
+    el.textContent = '';
+    el.style.minHeight = '';
+    turns.forEach(turn => {
+        const item = document.createElement('div');
+        item.className = 'history-turn';
+        if (turn.action && turn.index > 0) {
+            const action = document.createElement('div');
+            action.className = 'history-action';
+            action.textContent = `> ${turn.action}`;
+            item.appendChild(action);
+        }
+        item.appendChild(document.createTextNode(turn.text));
+        el.appendChild(item);
+    });
+    el.dataset.loaded = '1';
+}
+
+function unloadHistoryPage(el) {
+    if (!el.dataset.loaded) return;
+    el.style.minHeight = `${el.offsetHeight}px`;
+    el.textContent = '';
+    delete el.dataset.loaded;
+}
+
+function resetHistory() {
+    if (historyState && historyState.observer) historyState.observer.disconnect();
+    historyState = null;
+}
+
 // ============ 存档/读档功能 ============
+// 存档（v2）只保存元数据与最后一个回合的哈希，回合按哈希单独保存在 aiAdventureTurns 中：
+// 每个回合为 [上一回合哈希, 文本, 选项, 玩家行动, 图片, 图片描述?]，同一进度的多个存档共用相同的回合。
+// aiAdventureCheckpoint 记录与服务端同步到的位置，存档 / 读档只传输其后的回合。
+
+const SAVES_KEY = 'aiAdventureSaves';
+const TURNS_KEY = 'aiAdventureTurns';
+const CHECKPOINT_KEY = 'aiAdventureCheckpoint';
+
+function readStore(key, fallback) {
+    try {
+        return JSON.parse(localStorage.getItem(key)) || fallback;
+    } catch (e) {
+        return fallback;
+    }
+}
+
+// 从 head 沿哈希链取出完整的回合列表，缺少回合时返回 null
+function collectTurns(turnStore, head, count) {
+    const turns = [];
+    for (let h = head; h; ) {
+        const turn = turnStore[h];
+        if (!turn) return null;
+        turns.push([h, ...turn.slice(1)]);
+        h = turn[0];
+    }
+    turns.reverse();
+    return turns.length === count ? turns : null;
+}
+
+// 删除没有任何存档引用的回合
+function collectGarbageTurns(saves, turnStore) {
+    const reachable = new Set();
+    Object.values(saves).forEach(save => {
+        for (let h = save.head; h && !reachable.has(h) && turnStore[h]; h = turnStore[h][0]) {
+            reachable.add(h);
+        }
+    });
+    Object.keys(turnStore).forEach(h => {
+        if (!reachable.has(h)) delete turnStore[h];
+    });
+}
+
+// 较大的请求体在浏览器支持时以 gzip 上传
+function compressBody(text) {
+    if (typeof CompressionStream === 'undefined' || text.length < 1024) {
+        return Promise.resolve({ body: text, headers: {} });
+    }
+    const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+    return new Response(stream).blob().then(body => ({ body, headers: { 'Content-Encoding': 'gzip' } }));
+}
 
 // 保存游戏到localStorage
 function saveGameToLocalStorage(saveName) {
-    fetch('/save')
+    const turnStore = readStore(TURNS_KEY, {});
+    const checkpoint = readStore(CHECKPOINT_KEY, null);
+    let url = '/save';
+    if (checkpoint && turnStore[checkpoint.hash]) {
+        url += `?since=${checkpoint.count}&hash=${encodeURIComponent(checkpoint.hash)}`;
+    }
+
+    fetch(url)
         .then(res => res.json())
         .then(data => {
             if (!data.success) {
@@ -78,25 +240,38 @@ function saveGameToLocalStorage(saveName) {
                 return;
             }
 
-            const saveData = {
+            // 合并新回合（之前图片未完成的回合会被覆盖为最新状态）
+            const save = data.save;
+            let prev = save.base_hash;
+            save.turns.forEach(([h, ...rest]) => {
+                turnStore[h] = [prev, ...rest];
+                prev = h;
+            });
+
+            const saves = readStore(SAVES_KEY, {});
+            const saveId = `save_${Date.now()}`;
+            saves[saveId] = {
                 name: saveName,
                 timestamp: new Date().toISOString(),
-                data: data.data
+                v: save.v,
+                meta: save.meta,
+                count: save.count,
+                head: save.head
             };
 
-            // 获取现有存档
-            const saves = JSON.parse(localStorage.getItem('aiAdventureSaves') || '{}');
-
-            // 生成存档ID
-            const saveId = `save_${Date.now()}`;
-            saves[saveId] = saveData;
-
-            // 保存到localStorage
+            // 保存到localStorage：先写回合再写存档，失败时清理写入一半的回合
             try {
-                localStorage.setItem('aiAdventureSaves', JSON.stringify(saves));
+                localStorage.setItem(TURNS_KEY, JSON.stringify(turnStore));
+                localStorage.setItem(SAVES_KEY, JSON.stringify(saves));
+                localStorage.setItem(CHECKPOINT_KEY, JSON.stringify(data.checkpoint));
                 alert(uiTranslations.save_success || `存档成功: ${saveName}`);
                 closeSaveDialog();
             } catch (e) {
+                delete saves[saveId];
+                collectGarbageTurns(saves, turnStore);
+                try {
+                    localStorage.setItem(TURNS_KEY, JSON.stringify(turnStore));
+                } catch (ignored) {}
                 if (e.name === 'QuotaExceededError') {
                     alert(uiTranslations.storage_full || 'localStorage已满，请删除旧存档');
                 } else {
@@ -110,9 +285,17 @@ function saveGameToLocalStorage(saveName) {
         });
 }
 
+function postSave(payload) {
+    return compressBody(JSON.stringify(payload)).then(({ body, headers }) => fetch('/load', {
+        method: 'POST',
+        headers: Object.assign({ 'Content-Type': 'application/json' }, headers),
+        body
+    }));
+}
+
 // 从localStorage读档
 function loadGameFromLocalStorage(saveId) {
-    const saves = JSON.parse(localStorage.getItem('aiAdventureSaves') || '{}');
+    const saves = readStore(SAVES_KEY, {});
     const saveData = saves[saveId];
 
     if (!saveData) {
@@ -126,16 +309,42 @@ function loadGameFromLocalStorage(saveId) {
         return;
     }
 
-    fetch('/load', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(saveData)
-    })
+    let request;
+    let turns = null;
+    if (saveData.v === 2) {
+        turns = collectTurns(readStore(TURNS_KEY, {}), saveData.head, saveData.count);
+        if (!turns) {
+            alert(uiTranslations.load_error || '读档失败');
+            return;
+        }
+        const full = { v: 2, meta: saveData.meta, count: saveData.count, head: saveData.head, turns };
+        // 存档与服务端当前进度有共同的前缀时只上传之后的回合，检查点不一致时再上传完整存档
+        const checkpoint = readStore(CHECKPOINT_KEY, null);
+        const base = checkpoint ? turns.findIndex(t => t[0] === checkpoint.hash) + 1 : 0;
+        if (base > 0 && base === checkpoint.count) {
+            const delta = Object.assign({}, full, { base, base_hash: checkpoint.hash, turns: turns.slice(base) });
+            request = postSave(delta).then(res => (res.status === 409 ? postSave(full) : res));
+        } else {
+            request = postSave(full);
+        }
+    } else {
+        // 旧版存档：整体上传，由服务端转换
+        request = postSave(saveData);
+    }
+
+    request
         .then(res => res.json())
         .then(data => {
             if (data.success) {
+                if (turns) {
+                    // 图片仍在生成中的回合之前的部分与服务端一致
+                    const pending = turns.findIndex(t => t.length > 5);
+                    const count = pending === -1 ? turns.length : pending;
+                    localStorage.setItem(CHECKPOINT_KEY, JSON.stringify(
+                        count ? { count, hash: turns[count - 1][0] } : null));
+                } else {
+                    localStorage.removeItem(CHECKPOINT_KEY);
+                }
                 // 读档成功，刷新页面
                 window.location.reload();
             } else {
@@ -150,7 +359,7 @@ function loadGameFromLocalStorage(saveId) {
 
 // 获取所有存档
 function getSaveList() {
-    const saves = JSON.parse(localStorage.getItem('aiAdventureSaves') || '{}');
+    const saves = readStore(SAVES_KEY, {});
     return Object.entries(saves).map(([id, save]) => ({
         id,
         name: save.name,
@@ -165,9 +374,12 @@ function deleteSave(saveId) {
         return;
     }
 
-    const saves = JSON.parse(localStorage.getItem('aiAdventureSaves') || '{}');
+    const saves = readStore(SAVES_KEY, {});
     delete saves[saveId];
-    localStorage.setItem('aiAdventureSaves', JSON.stringify(saves));
+    const turnStore = readStore(TURNS_KEY, {});
+    collectGarbageTurns(saves, turnStore);
+    localStorage.setItem(SAVES_KEY, JSON.stringify(saves));
+    localStorage.setItem(TURNS_KEY, JSON.stringify(turnStore));
 
     // 刷新读档对话框
     showLoadDialog();
@@ -184,44 +396,136 @@ function closeSaveDialog() {
     document.getElementById('save-dialog').style.display = 'none';
 }
 
-// 执行存档
+// 执行存档：开启服务端存档槽时存到服务端，否则存到localStorage
 function doSave() {
     const saveNameInput = document.getElementById('save-name-input');
     const saveName = saveNameInput.value.trim() || `存档 ${new Date().toLocaleString()}`;
-    saveGameToLocalStorage(saveName);
+    if (serverSaves) {
+        saveGameToServer(saveName);
+    } else {
+        saveGameToLocalStorage(saveName);
+    }
+}
+
+// ============ 服务端存档槽 ============
+function saveGameToServer(saveName) {
+    fetch('/saves', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ name: saveName })
+    })
+        .then(res => res.json().then(data => ({ status: res.status, data })))
+        .then(({ status, data }) => {
+            if (data.success) {
+                alert(uiTranslations.save_success || `存档成功: ${saveName}`);
+                closeSaveDialog();
+            } else if (status === 413) {
+                alert(uiTranslations.save_quota || '云端存档已满，请删除旧存档');
+            } else {
+                alert(uiTranslations.save_error || '存档失败');
+            }
+        })
+        .catch(err => {
+            console.error('Save error:', err);
+            alert(uiTranslations.save_error || '存档失败');
+        });
+}
+
+function loadServerSave(slotId) {
+    const confirmMsg = uiTranslations.load_confirm || '读档会覆盖当前进度，确定要读档吗？';
+    if (!confirm(confirmMsg)) {
+        return;
+    }
+    fetch(`/saves/${encodeURIComponent(slotId)}/load`, { method: 'POST' })
+        .then(res => res.json())
+        .then(data => {
+            if (data.success) {
+                // 服务端进度已整体替换，本地检查点失效
+                localStorage.removeItem(CHECKPOINT_KEY);
+                window.location.reload();
+            } else {
+                alert(uiTranslations.load_error || '读档失败');
+            }
+        })
+        .catch(err => {
+            console.error('Load error:', err);
+            alert(uiTranslations.load_error || '读档失败');
+        });
+}
+
+function deleteServerSave(slotId) {
+    const confirmMsg = uiTranslations.delete_confirm || '确定要删除这个存档吗？';
+    if (!confirm(confirmMsg)) {
+        return;
+    }
+    fetch(`/saves/${encodeURIComponent(slotId)}`, { method: 'DELETE' })
+        .then(() => showLoadDialog());
+}
+
+// 服务端存档槽只取元数据列表
+function getServerSaveList() {
+    if (!serverSaves) {
+        return Promise.resolve([]);
+    }
+    return fetch('/saves')
+        .then(res => res.json())
+        .then(data => (data.slots || []).map(slot => ({
+            id: slot.slot_id,
+            name: slot.name,
+            timestamp: slot.updated_at * 1000,
+            turns: slot.turn_count,
+            server: true
+        })))
+        .catch(err => {
+            console.error('Save list error:', err);
+            return [];
+        });
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text == null ? '' : String(text);
+    return div.innerHTML;
 }
 
 // 显示读档对话框
 function showLoadDialog() {
     closeGameMenu();
-    const saves = getSaveList();
-
-    const saveListHtml = saves.length > 0
-        ? saves.map(save => {
-            const date = new Date(save.timestamp).toLocaleString();
-            return `
-                <div class="save-item">
-                    <div class="save-info">
-                        <div class="save-name">${save.name}</div>
-                        <div class="save-date">${date}</div>
-                    </div>
-                    <div class="save-actions">
-                        <button class="btn btn-small" onclick="loadGameFromLocalStorage('${save.id}')">
-                            ${uiTranslations.load_btn || '读取'}
-                        </button>
-                        <button class="btn btn-small btn-danger" onclick="deleteSave('${save.id}')">
-                            ${uiTranslations.delete_btn || '删除'}
-                        </button>
+    getServerSaveList().then(serverList => {
+        const saves = serverList.concat(getSaveList());
+
+        const saveListHtml = saves.length > 0
+            ? saves.map(save => {
+                const date = new Date(save.timestamp).toLocaleString();
+                const source = save.server
+                    ? (uiTranslations.server_save || '云端')
+                    : (uiTranslations.local_save || '本地');
+                const loadFn = save.server ? 'loadServerSave' : 'loadGameFromLocalStorage';
+                const deleteFn = save.server ? 'deleteServerSave' : 'deleteSave';
+                return `
+                    <div class="save-item">
+                        <div class="save-info">
+                            <div class="save-name">${escapeHtml(save.name)}</div>
+                            <div class="save-date">[${source}] ${date}${save.turns ? ` · ${save.turns}` : ''}</div>
+                        </div>
+                        <div class="save-actions">
+                            <button class="btn btn-small" onclick="${loadFn}('${save.id}')">
+                                ${uiTranslations.load_btn || '读取'}
+                            </button>
+                            <button class="btn btn-small btn-danger" onclick="${deleteFn}('${save.id}')">
+                                ${uiTranslations.delete_btn || '删除'}
+                            </button>
+                        </div>
                     </div>
-                </div>
-            `;
-        }).join('')
-        : `<div style="text-align: center; color: #999; padding: 2rem;">
-            ${uiTranslations.no_saves || '暂无存档'}
-        </div>`;
+                `;
+            }).join('')
+            : `<div style="text-align: center; color: #999; padding: 2rem;">
+                ${uiTranslations.no_saves || '暂无存档'}
+            </div>`;
 
-    document.getElementById('save-list').innerHTML = saveListHtml;
-    document.getElementById('load-dialog').style.display = 'flex';
+        document.getElementById('save-list').innerHTML = saveListHtml;
+        document.getElementById('load-dialog').style.display = 'flex';
+    });
 }
 
 // 关闭读档对话框
@@ -294,55 +598,386 @@ function debugInfo(storyData, charactersData) {
     console.log('Characters:', charactersData);
 }
 
-// 异步图片检查函数
-function checkImage() {
-    console.log("[Polling] Checking for image");
+// ============ 流式剧情 ============
 
-    document.getElementById("image-container").style.display = "flex";
-    document.getElementById("image-loading").style.display = "flex"; // Changed to flex for centering
-    startLoadingDots("image-dots");  // 图片 loading 省略号
-
-    fetch('/get_image', {
-        method: 'GET',
-        headers: {
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache',
-            'Expires': '0'
-        },
-        credentials: 'same-origin'
+// 拦截选项/自定义行动表单，改为流式请求并局部更新页面；
+// 不支持流式时请求 JSON，连 fetch 都不支持时走普通表单提交
+function submitTurn(event) {
+    const form = event.target;
+    if (!window.fetch) {
+        startLoading();
+        return true;
+    }
+    event.preventDefault();
+    if (window.ReadableStream && window.TextDecoder) {
+        streamNextStep(form);
+    } else {
+        fetchNextStep(form);
+    }
+    return false;
+}
+
+// 以 JSON 方式提交行动，只取回新回合的数据
+function fetchNextStep(form) {
+    const storyText = document.querySelector('.story-text');
+    const previousText = storyText.textContent.trim();
+    setTurnFormsDisabled(true);
+    startLoading();
+
+    fetch('/next_step', {
+        method: 'POST',
+        body: turnFormData(form),
+        credentials: 'same-origin',
+        headers: { 'Accept': 'application/json' }
     })
+        .then(res => res.json().then(data => ({ status: res.status, ok: res.ok, data })))
+        .then(({ status, ok, data }) => {
+            if (status === 409 || status === 429) return handleTurnRejected(data);
+            stopLoading();
+            if (!ok || !data.success) throw new Error(data.error || 'request failed');
+            pushRecentHistory(previousText);
+            resetStoryImage();
+            const actionInput = form.querySelector('input[name="player_input"]');
+            if (actionInput) actionInput.value = '';
+            applyTurnResult(data);
+            typeWriterEffect(storyText, data.text);
+        })
+        .catch(err => {
+            console.error('Next step failed:', err);
+            stopLoading();
+            setTurnFormsDisabled(false);
+            alert(err.message);
+        });
+}
+
+// 行动表单数据，附带当前回合序号
+function turnFormData(form) {
+    const formData = new FormData(form);
+    if (currentTurnIndex !== null) formData.set('turn_index', currentTurnIndex);
+    return formData;
+}
+
+// 回合被服务端拒绝：进度已被其他页面推进时重新加载，同一回合正在生成或提交过快时提示
+function handleTurnRejected(data) {
+    stopLoading();
+    if (data.stale) {
+        location.reload();
+        return;
+    }
+    setTurnFormsDisabled(false);
+    alert(data.error);
+}
+
+// 禁用/启用所有行动表单，防止生成过程中重复提交
+function setTurnFormsDisabled(disabled) {
+    document.querySelectorAll('form[action="/next_step"] button, form[action="/next_step"] input')
+        .forEach(el => { el.disabled = disabled; });
+}
+
+// 逐块读取 SSE 响应并回调 onEvent(event, data)
+function readEventStream(body, onEvent) {
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    function pump() {
+        return reader.read().then(({ done, value }) => {
+            if (done) return;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+                const raw = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let eventName = 'message';
+                let data = '';
+                raw.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                onEvent(eventName, data ? JSON.parse(data) : null);
+            }
+            return pump();
+        });
+    }
+    return pump();
+}
+
+// 把当前文本移入最近历史（最多保留 3 段）
+function pushRecentHistory(text) {
+    const historyEl = document.querySelector('.history-text');
+    if (!historyEl || !text || text === '...') return;
+    const parts = historyEl.textContent.trim() ? historyEl.textContent.trim().split('\n\n') : [];
+    parts.push(text);
+    historyEl.textContent = parts.slice(-3).join('\n\n');
+    historyEl.style.display = 'block';
+}
+
+function streamNextStep(form) {
+    const formData = turnFormData(form);
+    const storyText = document.querySelector('.story-text');
+    const previousText = storyText.textContent.trim();
+    let started = false;
+    let finished = false;
+
+    setTurnFormsDisabled(true);
+    startLoading();
+
+    function beginText() {
+        if (started) return;
+        started = true;
+        stopLoading();
+        pushRecentHistory(previousText);
+        storyText.textContent = '';
+        resetStoryImage();
+    }
+
+    fetch('/next_step_stream', { method: 'POST', body: formData, credentials: 'same-origin' })
+        .then(res => {
+            if (res.status === 409 || res.status === 429) {
+                finished = true;
+                return res.json().then(handleTurnRejected);
+            }
+            if (!res.ok || !res.body) throw new Error(`HTTP ${res.status}`);
+            return readEventStream(res.body, (eventName, data) => {
+                if (eventName === 'delta') {
+                    beginText();
+                    storyText.textContent += data.text;
+                } else if (eventName === 'done') {
+                    beginText();
+                    finished = true;
+                    const actionInput = form.querySelector('input[name="player_input"]');
+                    if (actionInput) actionInput.value = '';
+                    applyTurnResult(data);
+                } else if (eventName === 'error') {
+                    finished = true;
+                    console.error('Stream error:', data.error);
+                    // 生成期间进度已被其他页面推进：与 JSON 提交一样重新加载，避免之后的提交一直被拒绝
+                    if (data.stale) return handleTurnRejected(data);
+                    stopLoading();
+                    setTurnFormsDisabled(false);
+                    alert(data.error);
+                }
+            });
+        })
+        .then(() => {
+            if (!finished) throw new Error('stream ended unexpectedly');
+        })
+        .catch(err => {
+            console.error('Streaming failed:', err);
+            stopLoading();
+            if (!started) {
+                // 流式请求不可用，退回 JSON 请求
+                fetchNextStep(form);
+            } else {
+                setTurnFormsDisabled(false);
+            }
+        });
+}
+
+// 新回合开始时隐藏上一回合的图片
+function resetStoryImage() {
+    if (imageEventSource) {
+        imageEventSource.close();
+        imageEventSource = null;
+    }
+    const img = document.getElementById('story-image');
+    img.style.display = 'none';
+    img.removeAttribute('src');
+    document.getElementById('image-loading').style.display = 'none';
+    document.getElementById('image-container').style.display = 'none';
+}
+
+// 根据最终结构化结果更新选项、角色、历史与图片
+function applyTurnResult(data) {
+    currentTurnIndex = data.turn_index;
+    const storyText = document.querySelector('.story-text');
+    storyText.textContent = data.text;
+
+    // 下次打开历史时重新加载（未变化的页由 ETag 验证后直接使用缓存）
+    resetHistory();
+
+    renderOptions(data.options);
+    if (data.characters_changed && data.characters_changed.length) {
+        mergeCharacters(data.characters_changed);
+    }
+    setTurnFormsDisabled(false);
+
+    if (data.image_pending || characters.some(c => c.avatar_pending)) {
+        subscribeImages(data.turn_index, data.image_pending);
+    }
+}
+
+function buildTurnForm(value, label, extraClass) {
+    const form = document.createElement('form');
+    form.method = 'post';
+    form.action = '/next_step';
+    form.onsubmit = submitTurn;
+    const input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = 'branch_choice';
+    input.value = value;
+    const button = document.createElement('button');
+    button.type = 'submit';
+    button.className = extraClass ? `btn ${extraClass}` : 'btn';
+    button.textContent = label;
+    form.appendChild(input);
+    form.appendChild(button);
+    return form;
+}
+
+function renderOptions(options) {
+    const grid = document.querySelector('.options-grid');
+    const title = document.querySelector('.branch-section h2');
+    grid.innerHTML = '';
+    if (options && options.length) {
+        options.forEach(option => grid.appendChild(buildTurnForm(option, option)));
+        if (title) title.textContent = uiTranslations.response_prompt || '你想如何回应？';
+    } else {
+        const waitText = uiTranslations.wait_option || '等待给出选项';
+        grid.appendChild(buildTurnForm(waitText, waitText, 'btn-secondary'));
+        if (title) title.textContent = waitText;
+    }
+}
+
+// 合并本回合新增或变化的角色
+function mergeCharacters(changed) {
+    changed.forEach(c => {
+        const index = characters.findIndex(x => x.id === c.id);
+        if (index >= 0) characters[index] = c;
+        else characters.push(c);
+    });
+    renderCharacters(characters);
+}
+
+function renderCharacters(charactersData) {
+    characters = charactersData;
+    const list = document.querySelector('.character-list');
+    if (!list) return;
+    list.innerHTML = '';
+    if (!characters.length) {
+        const empty = document.createElement('div');
+        empty.style.cssText = 'text-align: center; color: #999; padding: 1rem;';
+        empty.textContent = uiTranslations.no_characters || '暂无角色';
+        list.appendChild(empty);
+        return;
+    }
+    characters.forEach(c => {
+        const card = document.createElement('div');
+        card.className = 'character-card';
+        card.onclick = () => openCharacterModal(c.id);
+        card.innerHTML = `
+            <div class="char-avatar">
+                <img style="width:100%; height:100%; object-fit:cover;" class="pixel-art">
+            </div>
+            <div class="char-info">
+                <h3></h3>
+                <p></p>
+            </div>
+        `;
+        card.querySelector('img').src = c.avatar;
+        card.querySelector('img').alt = c.name;
+        card.querySelector('h3').textContent = c.name;
+        card.querySelector('p').textContent = `${(c.desc || '').slice(0, 20)}...`;
+        list.appendChild(card);
+    });
+}
+
+// ============ 图片推送 ============
+let imageEventSource = null;
+
+// 显示场景图（淡入）
+function showStoryImage(url) {
+    const img = document.getElementById("story-image");
+    document.getElementById("image-container").style.display = "flex";
+    img.onload = () => {
+        stopLoadingDots("image-dots");
+        document.getElementById("image-loading").style.display = "none";
+        img.style.display = 'block';
+        // 淡入效果
+        img.style.opacity = 0;
+        setTimeout(() => {
+            img.style.transition = "opacity 0.5s ease-in-out";
+            img.style.opacity = 1;
+        }, 50);
+    };
+    img.onerror = () => {
+        console.error("[Image] Failed to load image URL:", url);
+        stopLoadingDots("image-dots");
+        document.getElementById("image-loading").style.display = "none";
+    };
+    img.src = url;
+}
+
+// 更新角色头像
+function updateCharacterAvatar(characterId, avatarUrl) {
+    const c = characters.find(x => x.id === characterId);
+    if (!c) return;
+    c.avatar = avatarUrl;
+    delete c.avatar_pending;
+    renderCharacters(characters);
+}
+
+// 订阅某回合的图片与头像事件，服务端在图片就绪或超时时推送，无需轮询
+function subscribeImages(turnIndex, showLoading, retries = 2) {
+    if (imageEventSource) {
+        imageEventSource.close();
+        imageEventSource = null;
+    }
+    if (!window.EventSource) {
+        checkImage();
+        return;
+    }
+
+    if (showLoading) {
+        document.getElementById("image-container").style.display = "flex";
+        document.getElementById("image-loading").style.display = "flex";
+        startLoadingDots("image-dots");  // 图片 loading 省略号
+    }
+
+    const source = new EventSource(`/image_events/${turnIndex}`);
+    imageEventSource = source;
+    let ended = false;
+
+    source.addEventListener('image', e => {
+        const data = JSON.parse(e.data);
+        if (data.image) {
+            showStoryImage(data.image);
+        } else {
+            stopLoadingDots("image-dots");
+            document.getElementById("image-loading").style.display = "none";
+        }
+    });
+    source.addEventListener('avatar', e => {
+        const data = JSON.parse(e.data);
+        updateCharacterAvatar(data.id, data.avatar);
+    });
+    source.addEventListener('end', () => {
+        ended = true;
+        source.close();
+        if (imageEventSource === source) imageEventSource = null;
+    });
+    source.onerror = () => {
+        // 阻止浏览器无限自动重连，改为有限次数的重新订阅
+        source.close();
+        if (imageEventSource === source) imageEventSource = null;
+        if (!ended && retries > 0) {
+            setTimeout(() => subscribeImages(turnIndex, false, retries - 1), 3000);
+        }
+    };
+}
+
+// 不支持 EventSource 的浏览器：单次查询，未完成时退避重试
+function checkImage(delay = 2000) {
+    fetch('/get_image', { credentials: 'same-origin', cache: 'no-store' })
         .then(res => res.json())
         .then(data => {
             if (data.image) {
-                const img = document.getElementById("story-image");
-                img.src = data.image;
-                img.onload = () => {
-                    stopLoadingDots("image-dots");
-                    document.getElementById("image-loading").style.display = "none";
-                    img.style.display = 'block';
-                    // 淡入效果
-                    img.style.opacity = 0;
-                    setTimeout(() => {
-                        img.style.transition = "opacity 0.5s ease-in-out";
-                        img.style.opacity = 1;
-                    }, 50);
-                };
-
-                img.onerror = () => {
-                    console.error("[Polling] Failed to load image URL:", data.image);
-                    // document.getElementById("image-loading").textContent = "图片加载失败，重试中...";
-                    setTimeout(checkImage, 3000);
-                };
-            } else {
-                console.log("[Polling] No image yet, continuing to poll...");
-                setTimeout(checkImage, 2000);
+                showStoryImage(data.image);
+            } else if (delay <= 30000) {
+                setTimeout(() => checkImage(delay * 2), delay);
             }
         })
-        .catch(error => {
-            console.error("[Polling] Fetch error:", error);
-            // document.getElementById("image-loading").textContent = "检查图片中...";
-            setTimeout(checkImage, 3000);
-        });
+        .catch(error => console.error("[Image] Fetch error:", error));
 }
 
 // 初始化函数 - 页面加载完成后调用
@@ -359,6 +994,7 @@ function initializeGame(charactersData, storyData, imagePending, translations) {
         if (translations) {
             uiTranslations = translations;
         }
+        currentTurnIndex = storyData.turn_index;
 
         // 增强像素效果
         enhancePixelEffects();
@@ -372,10 +1008,11 @@ function initializeGame(charactersData, storyData, imagePending, translations) {
             storyText.textContent = '...';
         }
 
-        // 如果需要，开始检查图片
-        if (imagePending) {
-            setTimeout(checkImage, 1000);
-        } else {
+        // 如果需要，订阅图片与头像推送
+        if (imagePending || characters.some(c => c.avatar_pending)) {
+            subscribeImages(storyData.turn_index, imagePending);
+        }
+        if (!imagePending) {
             const imageContainer = document.getElementById("image-container");
             // Only hide if no image exists
             const img = document.getElementById("story-image");
@@ -0,0 +1,116 @@
+"""
+静态资源
+
+启动时读取 static 目录中登记的文件（页面引用的脚本与样式），按内容哈希生成带指纹的地址（main.js -> /assets/main.<hash>.js），
+并预先压缩为 gzip（安装了 brotli 时另有 br）。内容变化时地址随之变化，响应可以永久缓存
+（Cache-Control: immutable），重复访问页面不再重新验证或下载。
+
+除文件外也可以注册由程序生成的资源（如按语言拆分的界面文本），同样带指纹并预先压缩。
+不需要构建步骤；开发模式下 refresh() 按修改时间重新读取变化的文件。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，缺失时只提供 gzip
+    brotli = None
+
+# 小于该大小的资源不压缩
+ASSET_COMPRESS_MIN_BYTES = int(os.environ.get('ASSET_COMPRESS_MIN_BYTES', 512))
+# 指纹长度（十六进制字符）
+_HASH_LEN = 12
+
+_COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+_MIMETYPES = {'.js': 'text/javascript', '.css': 'text/css', '.json': 'application/json'}
+
+
+def fingerprinted_name(name, digest):
+    """a/main.js -> a/main.<digest>.js"""
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+
+class Asset:
+    __slots__ = ('name', 'url_name', 'mimetype', 'etag', 'bodies', 'mtime')
+
+    def __init__(self, name, data, mimetype=None, mtime=None):
+        ext = os.path.splitext(name)[1]
+        self.name = name
+        self.mimetype = mimetype or _MIMETYPES.get(ext) or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.etag = hashlib.sha256(data).hexdigest()[:_HASH_LEN]
+        self.url_name = fingerprinted_name(name, self.etag)
+        self.mtime = mtime
+        self.bodies = {'identity': data}
+        if len(data) >= ASSET_COMPRESS_MIN_BYTES and self.mimetype.startswith(_COMPRESSIBLE):
+            self.bodies['gzip'] = gzip.compress(data, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(data)
+            # 压缩后没有变小的编码不使用
+            for encoding in [e for e in self.bodies if e != 'identity']:
+                if len(self.bodies[encoding]) >= len(data):
+                    del self.bodies[encoding]
+
+    def negotiate(self, accept_encodings):
+        """按 br > gzip > 原文选择客户端接受的编码"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and accept_encodings[encoding] > 0:
+                return encoding
+        return 'identity'
+
+
+class AssetManifest:
+
+    def __init__(self, folder, names, url_prefix='/assets'):
+        """names 为 folder 中需要指纹与预压缩的文件；目录中的其他文件（如用户生成的图片）不读取"""
+        self.folder = folder
+        self.names = tuple(names)
+        self.url_prefix = url_prefix
+        self._assets = {}  # 逻辑名称 -> Asset
+        self._by_url = {}  # 带指纹的名称 -> Asset
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """重新读取修改过的文件，返回更新的个数"""
+        updated = 0
+        for name in self.names:
+            path = os.path.join(self.folder, *name.split('/'))
+            mtime = os.path.getmtime(path)
+            current = self._assets.get(name)
+            if current is not None and current.mtime == mtime:
+                continue
+            with open(path, 'rb') as f:
+                self.add(name, f.read(), mtime=mtime)
+            updated += 1
+        return updated
+
+    def add(self, name, data, mimetype=None, mtime=None):
+        """注册（或替换）一个资源，返回其地址"""
+        asset = Asset(name, data, mimetype, mtime)
+        with self._lock:
+            previous = self._assets.get(name)
+            if previous is not None and previous.url_name != asset.url_name:
+                self._by_url.pop(previous.url_name, None)
+            self._assets[name] = asset
+            self._by_url[asset.url_name] = asset
+        return f"{self.url_prefix}/{asset.url_name}"
+
+    def url(self, name):
+        """资源的带指纹地址；不存在时抛出 KeyError"""
+        return f"{self.url_prefix}/{self._assets[name].url_name}"
+
+    def get(self, url_name):
+        return self._by_url.get(url_name)
+
+    def stats(self):
+        with self._lock:
+            assets = list(self._assets.values())
+        totals = {}
+        for asset in assets:
+            for encoding, body in asset.bodies.items():
+                totals[encoding] = totals.get(encoding, 0) + len(body)
+        return {'assets': len(assets), 'bytes': totals}
@@ -0,0 +1,260 @@
+"""
+剧情上下文管理
+
+generate_story 不再发送完整故事：最近 N 回合原文保留，更早的回合折叠进滚动摘要。
+摘要在每回合结束后由后台线程更新，并按会话缓存；叙事阶段、已知角色、摘要与最近回合
+一起受同一个 token 预算约束，使每回合的 prompt 大小保持有界。
+"""
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 保留原文的最近回合数
+RECENT_TURNS = int(os.environ.get('STORY_CONTEXT_RECENT_TURNS', 4))
+# 上下文（含系统提示）总 token 预算
+TOKEN_BUDGET = int(os.environ.get('STORY_CONTEXT_TOKEN_BUDGET', 2500))
+# 滚动摘要的 token 上限
+SUMMARY_MAX_TOKENS = int(os.environ.get('STORY_SUMMARY_MAX_TOKENS', 500))
+# 多进程部署时共享摘要的保留时间，以及摘要任务租约的时长（秒，应长于一次摘要请求）
+SHARED_SUMMARY_TTL = float(os.environ.get('SHARED_SUMMARY_TTL', 24 * 3600))
+SHARED_SUMMARY_LEASE = float(os.environ.get('SHARED_SUMMARY_LEASE', 180))
+
+_CJK_RE = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日文约每字 1 token，其余约每 4 个字符 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def summary_matches(summary, history):
+    """摘要是否属于当前历史：覆盖的回合都还在，且最后一个回合的哈希相同（没有哈希的旧摘要只比较回合数）"""
+    upto = summary['upto']
+    if upto > len(history):
+        return False
+    if not upto or summary.get('h') is None:
+        return True
+    return history[upto - 1].get('h') == summary['h']
+
+
+def truncate_to_tokens(text, budget, keep_tail=True):
+    """把文本截断到 token 预算以内，默认保留结尾（较新的内容）"""
+    if budget <= 0:
+        return ""
+    if estimate_tokens(text) <= budget:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        part = text[-mid:] if keep_tail else text[:mid]
+        if estimate_tokens(part) + 1 <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    part = text[-lo:] if keep_tail else text[:lo]
+    return ("…" + part) if keep_tail else (part + "…")
+
+
+# (回合数上限, 阶段标识, 提示词中的阶段描述)；阶段标识用于模型路由（story:<阶段>）
+NARRATIVE_STAGES = (
+    (3, 'intro', "开场/介绍"),
+    (8, 'rising', "发展/冲突"),
+    (12, 'climax', "高潮/转折"),
+    (None, 'ending', "结局/收尾"),
+)
+
+
+def _stage(turn_count):
+    for limit, key, label in NARRATIVE_STAGES:
+        if limit is None or turn_count < limit:
+            return key, label
+
+
+def narrative_stage(turn_count):
+    """根据历史长度判断故事阶段"""
+    return _stage(turn_count)[1]
+
+
+def narrative_stage_key(turn_count):
+    return _stage(turn_count)[0]
+
+
+def format_turn(record):
+    action = record.get('player_action', '')
+    return f"【玩家行动】{action}\n【剧情】{record.get('new_text', '')}"
+
+
+class ContextManager:
+    """
+    按会话缓存滚动摘要，并在预算内组装剧情上下文。
+
+    摘要以 {'upto': k, 'text': ..., 'h': 第 k-1 回合的链式哈希} 表示，覆盖第 0..k-1 回合；
+    读取时只采用 h 与当前历史一致的摘要，新游戏、读档之后旧历史的摘要（包括仍在生成中的）不会混入。
+    client_factory(api_key) 用于在后台线程中创建 OpenAI 客户端，摘要模型由 router 的 story_summary 路由选择。
+    传入 shared（coordination.SharedStore）时摘要写入共享缓存，同一会话的摘要任务在所有进程中只有一个。
+    """
+
+    def __init__(self, client_factory, router, recent_turns=RECENT_TURNS, token_budget=TOKEN_BUDGET,
+                 summary_max_tokens=SUMMARY_MAX_TOKENS, max_workers=2, max_sessions=1024, shared=None):
+        self.client_factory = client_factory
+        self.router = router
+        self.shared = shared
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summary_max_tokens = summary_max_tokens
+        self.max_sessions = max_sessions
+        self._summaries = OrderedDict()
+        self._inflight = set()
+        self._generations = {}  # sid -> reset 次数，reset 之前开始的摘要任务不再写入
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='story-summary')
+
+    # ------- 摘要缓存 -------
+    def get_summary(self, sid, history, stored=None):
+        """返回缓存与 session 中与当前历史一致的最新摘要"""
+        with self._lock:
+            cached = self._summaries.get(sid)
+            if cached is not None:
+                self._summaries.move_to_end(sid)
+        shared = self.shared.get('summary', sid) if self.shared is not None else None
+        candidates = sorted((s for s in (cached, shared, stored) if s), key=lambda s: s['upto'], reverse=True)
+        for summary in candidates:
+            if summary_matches(summary, history):
+                return summary
+        return {'upto': 0, 'text': ''}
+
+    def _put_summary(self, sid, summary, generation=None):
+        with self._lock:
+            if generation is not None and self._generations.get(sid, 0) != generation:
+                # 任务开始后历史已被整体替换
+                return
+            current = self._summaries.get(sid)
+            if current is None or summary['upto'] >= current['upto']:
+                self._summaries[sid] = summary
+                self._summaries.move_to_end(sid)
+            while len(self._summaries) > self.max_sessions:
+                self._summaries.popitem(last=False)
+        if self.shared is not None:
+            self.shared.put('summary', sid, summary, ttl=SHARED_SUMMARY_TTL)
+
+    def reset(self, sid):
+        """历史被整体替换（开始新游戏 / 读档）时丢弃旧摘要，进行中的摘要任务结果也不再写入"""
+        with self._lock:
+            self._summaries.pop(sid, None)
+            self._generations[sid] = self._generations.get(sid, 0) + 1
+        if self.shared is not None:
+            self.shared.delete('summary', sid)
+
+    # ------- 上下文组装 -------
+    def build_messages(self, history, character_names, summary, reserved_tokens=0):
+        """
+        在 token 预算内组装上下文消息（不含系统提示与当前输入）。
+
+        优先级：最近一回合 > 已知角色 > 摘要 > 更早的原文回合。
+        character_names 按最近出场排序（最近的在最后）；reserved_tokens 为系统提示与当前输入已占用的 token。
+        """
+        budget = self.token_budget - reserved_tokens
+        turn_count = len(history)
+        window_start = max(0, turn_count - self.recent_turns)
+        # 摘要尚未追上时，把缺口中的回合也当作原文候选（较旧的先被裁掉）
+        verbatim_start = min(summary['upto'], window_start)
+        turns = [format_turn(rec) for rec in history[verbatim_start:turn_count]] if turn_count else []
+
+        latest = turns.pop() if turns else ""
+        latest = truncate_to_tokens(latest, max(budget // 2, 1))
+        budget -= estimate_tokens(latest)
+
+        # 角色过多时保留最近出现的角色
+        names = []
+        char_budget = max(min(budget // 4, 200), 1)
+        for name in reversed(character_names):
+            char_budget -= estimate_tokens(name) + 1
+            if char_budget < 0:
+                break
+            names.insert(0, name)
+        char_text = "已知角色：" + ("，".join(names) if names else "当前还没有已知角色。")
+        budget -= estimate_tokens(char_text)
+
+        summary_text = ""
+        if summary['text']:
+            summary_text = "此前剧情摘要：" + truncate_to_tokens(summary['text'], min(budget // 2, self.summary_max_tokens))
+            budget -= estimate_tokens(summary_text)
+
+        kept = []
+        for text in reversed(turns):
+            cost = estimate_tokens(text)
+            if cost > budget:
+                break
+            kept.append(text)
+            budget -= cost
+        kept.reverse()
+        if latest:
+            kept.append(latest)
+
+        messages = [{"role": "user", "content": char_text}]
+        if summary_text:
+            messages.append({"role": "user", "content": summary_text})
+        if kept:
+            messages.append({"role": "user", "content": "最近的剧情：\n\n" + "\n\n".join(kept)})
+        return messages
+
+    # ------- 后台摘要 -------
+    def schedule_summary(self, sid, api_key, history, summary):
+        """把滑出原文窗口的回合折叠进摘要；同一会话同时只有一个摘要任务"""
+        target = len(history) - self.recent_turns
+        if target <= summary['upto']:
+            return None
+        with self._lock:
+            if sid in self._inflight:
+                return None
+            self._inflight.add(sid)
+        lease = None
+        if self.shared is not None:
+            lease = self.shared.acquire(f"summary:{sid}", SHARED_SUMMARY_LEASE)
+            if lease is None:
+                # 其他进程正在为该会话生成摘要
+                with self._lock:
+                    self._inflight.discard(sid)
+                return None
+        # 在请求线程中取出需要折叠的回合，后台线程不访问 session
+        records = list(history[summary['upto']:target])
+        with self._lock:
+            generation = self._generations.get(sid, 0)
+        return self._executor.submit(self._summarize, sid, api_key, summary, records, target, generation, lease)
+
+    def _summarize(self, sid, api_key, summary, records, target, generation=0, lease=None):
+        try:
+            client = self.client_factory(api_key)
+            new_turns = "\n\n".join(format_turn(rec) for rec in records)
+            with metrics.span('story_summary'):
+                response = self.router.call('story_summary', lambda model, timeout: client.chat.completions.create(
+                    model=model,
+                    timeout=timeout,
+                    messages=[
+                        {"role": "system", "content": "你是文字冒险游戏的剧情记录员。请把已有摘要与新增剧情合并为一段简洁的剧情摘要，"
+                                                      "保留关键人物、地点、物品、未解决的伏笔和玩家的重要选择。使用与原文相同的语言，"
+                                                      f"不超过 {self.summary_max_tokens} 字。"},
+                        {"role": "user", "content": f"已有摘要：{summary['text'] or '（无）'}\n\n新增剧情：\n{new_turns}"},
+                    ],
+                    max_tokens=self.summary_max_tokens * 2,
+                ))
+            metrics.record_usage('story_summary', getattr(response, 'usage', None))
+            text = truncate_to_tokens(response.choices[0].message.content or "", self.summary_max_tokens)
+            self._put_summary(sid, {'upto': target, 'text': text, 'h': records[-1].get('h')}, generation)
+        except Exception as e:
+            logger.warning("Story summary update failed: %s", e)
+        finally:
+            with self._lock:
+                self._inflight.discard(sid)
+            if lease is not None:
+                self.shared.release(f"summary:{sid}", lease)
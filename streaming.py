@@ -0,0 +1,92 @@
+"""
+流式输出辅助工具
+
+- sse_event: 按 Server-Sent Events 格式编码事件
+- JsonStringFieldExtractor: 从模型逐段输出的 JSON 中增量解码某个字符串字段，
+  用于在结构化输出尚未完整时就把 story_text 推送给前端
+"""
+import json
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def sse_event(event, data):
+    """编码一条 SSE 事件，data 以 JSON 发送"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+class JsonStringFieldExtractor:
+    """
+    增量提取 JSON 顶层字符串字段的值。
+
+    每次 feed() 传入新到达的 JSON 片段，返回该字段新解码出的文本；
+    字段结束后 done 为 True，之后的输入被忽略。
+    """
+
+    def __init__(self, field):
+        self._key = json.dumps(field)
+        self._buffer = ""
+        self._pos = None  # 字段值在 buffer 中的当前解码位置
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return ""
+        self._buffer += chunk
+        if self._pos is None and not self._find_value_start():
+            return ""
+        return self._decode()
+
+    def _find_value_start(self):
+        key_at = self._buffer.find(self._key)
+        if key_at < 0:
+            return False
+        i = key_at + len(self._key)
+        while i < len(self._buffer) and self._buffer[i] in ' \t\r\n:':
+            i += 1
+        if i >= len(self._buffer):
+            return False
+        if self._buffer[i] != '"':
+            # 不是字符串值
+            self.done = True
+            return False
+        self._pos = i + 1
+        return True
+
+    def _decode(self):
+        out = []
+        buf = self._buffer
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch == '\\':
+                if i + 1 >= len(buf):
+                    break
+                esc = buf[i + 1]
+                if esc == 'u':
+                    if i + 6 > len(buf):
+                        break
+                    code = int(buf[i + 2:i + 6], 16)
+                    # 代理对需要等待后半部分
+                    if 0xD800 <= code < 0xDC00:
+                        if i + 12 > len(buf):
+                            break
+                        low = int(buf[i + 8:i + 12], 16)
+                        out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                        i += 12
+                        continue
+                    out.append(chr(code))
+                    i += 6
+                    continue
+                out.append(_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            out.append(ch)
+            i += 1
+        self._pos = i
+        return "".join(out)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+# 模块常量在收集测试、第一次导入时读取：测试按回合快速提交，关闭回合限流与开场剧情池
+# （与 bench/loadtest.py 的默认值一致）
+os.environ.setdefault('RATE_LIMIT_KEY_PER_MIN', '0')
+os.environ.setdefault('RATE_LIMIT_SESSION_PER_MIN', '0')
+os.environ.setdefault('OPENING_POOL_VARIANTS', '0')
+
+from fake_openai import FakeConfig, FakeOpenAIServer  # noqa: E402
+
+
+@pytest.fixture
+def fake_openai(request, monkeypatch):
+    """在后台线程中运行的 OpenAI 替身服务；用 @pytest.mark.fake_config(...) 传入 FakeConfig 参数"""
+    marker = request.node.get_closest_marker('fake_config')
+    config = FakeConfig(**dict({'jitter': 0}, **(marker.kwargs if marker else {})))
+    server = FakeOpenAIServer(config).start()
+    monkeypatch.setenv('OPENAI_BASE_URL', server.base_url)
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """导入 app，所有存储放在临时目录；app 在进程中只导入一次，之后的测试共用同一组存储"""
+    root = tmp_path_factory.mktemp('app')
+    with pytest.MonkeyPatch.context() as mp:
+        for name, filename in [('SESSION_DB_PATH', 'sessions.db'), ('IMAGE_STORE_DIR', 'images'),
+                               ('PROMPT_CACHE_PATH', 'prompt_cache.db'), ('OPENING_POOL_PATH', 'openings.db'),
+                               ('COORDINATION_DB_PATH', 'coordination.db'), ('SAVE_SLOTS_DB_PATH', 'save_slots.db')]:
+            mp.setenv(name, str(root / filename))
+        mp.setenv('LOG_LEVEL', 'WARNING')
+        import app
+        yield app
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'fake_config(**kwargs): FakeConfig arguments for the fake_openai fixture')
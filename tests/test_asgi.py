@@ -0,0 +1,21 @@
+import asyncio
+
+import pytest
+
+
+def test_key_limiter_caps_concurrent_requests_per_key(app_module):
+    import asgi
+
+    limiter = asgi.KeyLimiter(limit=1, timeout=0.05)
+
+    async def run():
+        async with limiter.slot('sk-a'):
+            # 同一个 Key 的第二个请求排队超时；其他 Key 不受影响
+            with pytest.raises(asgi.KeyBusy):
+                async with limiter.slot('sk-a'):
+                    pass
+            async with limiter.slot('sk-b'):
+                assert limiter.stats() == {'keys': 2, 'requests': 2}
+        assert limiter.stats() == {'keys': 0, 'requests': 0}
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+from openai_clients import AsyncClientRegistry
+
+URL = '/images/' + 'a' * 40 + '.webp'
+
+
+class RecordingCache:
+    """记录每次缓存读写所在线程的 PromptCache 替身"""
+
+    def __init__(self, values):
+        self.values = values
+        self.threads = []
+
+    def get(self, stage, key):
+        self.threads.append(threading.current_thread())
+        return self.values.get(stage)
+
+    def put(self, stage, key, value):
+        self.threads.append(threading.current_thread())
+
+    def discard(self, stage, key):
+        self.threads.append(threading.current_thread())
+
+
+def test_prompt_cache_runs_off_the_event_loop(app_module, monkeypatch):
+    cache = RecordingCache({'rewrite': 'a castle', 'image': URL})
+    monkeypatch.setattr(app_module, 'prompt_cache', cache)
+    monkeypatch.setattr(app_module, 'async_openai_clients', AsyncClientRegistry())
+    monkeypatch.setattr(app_module.image_store, 'has', lambda url: url == URL)
+
+    async def run():
+        return (await app_module.agenerate_image('castle', 'story', 'sk-test'),
+                await app_module.agenerate_avatar('knight', 'sk-test'),
+                threading.current_thread())
+
+    scene, avatar, loop_thread = asyncio.run(run())
+    assert scene == avatar == URL
+    assert len(cache.threads) == 4
+    assert loop_thread not in cache.threads
@@ -0,0 +1,46 @@
+from character_registry import CharacterRegistry, index_characters, similar_names
+
+
+def appearance(char_id, name, event=''):
+    return {'id': char_id, 'name': name, 'desc': 'd', 'detail': '', 'event': event}
+
+
+def test_same_character_under_new_id_becomes_an_alias():
+    registry = CharacterRegistry({})
+    emily, created = registry.upsert(appearance('emily', '艾米丽·史密斯', '出场'), turn=0)
+    assert created
+
+    record, created = registry.upsert(appearance('emily_2', '艾米丽', '道别'), turn=3)
+    assert record is emily and not created
+    assert emily['aliases'] == ['emily_2'] and registry.get('emily_2') is emily
+    assert emily['events'] == ['出场', '道别']
+    assert list(registry.records) == ['emily']
+    assert [c['id'] for c in registry.changed_records()] == ['emily']
+
+
+def test_similar_names():
+    assert similar_names('Emily Smith', 'emily  smith')
+    assert similar_names('Alexander', 'Alexandre')
+    # 短名称差一个字往往就是另一个人
+    assert not similar_names('小明', '小红')
+    assert not similar_names('', 'Emily')
+
+
+def test_events_are_folded_into_a_bounded_summary():
+    registry = CharacterRegistry({}, event_cap=4, summary_chars=20)
+    for turn in range(20):
+        record, _ = registry.upsert(appearance('c1', 'Ann', f'事件{turn}'), turn=turn)
+
+    assert len(record['events']) <= 4 and record['events'][-1] == '事件19'
+    assert len(record['event_summary']) <= 20 and record['event_summary'].startswith('…')
+    # 重复的事件不再追加
+    registry.add_event(record, '事件19', 20)
+    assert record['events'].count('事件19') == 1
+
+
+def test_old_list_is_indexed_by_id():
+    records = index_characters([{'id': 'a', 'name': 'Ann', 'events': ['x']},
+                                {'id': 'b', 'name': 'Bob', 'events': []},
+                                {'id': 'a', 'name': 'Ann', 'events': ['y']}])
+    assert list(records) == ['a', 'b'] and records['a']['events'] == ['x', 'y']
+    assert CharacterRegistry(records).names() == ['Ann', 'Bob']
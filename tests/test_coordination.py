@@ -0,0 +1,109 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from coordination import SharedStore, stable_secret_key
+from key_validation import KeyValidator
+from turn_guard import RateLimiter, TurnCoalescer, TurnConflict
+
+
+@pytest.fixture
+def stores(tmp_path):
+    """同一个文件上的两个 SharedStore，相当于两个 worker 进程"""
+    path = str(tmp_path / 'coordination.db')
+    return SharedStore(path, poll_interval=0.02), SharedStore(path, poll_interval=0.02)
+
+
+def test_leases_are_exclusive_until_released_or_expired(stores):
+    a, b = stores
+    token = a.acquire('image:x', 60, holder='worker-a')
+    assert token and b.acquire('image:x', 60) is None
+    assert b.holder('image:x') == 'worker-a'
+
+    b.release('image:x', 'not-the-token')
+    assert b.holder('image:x') == 'worker-a'
+    a.release('image:x', token)
+    assert b.holder('image:x') is None
+
+    assert a.acquire('image:y', 0.05)
+    time.sleep(0.1)
+    assert b.acquire('image:y', 60)
+
+
+def test_cache_entries_expire(stores):
+    a, b = stores
+    a.put('summary', 's1', {'text': 'hi'}, ttl=0.05)
+    assert b.get('summary', 's1') == {'text': 'hi'}
+    time.sleep(0.1)
+    assert b.get('summary', 's1') is None
+    assert stable_secret_key(a) == stable_secret_key(b)
+    assert stable_secret_key(a, 'configured') == 'configured'
+
+
+def test_alock_does_not_block_the_event_loop(stores):
+    store, _ = stores
+    held = threading.Event()
+
+    def hold_write_lock():
+        # 另一个进程长时间持有写锁
+        conn = sqlite3.connect(store.path)
+        conn.execute('BEGIN IMMEDIATE')
+        held.set()
+        time.sleep(0.5)
+        conn.rollback()
+        conn.close()
+
+    threading.Thread(target=hold_write_lock).start()
+    held.wait(5)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.02)
+                ticks += 1
+
+        task = asyncio.ensure_future(ticker())
+        async with store.alock('image:x', 5, 2) as locked:
+            assert locked
+        task.cancel()
+        return ticks
+
+    assert asyncio.run(run()) >= 10
+
+
+def test_rate_limit_buckets_are_shared(stores):
+    a, b = (RateLimiter(per_minute=6, burst=2, shared=store, name='key') for store in stores)
+    assert a.acquire('sk') == 0
+    assert b.acquire('sk') == 0
+    assert a.acquire('sk') > 0 and b.acquire('sk') > 0
+
+
+def test_duplicate_turn_on_another_worker_waits_for_the_result(stores):
+    a, b = TurnCoalescer(shared=stores[0]), TurnCoalescer(shared=stores[1])
+    claim, leader = a.claim('s', 3, 'go')
+    remote, remote_leader = b.claim('s', 3, 'go')
+    assert leader and not remote_leader
+    with pytest.raises(TurnConflict):
+        b.claim('s', 3, 'other')
+
+    threading.Timer(0.1, claim.resolve, [{'text': 'hi'}]).start()
+    assert remote.wait(5) == {'text': 'hi'}
+    assert b.replay('s', 3, 'go') == {'text': 'hi'}
+
+
+def test_key_validation_is_shared_between_workers(stores):
+    calls = []
+    models = SimpleNamespace(retrieve=lambda model: calls.append(model))
+    a, b = (KeyValidator(lambda api_key: SimpleNamespace(models=models), mode='light', shared=store)
+            for store in stores)
+
+    assert a.validate('sk-x') == (True, None)
+    assert b.validate('sk-x') == (True, None)
+    assert len(calls) == 1 and b.stats()['shared_hits'] == 1
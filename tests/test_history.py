@@ -0,0 +1,48 @@
+def start_game(app_module, count):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['api_key'] = 'sk-test'
+        session['characters'] = []
+        session['history'] = [{'new_text': f'turn {i}', 'options': ['a'], 'player_action': f'act {i}' if i else None,
+                               'image': None} for i in range(count)]
+    return client
+
+
+def test_history_pages_walk_back_to_the_start(app_module):
+    client = start_game(app_module, 25)
+
+    page = client.get('/history?limit=10').get_json()
+    assert (page['start'], page['total'], page['next_cursor']) == (20, 25, 20)
+    assert [t['index'] for t in page['turns']] == list(range(20, 25))
+    assert page['turns'][0]['text'] == 'turn 20' and page['turns'][0]['action'] == 'act 20'
+
+    indexes = []
+    cursor = page['next_cursor']
+    while cursor is not None:
+        page = client.get(f'/history?limit=10&before={cursor}').get_json()
+        indexes = [t['index'] for t in page['turns']] + indexes
+        cursor = page['next_cursor']
+    assert indexes == list(range(20))
+
+
+def test_history_revalidates_with_etag(app_module):
+    client = start_game(app_module, 3)
+
+    response = client.get('/history?before=3')
+    assert response.status_code == 200 and 'no-cache' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert client.get('/history?before=3', headers={'If-None-Match': etag}).status_code == 304
+
+    # 新游戏后同一地址对应不同的回合
+    client = start_game(app_module, 3)
+    with client.session_transaction() as session:
+        session['history'].update(2, new_text='another story')
+    assert client.get('/history?before=3', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_single_turn(app_module):
+    client = start_game(app_module, 3)
+
+    assert client.get('/history/1').get_json()['text'] == 'turn 1'
+    assert client.get('/history/3').status_code == 404
+    assert app_module.app.test_client().get('/history').status_code == 401
@@ -0,0 +1,115 @@
+import json
+import threading
+
+from flask import session
+
+URL = '/images/' + 'c' * 40 + '.webp'
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n') if not line.startswith(':'))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def start_game(app_module, **record):
+    client = app_module.app.test_client()
+    with client.session_transaction() as stored:
+        stored['api_key'] = 'sk-test'
+        stored['characters'] = []
+        stored['history'] = [dict({'new_text': '开场', 'options': ['a'], 'player_action': None}, **record)]
+    return client
+
+
+def pending_turn(job_id):
+    return {'new_text': 't', 'options': [], 'player_action': None, 'h': 'h0',
+            'image': None, 'image_pending': True, 'image_prompt': 'a castle', 'image_job': job_id}
+
+
+def test_image_event_is_pushed_when_the_job_finishes(app_module):
+    release = threading.Event()
+    job = app_module.image_jobs.submit('image', None, lambda: release.wait(5) and URL)
+    client = start_game(app_module, image=None, image_pending=True, image_prompt='a castle', image_job=job.id)
+
+    status = client.get('/image_status/0').get_json()
+    assert status['image_pending'] and status['job']['id'] == job.id
+
+    threading.Timer(0.2, release.set).start()
+    events = parse_events(client.get('/image_events/0').get_data(as_text=True))
+
+    assert events == [('image', {'turn_index': 0, 'image': URL}), ('end', {})]
+    assert client.get('/image_status/0').get_json()['image'] == URL
+
+
+def test_turn_without_job_or_prompt_gets_the_placeholder(app_module):
+    client = start_game(app_module, image=None, image_pending=True)
+
+    events = parse_events(client.get('/image_events/0').get_data(as_text=True))
+
+    assert events[0] == ('image', {'turn_index': 0, 'image': app_module.SCENE_PLACEHOLDER})
+    assert client.get('/image_status/0').get_json()['image_pending'] is False
+
+
+def test_unknown_turn_is_rejected(app_module):
+    client = start_game(app_module, image=URL, image_pending=False)
+
+    assert client.get('/image_events/3').status_code == 404
+    assert parse_events(client.get('/image_events/0').get_data(as_text=True))[0][1]['image'] == URL
+
+
+def test_scene_job_running_on_another_worker_is_not_requeued(app_module):
+    with app_module.app.test_request_context('/image_status/0'):
+        session['api_key'] = 'sk-test'
+        session['history'] = [pending_turn('remote-job')]
+        lease = app_module.shared_store.acquire(app_module.image_job_lease('remote-job'), 60)
+        try:
+            assert app_module.ensure_scene_job(0) is None
+            assert session['history'][0]['image_job'] == 'remote-job'
+        finally:
+            app_module.shared_store.release(app_module.image_job_lease('remote-job'), lease)
+
+        # 持有租约的进程已退出：用保存的 prompt 重新排队
+        job = app_module.ensure_scene_job(0)
+        assert job is not None
+        assert session['history'][0]['image_job'] == job.id
+        assert app_module.scene_job_elsewhere(session['history'][0]) is False
+        session.discard_changes()
+
+
+def test_turn_payload_hides_avatar_job_ids(app_module):
+    with app_module.app.test_request_context('/next_step'):
+        session['api_key'] = 'sk-test'
+        session['history'] = [pending_turn('job-1')]
+        session['characters'] = {'c1': {'id': 'c1', 'name': 'Ann', 'desc': '', 'detail': '', 'events': [],
+                                        'avatar': app_module.AVATAR_PLACEHOLDER, 'avatar_job': 'job-2'}}
+        registry = app_module.character_registry()
+        registry.mark_changed(registry.get('c1'))
+
+        payload = app_module.build_turn_payload(session['history'][0])
+        # 会话中的记录仍保留任务 ID，供写回时核对
+        assert registry.get('c1')['avatar_job'] == 'job-2'
+        session.discard_changes()
+
+    changed, = payload['characters_changed']
+    assert 'avatar_job' not in changed and changed['avatar_pending'] is True
+
+
+def test_avatar_from_another_worker_is_merged_after_overwrite(app_module):
+    url = '/images/' + 'b' * 40 + '.thumb.webp'
+    # 其他 worker 完成了任务，但其写回已被本请求之前读取的整份会话数据覆盖
+    app_module.shared_store.put('avatar_result', 'remote-avatar', url)
+    characters = {
+        'c1': {'id': 'c1', 'name': 'Ann', 'avatar': app_module.AVATAR_PLACEHOLDER, 'avatar_job': 'remote-avatar'},
+        # 任务与租约都已不在（进程重启）：不再等待，改用占位图
+        'c2': {'id': 'c2', 'name': 'Bob', 'avatar': app_module.AVATAR_PLACEHOLDER, 'avatar_job': 'lost-avatar'},
+    }
+    with app_module.app.test_request_context('/game'):
+        session['api_key'] = 'sk-test'
+        session['characters'] = characters
+        app_module.apply_finished_jobs()
+        session.discard_changes()
+
+    assert characters['c1'] == {'id': 'c1', 'name': 'Ann', 'avatar': url}
+    assert characters['c2'] == {'id': 'c2', 'name': 'Bob', 'avatar': app_module.AVATAR_PLACEHOLDER}
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from flask import session
+
+URL = '/images/' + 'd' * 40 + '.webp'
+
+
+def test_direct_pipeline_renders_the_story_prompt_once(app_module, monkeypatch):
+    submitted = []
+
+    def submit(kind, key, fn, *args, **kwargs):
+        submitted.append((fn, args))
+        return SimpleNamespace(id='pipeline-job')
+    monkeypatch.setattr(app_module.image_jobs, 'submit', submit)
+    with app_module.app.test_request_context('/next_step'):
+        session['api_key'] = 'sk-test'
+        session['settings'] = {'theme': '科幻', 'style': '冷峻'}
+        app_module.enqueue_scene_image(0, 'a ruined space station', 'h0')
+        session.discard_changes()
+
+    (fn, (prompt, kind, api_key)), = submitted
+    # 不再附带完整故事做改写，画面描述套用按游戏设定生成的模板
+    assert fn is app_module.render_direct and (kind, api_key) == ('scene', 'sk-test')
+    assert prompt.startswith('a ruined space station') and '科幻' in prompt and '冷峻' in prompt
+
+    rendered = []
+    monkeypatch.setattr(app_module, 'render_image', lambda client, img_prompt, kind: rendered.append(img_prompt) or URL)
+    assert app_module.render_direct(prompt, 'scene', 'sk-test') == URL
+    assert rendered == [prompt]
+
+
+def test_direct_pipeline_falls_back_to_placeholder(app_module, monkeypatch):
+    def fail(client, img_prompt, kind):
+        raise RuntimeError('upstream error')
+    monkeypatch.setattr(app_module, 'render_image', fail)
+
+    assert app_module.render_direct('a knight', 'avatar', 'sk-test') == app_module.AVATAR_PLACEHOLDER
+    assert app_module.render_direct('a castle', 'scene', 'sk-test') == app_module.SCENE_PLACEHOLDER
@@ -0,0 +1,56 @@
+import io
+import os
+
+import pytest
+
+from image_store import ImageStore, extract_image_hashes
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def png(color, size=(640, 480)):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, 'PNG')
+    return out.getvalue()
+
+
+def test_same_image_is_stored_once(tmp_path):
+    store = ImageStore(str(tmp_path))
+    url = store.put(png('red'))
+
+    assert store.put(png('red')) == url
+    assert len(os.listdir(tmp_path)) == 1
+    name = url.rsplit('/', 1)[1]
+    assert url.startswith('/images/') and store.path_for(name) is not None
+    assert extract_image_hashes(f'{{"image": "{url}"}}') == {name.split('.')[0]}
+
+
+def test_avatar_gets_a_square_thumbnail(tmp_path):
+    store = ImageStore(str(tmp_path))
+    url = store.put(png('blue', (800, 400)), kind='avatar')
+
+    name = url.rsplit('/', 1)[1]
+    assert '.thumb.' in name
+    with Image.open(store.path_for(name)) as thumb:
+        assert thumb.size == (200, 200)
+    assert store.etag_for(name).endswith('-thumb')
+
+
+def test_path_for_rejects_unexpected_names(tmp_path):
+    store = ImageStore(str(tmp_path))
+    assert store.path_for('../secret.png') is None
+    assert store.path_for('a' * 40 + '.png') is None
+
+
+def test_collect_removes_unreferenced_images_over_quota(tmp_path):
+    kept = set()
+    store = ImageStore(str(tmp_path), min_age=0, referenced=lambda: kept)
+    keep = store.put(png('green'))
+    drop = store.put(png('yellow'))
+    kept.add(keep.rsplit('/', 1)[1].split('.')[0])
+
+    store.quota_bytes = 0
+    assert store.collect() == 1
+
+    assert store.path_for(keep.rsplit('/', 1)[1]) is not None
+    assert store.path_for(drop.rsplit('/', 1)[1]) is None
@@ -0,0 +1,45 @@
+import threading
+
+from jobs import DONE, FAILED, JobQueue
+
+
+def test_job_runs_in_background_and_writes_back():
+    jobs = JobQueue(workers=2)
+    written = []
+    job = jobs.submit('image', 'k', lambda x: x * 2, 21, on_done=lambda j: written.append(j.result))
+
+    assert job.wait(5)
+    assert job.status == DONE and job.result == 42
+    assert written == [42]
+    assert jobs.get(job.id) is job
+    assert jobs.get(None) is None
+
+
+def test_same_key_reuses_the_job_until_it_fails():
+    jobs = JobQueue(workers=1)
+    release = threading.Event()
+    first = jobs.submit('image', 'k', release.wait, 5)
+    assert jobs.submit('image', 'k', release.wait, 5) is first
+    release.set()
+    assert first.wait(5)
+    assert jobs.submit('image', 'k', release.wait, 5) is first
+
+    def fail():
+        raise RuntimeError('boom')
+
+    failed = jobs.submit('image', 'other', fail)
+    assert failed.wait(5) and failed.status == FAILED and failed.error == 'boom'
+    retry = jobs.submit('image', 'other', lambda: 'ok')
+    assert retry is not failed
+    assert retry.wait(5) and retry.result == 'ok'
+
+
+def test_deferred_job_waits_for_start():
+    jobs = JobQueue(workers=1)
+    job = jobs.submit('avatar', 'k', lambda: 'done', defer=True)
+
+    assert not job.wait(0.2)
+    jobs.start(job)
+    jobs.start(job)
+    assert job.wait(5) and job.result == 'done'
+    assert jobs.stats()[DONE] == 1
@@ -0,0 +1,87 @@
+import threading
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+from key_validation import KeyValidator
+
+
+def api_error(cls, status):
+    response = httpx.Response(status, request=httpx.Request('GET', 'https://api.example/v1/models/x'))
+    return cls('error', response=response, body=None)
+
+
+class FakeModels:
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def retrieve(self, model):
+        self.calls += 1
+        self.release.wait(5)
+        outcome = self.outcomes.get(model) if isinstance(self.outcomes, dict) else self.outcomes
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    list = retrieve
+
+
+def validator_for(models, **kwargs):
+    return KeyValidator(lambda api_key: SimpleNamespace(models=models), mode='light', **kwargs)
+
+
+def test_valid_and_invalid_results_are_cached():
+    models = FakeModels(None)
+    validator = validator_for(models)
+    assert validator.validate('sk-good') == (True, None)
+    assert validator.validate('sk-good') == (True, None)
+    assert models.calls == 1
+
+    models.outcomes = api_error(openai.AuthenticationError, 401)
+    ok, error = validator.validate('sk-bad')
+    assert not ok and error
+    assert validator.validate('sk-bad')[0] is False
+    assert models.calls == 2
+    assert validator.stats()['hits'] == 2
+
+
+def test_transient_errors_are_not_cached():
+    models = FakeModels(api_error(openai.InternalServerError, 500))
+    validator = validator_for(models)
+
+    assert validator.validate('sk-x')[0] is False
+    models.outcomes = None
+    assert validator.validate('sk-x') == (True, None)
+    assert models.calls == 2
+
+
+def test_missing_model_still_means_the_key_works():
+    validator = validator_for(FakeModels(api_error(openai.NotFoundError, 404)))
+    assert validator.validate('sk-x') == (True, None)
+
+
+def test_concurrent_checks_of_one_key_share_a_request():
+    models = FakeModels(None)
+    models.release.clear()
+    validator = validator_for(models)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(validator.validate('sk-x'))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    threading.Timer(0.2, models.release.set).start()
+    for t in threads:
+        t.join(5)
+
+    assert results == [(True, None)] * 5
+    assert models.calls == 1
+
+
+def test_off_mode_skips_the_network():
+    models = FakeModels(api_error(openai.AuthenticationError, 401))
+    validator = KeyValidator(lambda api_key: SimpleNamespace(models=models), mode='off')
+    assert validator.validate('sk-x') == (True, None)
+    assert models.calls == 0
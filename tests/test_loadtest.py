@@ -0,0 +1,90 @@
+"""
+在进程内对 app 运行小规模压测（bench/loadtest.py），覆盖开局、回合（经模型路由）、会话存储、
+历史分页与存档读档的完整流程。
+
+app 由 app_module 夹具导入，各次运行共用同一个 app 与存储目录；异步服务模式会切换 app 的图片任务，
+放在最后运行。
+"""
+import logging
+
+import pytest
+
+from bench import loadtest
+from model_router import MODEL_FALLBACKS
+from story_context import TOKEN_BUDGET
+
+PLAYERS = 3
+TURNS = 6
+# 剧情路由改发下一层模型的原因（客户端错误不会降级）
+FALLBACK_REASONS = ('hedge', 'timeout', 'rate_limited', 'error')
+
+
+@pytest.fixture(scope='module', autouse=True)
+def bench_env(app_module):
+    yield
+    logging.disable(logging.NOTSET)
+
+
+def story_fallbacks():
+    return sum(MODEL_FALLBACKS.value(route='story', reason=reason) for reason in FALLBACK_REASONS)
+
+
+def run(*argv):
+    args = loadtest.build_parser().parse_args([
+        '--players', str(PLAYERS), '--turns', str(TURNS), '--no-save',
+        '--story-latency', '0.05', '--chat-latency', '0.02', '--image-latency', '0.1', *argv,
+    ])
+    fallbacks = story_fallbacks()
+    result = loadtest.run(args)
+    result['fallbacks'] = story_fallbacks() - fallbacks
+    logging.disable(logging.NOTSET)
+    return result
+
+
+def check(result, turn_endpoint):
+    assert result['errors'] == {}
+    endpoints = result['endpoints']
+    assert endpoints[turn_endpoint]['count'] == PLAYERS * TURNS
+    for name in ('/start', '/game', '/history', '/save', '/load'):
+        assert endpoints[name]['count'] >= PLAYERS, name
+    # 开场剧情 + 每回合一次剧情调用；对冲或超时后改发下一层模型的请求另计
+    assert 0 <= result['story_calls'] - PLAYERS * (TURNS + 1) <= result['fallbacks']
+    assert result['openai_calls']['models.retrieve'] == PLAYERS
+    # 每回合都有会话数据写入存储
+    assert len(result['per_turn']['session_bytes']) == TURNS + 1
+
+
+def test_json_turns():
+    result = run('--mode', 'json')
+    check(result, '/next_step')
+    # 旧回合折叠进摘要后 prompt 受上下文预算约束，不随回合增长
+    assert max(result['per_turn']['prompt_tokens'].values()) <= TOKEN_BUDGET * 1.1
+
+
+def test_html_turns():
+    check(run('--mode', 'html'), '/next_step')
+
+
+def test_stream_turns():
+    check(run('--mode', 'stream'), '/next_step_stream')
+
+
+def test_speculative_turns(app_module, monkeypatch):
+    # app 已由夹具导入，--speculate 只能改写已有的预生成器
+    monkeypatch.setattr(app_module.speculator, 'top_k', 2)
+    result = run('--mode', 'json', '--speculate', '2')
+    assert result['errors'] == {}
+    assert result['endpoints']['/next_step']['count'] == PLAYERS * TURNS
+    speculation = result['app']['speculation']
+    assert speculation['started'] > 0
+    assert speculation['hits'] + speculation['misses'] > 0
+
+
+def test_json_turns_asgi():
+    pytest.importorskip('uvicorn')
+    check(run('--mode', 'json', '--asgi'), '/next_step')
+
+
+def test_stream_turns_asgi():
+    pytest.importorskip('uvicorn')
+    check(run('--mode', 'stream', '--asgi'), '/next_step_stream')
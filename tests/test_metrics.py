@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+
+
+def test_render_counter_and_histogram():
+    registry = metrics.Registry()
+    calls = registry.register(metrics.Counter('test_calls_total', 'Calls.', ['kind']))
+    seconds = registry.register(metrics.Histogram('test_seconds', 'Latency.', buckets=(0.1, 1)))
+    calls.inc(kind='a')
+    calls.inc(2, kind='a')
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE ai_adventure_test_calls_total counter' in lines
+    assert 'ai_adventure_test_calls_total{kind="a"} 3' in lines
+    assert 'ai_adventure_test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'ai_adventure_test_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'ai_adventure_test_seconds_count 2' in lines
+    with pytest.raises(ValueError):
+        calls.inc(other='x')
+
+
+def test_span_counts_errors_and_usage_accepts_both_apis():
+    with pytest.raises(RuntimeError):
+        with metrics.span('test_failing'):
+            raise RuntimeError('boom')
+    assert metrics.SPAN_ERRORS.value(span='test_failing') == 1
+
+    metrics.record_usage('test_call', SimpleNamespace(input_tokens=10, output_tokens=3))
+    metrics.record_usage('test_call', SimpleNamespace(prompt_tokens=5, completion_tokens=2))
+    metrics.record_usage('test_call', None)
+    assert metrics.LLM_CALLS.value(call='test_call') == 3
+    assert metrics.LLM_TOKENS.value(call='test_call', direction='input') == 15
+    assert metrics.LLM_TOKENS.value(call='test_call', direction='output') == 5
+
+
+def test_metrics_endpoint(app_module):
+    client = app_module.app.test_client()
+    client.get('/metrics')
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'ai_adventure_http_request_seconds_count{endpoint="/metrics",method="GET",status="200"}' in body
+    assert '# TYPE ai_adventure_image_job_queue_depth gauge' in body
@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+import pytest
+
+from model_router import ModelRouter
+from openai_clients import AsyncClientRegistry, ClientRegistry
+
+ROUTES = {'story': {'models': ['primary', 'fallback'], 'timeout': 5, 'hedge_after': 0}}
+
+
+class ClientError(Exception):
+    status_code = 400
+
+
+def failing(*broken, error=ConnectionError):
+    calls = []
+
+    def fn(model, timeout):
+        calls.append(model)
+        if model in broken:
+            raise error('upstream error')
+        return model
+    fn.calls = calls
+    return fn
+
+
+def test_errors_fall_back_to_the_next_tier():
+    router = ModelRouter(routes=ROUTES)
+    fn = failing('primary')
+
+    assert router.call('story', fn) == 'fallback'
+    assert fn.calls == ['primary', 'fallback']
+
+    async def afn(model, timeout):
+        return fn(model, timeout)
+    assert asyncio.run(router.acall('story', afn)) == 'fallback'
+    assert fn.calls == ['primary', 'fallback', 'primary', 'fallback']
+
+
+def test_client_errors_are_not_retried_on_another_model():
+    router = ModelRouter(routes=ROUTES)
+    fn = failing('primary', error=ClientError)
+
+    with pytest.raises(ClientError):
+        router.call('story', fn)
+    assert fn.calls == ['primary']
+
+
+def test_failing_model_is_demoted():
+    router = ModelRouter(routes=ROUTES, min_samples=2, error_threshold=0.5, cooldown=60)
+    for _ in range(2):
+        router.call('story', failing('primary'))
+
+    assert router.plan('story') == ['fallback', 'primary']
+    assert router.stats()['primary']['demoted']
+
+
+def test_slow_primary_is_hedged():
+    router = ModelRouter(routes={'story': dict(ROUTES['story'], hedge_after=0.05)})
+
+    def fn(model, timeout):
+        if model == 'primary':
+            time.sleep(1)
+        return model
+
+    start = time.monotonic()
+    assert router.call('story', fn) == 'fallback'
+    assert time.monotonic() - start < 0.9
+
+
+def test_stage_routes_inherit_from_their_call_type():
+    router = ModelRouter(routes={'story': {'timeout': 10}, 'story:climax': {'models': ['big']}})
+
+    assert router.resolve('story', 'climax') == 'story:climax'
+    assert router.resolve('story', 'intro') == 'story'
+    assert router.routes['story:climax'].timeout == 10
+    assert router.routes['story:climax'].models == ['big']
+
+
+HUNG_ROUTES = {'story': {'models': ['hung-model', 'gpt-4o-mini'], 'timeout': 2, 'hedge_after': 0}}
+HUNG = pytest.mark.fake_config(chat_latency=0.05, model_latency={'hung-model': 10})
+
+
+def chat(client):
+    return lambda model, timeout: client.chat.completions.create(
+        model=model, messages=[{"role": "user", "content": "hi"}], timeout=timeout)
+
+
+@HUNG
+def test_hung_primary_falls_back_within_budget(fake_openai):
+    router = ModelRouter(routes=HUNG_ROUTES)
+    client = ClientRegistry(max_retries=0).get('sk-test')
+
+    start = time.monotonic()
+    response = router.call('story', chat(client))
+
+    assert response.model == 'gpt-4o-mini'
+    assert time.monotonic() - start < HUNG_ROUTES['story']['timeout']
+
+
+@HUNG
+def test_hung_primary_falls_back_within_budget_async(fake_openai):
+    router = ModelRouter(routes=HUNG_ROUTES)
+
+    async def run():
+        registry = AsyncClientRegistry(max_retries=0)
+        try:
+            return await router.acall('story', chat(registry.get('sk-test')))
+        finally:
+            await registry.aclose()
+
+    start = time.monotonic()
+    response = asyncio.run(run())
+
+    assert response.model == 'gpt-4o-mini'
+    assert time.monotonic() - start < HUNG_ROUTES['story']['timeout']
+
+
+@pytest.mark.fake_config(model_latency={'hung-model': 10})
+def test_all_tiers_hung_raises_at_deadline(fake_openai):
+    router = ModelRouter(routes={'story': {'models': ['hung-model'], 'timeout': 1, 'hedge_after': 0}})
+    client = ClientRegistry(max_retries=0).get('sk-test')
+
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        router.call('story', chat(client))
+    assert time.monotonic() - start < 1.5
+
+
+def test_last_tier_is_retried_after_errors():
+    router = ModelRouter(routes={'image': {'models': ['m'], 'timeout': 5}}, retries=1)
+    calls = []
+
+    def flaky(model, timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            raise ConnectionError('reset')
+        return model
+
+    assert router.call('image', flaky) == 'm'
+    assert len(calls) == 2
+
+
+def test_stream_attempts_leave_time_for_fallback():
+    router = ModelRouter(routes=HUNG_ROUTES, retries=0)
+    attempts = list(router.attempts('story'))
+    assert attempts[0].timeout <= HUNG_ROUTES['story']['timeout'] / 2 + 0.01
+    assert attempts[-1].timeout > HUNG_ROUTES['story']['timeout'] / 2
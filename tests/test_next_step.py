@@ -0,0 +1,38 @@
+import pytest
+
+STORY = {'text': '门开了。', 'options': ['进去', '离开'], 'image_pending': False, 'image_content': None,
+         'new_character': None}
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'generate_story', lambda user_input: dict(STORY))
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['api_key'] = 'sk-test'
+        session['characters'] = []
+        session['history'] = [{'new_text': '你站在门前。', 'options': ['开门'], 'player_action': None}]
+    return client
+
+
+def test_json_response_contains_only_the_new_turn(client):
+    response = client.post('/next_step', data={'branch_choice': '开门'}, headers={'Accept': 'application/json'})
+
+    payload = response.get_json()
+    assert payload['success'] is True
+    assert payload['turn_index'] == 1
+    assert payload['text'] == '门开了。' and payload['options'] == ['进去', '离开']
+    assert payload['image_pending'] is False
+    assert '你站在门前' not in response.get_data(as_text=True)
+
+
+def test_format_query_selects_json(client):
+    response = client.post('/next_step?format=json', data={'branch_choice': '开门'})
+    assert response.mimetype == 'application/json'
+
+
+def test_plain_form_submit_still_renders_the_page(client):
+    response = client.post('/next_step', data={'branch_choice': '开门'}, headers={'Accept': 'text/html'})
+
+    assert response.mimetype == 'text/html'
+    assert '门开了。' in response.get_data(as_text=True)
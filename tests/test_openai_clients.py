@@ -0,0 +1,41 @@
+import time
+
+from openai_clients import ClientRegistry, key_fingerprint
+
+
+def test_same_key_shares_one_client():
+    registry = ClientRegistry()
+    a = registry.get('sk-a')
+
+    assert registry.get('sk-a') is a
+    assert registry.get('sk-b') is not a
+    stats = registry.stats()
+    assert (stats['hits'], stats['misses'], stats['clients']) == (1, 2, 2)
+    assert stats['hit_rate'] == 1 / 3
+    registry.clear()
+    assert registry.stats()['clients'] == 0
+
+
+def test_least_recently_used_client_is_evicted():
+    registry = ClientRegistry(max_clients=2)
+    a = registry.get('sk-a')
+    registry.get('sk-b')
+    registry.get('sk-a')
+    registry.get('sk-c')
+
+    assert registry.stats()['clients'] == 2
+    assert registry.get('sk-a') is a
+    assert registry.stats()['evictions'] == 1
+
+
+def test_idle_client_expires():
+    registry = ClientRegistry(ttl=0.05)
+    a = registry.get('sk-a')
+    time.sleep(0.1)
+
+    assert registry.get('sk-a') is not a
+
+
+def test_fingerprint_does_not_contain_the_key():
+    fp = key_fingerprint('sk-secret-value')
+    assert 'secret' not in fp and len(fp) == 32 and fp == key_fingerprint('sk-secret-value')
@@ -0,0 +1,64 @@
+import time
+
+from opening_pool import OpeningPool
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def counting(calls):
+    return lambda api_key, request: calls.append(api_key) or {'n': len(calls), 'request': request}
+
+
+def test_each_version_is_taken_once(tmp_path):
+    pool = OpeningPool(str(tmp_path / 'openings.db'), counting([]), variants=2)
+    pool.put('k', {'n': 1})
+    pool.put('k', {'n': 2})
+
+    assert pool.take('k') == {'n': 1}
+    assert pool.take('k') == {'n': 2}
+    assert pool.take('k') is None
+    assert pool.take('other') is None
+    assert (pool.stats()['hits'], pool.stats()['misses']) == (2, 2)
+
+
+def test_expired_versions_are_not_served(tmp_path):
+    pool = OpeningPool(str(tmp_path / 'openings.db'), counting([]), variants=2, ttl=0.05)
+    pool.put('k', {'n': 1})
+    time.sleep(0.1)
+
+    assert not pool.has('k') and pool.take('k') is None
+
+
+def test_fill_tops_up_synchronously(tmp_path):
+    calls = []
+    pool = OpeningPool(str(tmp_path / 'openings.db'), counting(calls), variants=3, api_key='')
+    pool.put('k', {'n': 0})
+
+    assert pool.fill('k', 'sk-operator', 'request') == 2
+    assert pool.count('k') == 3 and calls == ['sk-operator', 'sk-operator']
+
+
+def test_no_background_refill_without_pool_key(tmp_path):
+    calls = []
+    pool = OpeningPool(str(tmp_path / 'openings.db'), lambda api_key, request: calls.append(api_key) or {},
+                       variants=2, api_key='')
+
+    assert pool.take('k') is None
+    assert pool.refill('k', dict) == 0
+    assert calls == []
+
+
+def test_refill_uses_pool_key(tmp_path):
+    calls = []
+    pool = OpeningPool(str(tmp_path / 'openings.db'), lambda api_key, request: calls.append(api_key) or {'n': 1},
+                       variants=2, api_key='sk-pool')
+
+    assert pool.refill('k', dict) == 2
+    assert wait_for(lambda: pool.count('k') == 2)
+    assert calls == ['sk-pool', 'sk-pool']
+    assert pool.take('k') == {'n': 1}
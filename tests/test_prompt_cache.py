@@ -0,0 +1,35 @@
+import time
+
+from prompt_cache import PromptCache, cache_key
+
+
+def test_formatting_differences_share_a_key():
+    assert cache_key('scene', '  A Dark  Forest。') == cache_key('scene', 'a dark forest')
+    assert cache_key('scene', 'Ａ ｆｏｒｅｓｔ') == cache_key('scene', 'a forest')
+    assert cache_key('scene', 'a forest') != cache_key('avatar', 'a forest')
+
+
+def test_get_put_and_stats_per_stage(tmp_path):
+    cache = PromptCache(str(tmp_path / 'cache.db'))
+    assert cache.get('rewrite', 'k') is None
+    cache.put('rewrite', 'k', 'a castle at dusk')
+    assert cache.get('rewrite', 'k') == 'a castle at dusk'
+    assert cache.get('image', 'k') is None
+    cache.discard('rewrite', 'k')
+    assert cache.get('rewrite', 'k') is None
+
+    stats = cache.stats()
+    assert stats['stages']['rewrite'] == {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3}
+    assert stats['stages']['image']['misses'] == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = PromptCache(str(tmp_path / 'cache.db'), max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.put('image', key, key)
+        time.sleep(0.01)
+    cache.get('image', 'a')
+
+    assert cache.evict() == 1
+    assert cache.get('image', 'b') is None
+    assert cache.get('image', 'a') == 'a' and cache.get('image', 'c') == 'c'
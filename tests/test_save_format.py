@@ -0,0 +1,89 @@
+import pytest
+
+from save_format import SaveError, decode_turns, encode_save, parse_save, turn_hash
+from session_store import TurnLog
+
+NAME = 'a' * 40 + '.webp'
+PLACEHOLDER = '/api/placeholder/800/400'
+
+
+def turn(i, **fields):
+    return dict({'new_text': f'turn {i}', 'options': [f'go {i}'], 'player_action': f'act {i}' if i else None,
+                 'image': f'/images/{NAME}'}, **fields)
+
+
+def game(n=3):
+    return {'history': TurnLog.from_list([turn(i) for i in range(n)]), 'language': 'zh',
+            'characters': [{'id': 'c1', 'name': 'Ann', 'desc': '', 'detail': '', 'events': ['met'],
+                            'avatar': f'/images/{NAME}'}]}
+
+
+def test_round_trip_keeps_turns_and_stores_image_names():
+    document, checkpoint = encode_save(game(), '/images')
+    assert document['turns'][0][4] == NAME
+    assert document['meta']['characters'][0]['avatar'] == NAME
+    assert checkpoint == {'count': 3, 'hash': document['head']}
+
+    records = decode_turns(parse_save(document), '/images', PLACEHOLDER)
+    assert [r['new_text'] for r in records] == ['turn 0', 'turn 1', 'turn 2']
+    assert records[0]['image'] == f'/images/{NAME}'
+    assert records[2]['h'] == document['head']
+
+
+def test_incremental_save_after_checkpoint():
+    session = game()
+    full, checkpoint = encode_save(session, '/images')
+    session['history'].append(turn(3))
+
+    document, _ = encode_save(session, '/images', since=checkpoint['count'], since_hash=checkpoint['hash'])
+    assert (document['base'], document['base_hash'], len(document['turns'])) == (3, full['head'], 1)
+    parse_save(document)
+
+    # 检查点与当前进度不一致时返回完整存档
+    document, _ = encode_save(session, '/images', since=3, since_hash='0' * 16)
+    assert (document['base'], len(document['turns'])) == (0, 4)
+
+
+def test_pending_image_keeps_prompt_and_moves_checkpoint_back():
+    session = game()
+    session['history'].update(1, image=None, image_pending=True, image_prompt='a castle')
+    document, checkpoint = encode_save(session, '/images')
+
+    assert document['turns'][1][4:] == [None, 'a castle']
+    assert checkpoint['count'] == 1
+    record = decode_turns(parse_save(document), '/images', PLACEHOLDER)[1]
+    assert record['image_pending'] and record['image_prompt'] == 'a castle'
+
+
+def test_tampered_turn_is_rejected():
+    document, _ = encode_save(game(), '/images')
+    document['turns'][1][1] = 'rewritten'
+    with pytest.raises(SaveError):
+        parse_save(document)
+
+
+def test_v1_save_is_upgraded():
+    data = {'data': {'history': [turn(0), turn(1)], 'story': 'turn 0\nturn 1', 'language': 'en'}}
+    document = parse_save(data)
+    assert (document.count, document.meta.language) == (2, 'en')
+    assert decode_turns(document, '/images', PLACEHOLDER)[1]['player_action'] == 'act 1'
+
+
+@pytest.mark.parametrize('ref, expected', [
+    (NAME, '/images/' + NAME),
+    ('/images/' + NAME, '/images/' + NAME),
+    ('b' * 40 + '.thumb.jpg', '/images/' + 'b' * 40 + '.thumb.jpg'),
+    ('/logout', PLACEHOLDER),
+    ('/api/placeholder/800/400', PLACEHOLDER),
+    ('//evil.example/x.png', PLACEHOLDER),
+    ('https://evil.example/' + NAME, PLACEHOLDER),
+    ('/images/../app.py', PLACEHOLDER),
+    ('/images/' + NAME + '?x=1', PLACEHOLDER),
+    ('javascript:alert(1)', PLACEHOLDER),
+    (None, None),
+])
+def test_only_image_store_urls_are_restored(ref, expected):
+    h = turn_hash(None, {'new_text': 't', 'options': [], 'player_action': None})
+    document = parse_save({'v': 2, 'meta': {}, 'count': 1, 'head': h, 'turns': [[h, 't', [], None, ref]]})
+
+    assert decode_turns(document, '/images', PLACEHOLDER)[0]['image'] == expected
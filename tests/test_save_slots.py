@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from save_slots import QuotaExceeded, SaveSlotStore
+
+
+def document(count, theme='castle'):
+    return {'v': 2, 'meta': {'settings': {'theme': theme}, 'language': 'zh'}, 'count': count, 'turns': []}
+
+
+def test_put_list_get_and_delete(tmp_path):
+    store = SaveSlotStore(str(tmp_path / 'slots.db'))
+    slot = store.put('alice', ' first ', document(3), images=['a' * 40])
+
+    meta, = store.list('alice')
+    assert meta == slot
+    assert (meta['name'], meta['turn_count'], meta['theme']) == ('first', 3, 'castle')
+    assert store.get('alice', slot['slot_id']) == document(3)
+    assert list(store.iter_image_hashes()) == ['a' * 40]
+    # 其他用户看不到这个存档
+    assert store.list('bob') == [] and store.get('bob', slot['slot_id']) is None
+
+    updated = store.put('alice', 'first', document(5), slot_id=slot['slot_id'])
+    assert (updated['created_at'], updated['turn_count']) == (slot['created_at'], 5)
+    assert store.usage('alice')['slots'] == 1
+    with pytest.raises(KeyError):
+        store.put('alice', 'x', document(1), slot_id='missing')
+
+    assert store.delete('alice', slot['slot_id'])
+    assert not store.delete('alice', slot['slot_id'])
+    assert store.list('alice') == [] and store.get('alice', slot['slot_id']) is None
+
+
+def test_quota(tmp_path):
+    store = SaveSlotStore(str(tmp_path / 'slots.db'), max_slots=2, max_bytes=10 * 1024)
+    first = store.put('alice', 'a', document(1))
+    store.put('alice', 'b', document(2))
+    with pytest.raises(QuotaExceeded):
+        store.put('alice', 'c', document(3))
+    # 覆盖已有的槽不受槽数限制
+    store.put('alice', 'a', document(4), slot_id=first['slot_id'])
+    store.put('bob', 'a', document(1))
+
+    big = dict(document(1), turns=[[str(i), os.urandom(1024).hex()] for i in range(20)])
+    with pytest.raises(QuotaExceeded):
+        store.put('alice', 'a', big, slot_id=first['slot_id'])
+    assert store.get('alice', first['slot_id'])['count'] == 4
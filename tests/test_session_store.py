@@ -0,0 +1,147 @@
+import sqlite3
+import time
+
+import pytest
+from flask import Flask, session
+
+from session_store import SQLiteSessionBackend, ServerSession, ServerSessionInterface
+
+
+class RecordingBackend(SQLiteSessionBackend):
+    """记录每次保存写入的回合序号"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.saved = []
+
+    def save(self, sid, data, turn_count, turns, *args, **kwargs):
+        self.saved.append(sorted(turns))
+        return super().save(sid, data, turn_count, turns, *args, **kwargs)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return RecordingBackend(str(tmp_path / 'sessions.db'))
+
+
+@pytest.fixture
+def client(backend):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.session_interface = ServerSessionInterface(backend)
+
+    @app.route('/turn/<text>')
+    def turn(text):
+        session['history'].append({'new_text': text, 'full_text': 'derived'})
+        return str(len(session['history']))
+
+    @app.route('/image/<int:index>')
+    def image(index):
+        session['history'].update(index, image=f'/images/{index}')
+        return session['history'][index]['new_text']
+
+    @app.route('/new_game')
+    def new_game():
+        session['history'] = [{'new_text': 'fresh'}]
+        return ''
+
+    return app.test_client()
+
+
+def test_only_changed_turns_are_written(client, backend):
+    for text in ('a', 'b', 'c'):
+        client.get(f'/turn/{text}')
+    assert client.get('/image/1').text == 'b'
+
+    assert backend.saved == [[0], [1], [2], [1]]
+    sid = next(iter(backend._conn().execute('SELECT sid FROM sessions')))[0]
+    data, turn_count = backend.open(sid)
+    assert turn_count == 3 and 'history' not in data
+    turns = backend.load_turns(sid, 0, 3)
+    assert [t['new_text'] for t in turns] == ['a', 'b', 'c']
+    # 可重建的冗余字段不持久化
+    assert 'full_text' not in turns[0]
+    assert turns[1]['image'] == '/images/1'
+
+
+def test_cookie_holds_only_the_signed_session_id(client):
+    for text in ('a' * 2000, 'b' * 2000):
+        client.get(f'/turn/{text}')
+
+    cookie = client.get_cookie('session')
+    assert cookie is not None and len(cookie.value) < 100
+
+
+def test_replacing_history_rewrites_all_turns(client, backend):
+    client.get('/turn/a')
+    client.get('/turn/b')
+    client.get('/new_game')
+
+    sid = next(iter(backend._conn().execute('SELECT sid FROM sessions')))[0]
+    assert backend.load_turns(sid, 0, 5) == [{'new_text': 'fresh'}]
+
+
+def test_purge_removes_idle_sessions_and_turns(tmp_path):
+    backend = SQLiteSessionBackend(str(tmp_path / 'sessions.db'))
+    backend.save('old', {'a': 1}, 1, {0: {'new_text': 'x'}})
+    backend.save('new', {'a': 2}, 1, {0: {'new_text': 'y'}})
+    with backend._conn() as conn:
+        conn.execute('UPDATE sessions SET updated_at = ? WHERE sid = ?', (time.time() - 100, 'old'))
+
+    assert backend.purge(50) == 1
+    assert backend.open('old') is None
+    assert backend.load_turns('old', 0, 1) == []
+    assert backend.open('new') is not None
+
+
+def test_persist_purges_on_interval(tmp_path):
+    backend = SQLiteSessionBackend(str(tmp_path / 'sessions.db'))
+    backend.save('old', {'a': 1}, 0, {})
+    with backend._conn() as conn:
+        conn.execute('UPDATE sessions SET updated_at = ? WHERE sid = ?', (time.time() - 100, 'old'))
+    interface = ServerSessionInterface(backend, max_age=50, purge_interval=0)
+
+    session = ServerSession({'a': 2}, sid='new', new=True)
+    interface.persist(session)
+
+    assert backend.open('old') is None
+    assert backend.open('new') is not None
+
+
+def test_update_turn_drops_writes_for_replaced_turn(tmp_path):
+    backend = SQLiteSessionBackend(str(tmp_path / 'sessions.db'))
+    backend.save('s', {}, 1, {0: {'new_text': 'old game', 'h': 'aaa', 'image_pending': True}})
+    # 新游戏：同一序号的回合换成了另一段历史
+    backend.save('s', {}, 1, {0: {'new_text': 'new game', 'h': 'bbb', 'image_pending': True}}, rewrite=True)
+
+    assert not backend.update_turn('s', 0, {'image': '/images/old', 'image_pending': False}, expected_hash='aaa')
+    assert backend.load_turns('s', 0, 1)[0]['image_pending'] is True
+    assert backend.update_turn('s', 0, {'image': '/images/new', 'image_pending': False}, expected_hash='bbb')
+    assert backend.load_turns('s', 0, 1)[0]['image'] == '/images/new'
+
+
+class FlakyBackend(SQLiteSessionBackend):
+    """第一次保存时失败（如其他 worker 持有写锁）"""
+
+    failures = 1
+
+    def save(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return super().save(*args, **kwargs)
+
+
+def test_failed_save_keeps_changed_turns(tmp_path):
+    backend = FlakyBackend(str(tmp_path / 'sessions.db'))
+    interface = ServerSessionInterface(backend)
+    session = ServerSession({'a': 1}, sid='s', new=True)
+    session['history'].append({'new_text': 'first'})
+
+    with pytest.raises(sqlite3.OperationalError):
+        interface.persist(session)
+    assert backend.open('s') is None
+
+    interface.persist(session)
+    assert backend.turn_count('s') == 1
+    assert backend.load_turns('s', 0, 1)[0]['new_text'] == 'first'
@@ -0,0 +1,66 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from speculation import Speculator
+
+
+def completion(option, delay=0.0, release=None):
+    if release is not None:
+        release.wait(5)
+    time.sleep(delay)
+    return SimpleNamespace(option=option, usage=SimpleNamespace(input_tokens=100, output_tokens=50))
+
+
+def test_chosen_branch_is_used_and_the_others_cancelled():
+    speculator = Speculator(lambda api_key, request: completion(request), top_k=2)
+    assert speculator.speculate('s', 0, 'sk', ['a', 'b', 'c'], lambda option: option) == 2
+    assert not speculator.has('s', 0, 'c')
+
+    assert speculator.take('s', 0, 'a').option == 'a'
+    assert not speculator.has('s', 0, 'b')
+    stats = speculator.stats()
+    assert (stats['hits'], stats['cancelled'], stats['entries']) == (1, 1, 0)
+
+    # 未预测的选项由调用方正常生成
+    assert speculator.take('s', 0, 'c') is None
+    assert speculator.stats()['misses'] == 1
+
+
+def test_session_budget_limits_speculation():
+    speculator = Speculator(lambda api_key, request: completion(request), top_k=2, session_budget=1)
+    assert speculator.speculate('s', 0, 'sk', ['a', 'b'], lambda option: option) == 1
+    assert speculator.stats()['skipped_budget'] == 1
+    # 其他会话不受影响
+    assert speculator.speculate('t', 0, 'sk', ['a'], lambda option: option) == 1
+
+
+def test_disabled_speculator_does_nothing():
+    speculator = Speculator(lambda api_key, request: completion(request), top_k=0)
+    assert speculator.speculate('s', 0, 'sk', ['a'], lambda option: option) == 0
+    assert speculator.take('s', 0, 'a') is None
+
+
+def test_take_waits_at_most_wait_seconds():
+    release = threading.Event()
+    speculator = Speculator(lambda api_key, request: completion(request, release=release), top_k=1, wait=0.2)
+    speculator.speculate('s', 0, 'sk', ['go'], lambda option: option)
+
+    start = time.monotonic()
+    assert speculator.take('s', 0, 'go') is None
+    assert time.monotonic() - start < 1
+    release.set()
+
+
+def test_unused_running_branches_are_counted_as_wasted():
+    release = threading.Event()
+    speculator = Speculator(lambda api_key, request: completion(request, release=release), top_k=2)
+    assert speculator.speculate('s', 0, 'sk', ['a', 'b'], lambda option: option) == 2
+
+    release.set()
+    assert speculator.take('s', 0, 'a').option == 'a'
+    # 线程中已开始的分支 b 无法中断，生成完毕后计入浪费
+    deadline = time.monotonic() + 5
+    while speculator.stats()['wasted'] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert speculator.stats()['wasted'] == 1
@@ -0,0 +1,62 @@
+import gzip
+import os
+
+from static_assets import AssetManifest
+
+SCRIPT = b'function hello() { return "hello"; }\n' * 50
+
+
+def test_fingerprints_and_precompresses_listed_files(tmp_path):
+    (tmp_path / 'main.js').write_bytes(SCRIPT)
+    (tmp_path / 'tiny.css').write_bytes(b'p{}')
+    manifest = AssetManifest(str(tmp_path), ['main.js', 'tiny.css'])
+
+    url = manifest.url('main.js')
+    asset = manifest.get(url.rsplit('/', 1)[1])
+    assert url.startswith('/assets/main.') and url.endswith('.js')
+    assert asset.mimetype == 'text/javascript'
+    assert gzip.decompress(asset.bodies['gzip']) == SCRIPT
+    # 过小的文件不压缩
+    assert list(manifest.get(manifest.url('tiny.css').rsplit('/', 1)[1]).bodies) == ['identity']
+
+    # 内容变化后地址随之变化，旧地址不再可用
+    (tmp_path / 'main.js').write_bytes(SCRIPT + b'//v2\n')
+    os.utime(tmp_path / 'main.js', (1, 1))
+    assert manifest.refresh() == 1
+    assert manifest.url('main.js') != url
+    assert manifest.get(url.rsplit('/', 1)[1]) is None
+    assert manifest.refresh() == 0
+
+
+def test_ignores_unlisted_files(tmp_path):
+    (tmp_path / 'main.js').write_bytes(SCRIPT)
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'images' / 'old.png').write_bytes(b'\x89PNG' + bytes(4096))
+    manifest = AssetManifest(str(tmp_path), ['main.js'])
+
+    assert manifest.stats()['assets'] == 1
+
+
+def test_generated_assets(tmp_path):
+    manifest = AssetManifest(str(tmp_path), [])
+    url = manifest.add('i18n/zh.js', b'window.UI = {};\n')
+
+    assert url == manifest.url('i18n/zh.js') and url.startswith('/assets/i18n/zh.')
+
+
+def test_assets_are_served_immutable_and_compressed(app_module):
+    client = app_module.app.test_client()
+    url = app_module.assets.url('main.js')
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+    with open(os.path.join(app_module.app.static_folder, 'main.js'), 'rb') as f:
+        assert gzip.decompress(response.data) == f.read()
+
+    plain = client.get(url)
+    assert 'Content-Encoding' not in plain.headers and plain.headers['ETag'] != response.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': plain.headers['ETag']}).status_code == 304
+    assert client.get('/assets/main.000000000000.js').status_code == 404
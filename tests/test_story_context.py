@@ -0,0 +1,118 @@
+import threading
+from types import SimpleNamespace
+
+from model_router import ModelRouter
+from story_context import ContextManager, estimate_tokens, truncate_to_tokens
+
+
+class FakeClient:
+    """chat.completions.create 返回固定摘要的客户端替身"""
+
+    def __init__(self, text):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.text = text
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        message = SimpleNamespace(content=self.text)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class BlockingRouter:
+    """story_summary 调用在 release 之前一直阻塞，返回固定的摘要"""
+
+    def __init__(self, text):
+        self.text = text
+        self.release = threading.Event()
+
+    def call(self, name, fn):
+        self.release.wait(5)
+        message = SimpleNamespace(content=self.text)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def turns(count, text='剧情' * 200):
+    return [{'new_text': f'{text} #{i}', 'options': [], 'player_action': f'行动 {i}'} for i in range(count)]
+
+
+def total_tokens(messages):
+    return sum(estimate_tokens(m['content']) for m in messages)
+
+
+def test_estimate_and_truncate_tokens():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('你好') == 2
+    assert estimate_tokens('abcdefgh') == 2
+    text = '前文' * 100 + '结尾'
+    cut = truncate_to_tokens(text, 10)
+    assert estimate_tokens(cut) <= 10 and cut.endswith('结尾')
+
+
+def test_context_stays_within_budget_as_history_grows():
+    manager = ContextManager(lambda api_key: FakeClient(''), ModelRouter(routes={}), recent_turns=4, token_budget=800)
+    characters = [f'角色{i}' for i in range(50)]
+    sizes = []
+    for count in (5, 50, 200):
+        summary = {'upto': count - 4, 'text': '摘要' * 1000}
+        messages = manager.build_messages(turns(count), characters, summary, reserved_tokens=100)
+        sizes.append(total_tokens(messages))
+        # 最近一回合总是保留
+        assert f'#{count - 1}' in messages[-1]['content']
+    assert max(sizes) <= 700
+
+
+def test_old_turns_are_folded_into_the_summary():
+    client = FakeClient('旧回合摘要')
+    manager = ContextManager(lambda api_key: client, ModelRouter(routes={}), recent_turns=2)
+    history = turns(6, '短')
+
+    manager.schedule_summary('s', 'sk', history, manager.get_summary('s', history)).result(5)
+
+    summary = manager.get_summary('s', history)
+    assert (summary['upto'], summary['text']) == (4, '旧回合摘要')
+    assert '短 #3' in client.requests[0]['messages'][1]['content']
+    # 原文窗口内的回合不需要摘要
+    assert manager.schedule_summary('s', 'sk', history, summary) is None
+    messages = manager.build_messages(history, [], summary)
+    assert any('旧回合摘要' in m['content'] for m in messages)
+    assert '短 #3' not in messages[-1]['content'] and '短 #5' in messages[-1]['content']
+
+
+def game_turns(game, count):
+    return [{'new_text': f'{game} {i}', 'options': [], 'player_action': 'a', 'h': f'{game}-{i}'}
+            for i in range(count)]
+
+
+def test_summary_from_replaced_history_is_ignored():
+    router = BlockingRouter('old game summary')
+    manager = ContextManager(lambda api_key: None, router, recent_turns=1)
+    old = game_turns('old', 4)
+    future = manager.schedule_summary('s', 'sk', old, {'upto': 0, 'text': ''})
+
+    # 摘要还在生成时开始了新游戏
+    manager.reset('s')
+    router.release.set()
+    future.result(5)
+
+    new = game_turns('new', 6)
+    assert manager.get_summary('s', new) == {'upto': 0, 'text': ''}
+
+
+def test_summary_written_by_another_history_does_not_match():
+    manager = ContextManager(lambda api_key: None, BlockingRouter(''), recent_turns=1)
+    stored = {'upto': 3, 'text': 'old game summary', 'h': 'old-2'}
+
+    assert manager.get_summary('s', game_turns('new', 6), stored)['upto'] == 0
+    assert manager.get_summary('s', game_turns('old', 6), stored) is stored
+
+
+def test_summary_is_used_for_the_same_history():
+    router = BlockingRouter('summary')
+    router.release.set()
+    manager = ContextManager(lambda api_key: None, router, recent_turns=1)
+    history = game_turns('game', 4)
+    manager.schedule_summary('s', 'sk', history, {'upto': 0, 'text': ''}).result(5)
+
+    summary = manager.get_summary('s', history)
+    assert summary['upto'] == 3 and summary['text'] == 'summary'
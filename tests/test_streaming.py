@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from streaming import JsonStringFieldExtractor, sse_event
+
+DOCUMENT = json.dumps({'title': 'x', 'story_text': '第一行\n"引号" \\ 😀 end', 'options': ['a']}, ensure_ascii=True)
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, len(DOCUMENT)])
+def test_extracts_story_text_from_any_chunking(size):
+    extractor = JsonStringFieldExtractor('story_text')
+    out = ''.join(extractor.feed(DOCUMENT[i:i + size]) for i in range(0, len(DOCUMENT), size))
+    assert out == '第一行\n"引号" \\ 😀 end'
+    assert extractor.done
+
+
+def test_ignores_non_string_field():
+    extractor = JsonStringFieldExtractor('story_text')
+    assert extractor.feed('{"story_text": 3, "other": "x"}') == ''
+    assert extractor.done
+
+
+def test_sse_event_format():
+    assert sse_event('delta', {'text': '你好'}) == 'event: delta\ndata: {"text": "你好"}\n\n'
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n') if not line.startswith(':'))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def test_next_step_stream_sends_deltas_then_commits_the_turn(app_module, monkeypatch):
+    story = {'text': '你走进了森林。', 'options': ['向前', '返回'], 'image_pending': False, 'image_content': None,
+             'new_character': None}
+
+    def fake_stream(user_input):
+        assert user_input == '进入森林'
+        yield 'delta', '你走进'
+        yield 'delta', '了森林。'
+        yield 'story', dict(story)
+
+    monkeypatch.setattr(app_module, 'generate_story_stream', fake_stream)
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['api_key'] = 'sk-test'
+        session['characters'] = []
+        session['history'] = [{'new_text': '开场', 'options': ['进入森林'], 'player_action': None}]
+
+    response = client.post('/next_step_stream', data={'branch_choice': '进入森林'})
+    assert response.mimetype == 'text/event-stream'
+    events = parse_events(response.get_data(as_text=True))
+
+    assert events[:2] == [('delta', {'text': '你走进'}), ('delta', {'text': '了森林。'})]
+    name, done = events[-1]
+    assert name == 'done' and done['text'] == '你走进了森林。' and done['options'] == ['向前', '返回']
+    with client.session_transaction() as session:
+        assert len(session['history']) == 2
+        assert session['history'][-1]['player_action'] == '进入森林'
+
+
+def test_next_step_stream_reports_errors_as_events(app_module, monkeypatch):
+    def failing_stream(user_input):
+        yield 'delta', '半'
+        raise RuntimeError('model unavailable')
+
+    monkeypatch.setattr(app_module, 'generate_story_stream', failing_stream)
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['api_key'] = 'sk-test'
+        session['characters'] = []
+        session['history'] = [{'new_text': '开场', 'options': ['a'], 'player_action': None}]
+
+    events = parse_events(client.post('/next_step_stream', data={'branch_choice': 'a'}).get_data(as_text=True))
+    assert events[-1][0] == 'error'
+    with client.session_transaction() as session:
+        assert len(session['history']) == 1
@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+from turn_guard import RateLimiter, TurnCoalescer, TurnConflict
+
+
+def test_duplicate_submit_waits_for_the_first_one():
+    coalescer = TurnCoalescer()
+    leader, first = coalescer.claim('s', 3, 'open the door')
+    duplicate, again = coalescer.claim('s', 3, 'open the door')
+    assert (first, again) == (True, False) and duplicate is leader
+    with pytest.raises(TurnConflict):
+        coalescer.claim('s', 3, 'run away')
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(duplicate.wait(5)))
+    waiter.start()
+    leader.resolve({'turn': 3})
+    waiter.join(5)
+    assert results == [{'turn': 3}]
+    # 迟到的重复提交直接取回结果
+    assert coalescer.replay('s', 3, 'open the door') == {'turn': 3}
+    assert coalescer.replay('s', 3, 'run away') is None
+    assert coalescer.stats() == {'leaders': 1, 'coalesced': 1, 'conflicts': 1, 'inflight': 0}
+
+
+def test_failed_turn_can_be_retried():
+    coalescer = TurnCoalescer()
+    claim, _ = coalescer.claim('s', 0, 'look')
+    claim.fail(RuntimeError('upstream error'))
+    with pytest.raises(RuntimeError):
+        claim.wait(1)
+
+    retry, first = coalescer.claim('s', 0, 'look')
+    assert first and retry is not claim
+
+
+def test_rate_limiter_allows_burst_then_asks_to_wait():
+    limiter = RateLimiter(per_minute=6, burst=2)
+    assert limiter.acquire('k') == 0
+    assert limiter.acquire('k') == 0
+    assert 9 < limiter.acquire('k') <= 10
+    assert limiter.acquire('other') == 0
+
+    limiter.refund('k')
+    assert limiter.acquire('k') == 0
+    assert RateLimiter(per_minute=0, burst=1).acquire('k') == 0
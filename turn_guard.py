@@ -0,0 +1,252 @@
+"""
+回合提交的去重与限流
+
+- TurnCoalescer：同一会话同一回合同时只生成一次。相同行动的重复提交（双击、重发表单）
+  等待第一次提交的结果；已完成的结果保留 TURN_REPLAY_TTL 秒，迟到的重复提交也能直接取回；
+  同一回合已有其他行动在生成时拒绝。
+- RateLimiter：令牌桶，app 中分别按 API Key 与会话各用一个。
+
+回合版本检查（客户端提交其看到的回合序号、写入时比对存储中的回合数）见 app.admit_turn
+与 session_store。
+
+传入 coordination.SharedStore 时两者在多个 worker 进程间生效：回合生成持有跨进程租约，
+结果写入共享缓存，落到其他进程的重复提交等待并取回同一结果；令牌桶也由所有进程共用。
+"""
+import os
+import threading
+import time
+
+# 按 API Key / 会话限流：每分钟补充的次数与桶容量（允许的突发次数），速率为 0 表示不限
+RATE_LIMIT_KEY_PER_MIN = float(os.environ.get('RATE_LIMIT_KEY_PER_MIN', 30))
+RATE_LIMIT_KEY_BURST = int(os.environ.get('RATE_LIMIT_KEY_BURST', 10))
+RATE_LIMIT_SESSION_PER_MIN = float(os.environ.get('RATE_LIMIT_SESSION_PER_MIN', 12))
+RATE_LIMIT_SESSION_BURST = int(os.environ.get('RATE_LIMIT_SESSION_BURST', 4))
+# 已完成回合的结果保留时间（秒），以及重复提交等待第一次提交的最长时间
+TURN_REPLAY_TTL = float(os.environ.get('TURN_REPLAY_TTL', 60))
+TURN_WAIT_TIMEOUT = float(os.environ.get('TURN_WAIT_TIMEOUT', 180))
+
+
+class TurnConflict(Exception):
+    """同一回合已有其他行动在生成"""
+
+
+class RateLimited(Exception):
+    """回合提交超出频率限制"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many turns, please retry in {retry_after:.0f}s.")
+        self.retry_after = retry_after
+
+
+class TurnClaim:
+    """一次进行中的回合生成；第一次提交负责 resolve / fail，重复提交 wait"""
+
+    def __init__(self, action):
+        self.action = action
+        self.created_at = time.time()
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.on_finish = None
+        self._event = threading.Event()
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def resolve(self, result):
+        if not self.done:
+            self.result = result
+            self._finish()
+
+    def fail(self, error):
+        if not self.done:
+            self.error = error
+            self._finish()
+
+    def _finish(self):
+        self.finished_at = time.time()
+        self._event.set()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def wait(self, timeout=TURN_WAIT_TIMEOUT):
+        """返回第一次提交的结果；失败时抛出同样的异常，超时抛出 TimeoutError"""
+        if not self._event.wait(timeout):
+            raise TimeoutError('waiting for a duplicate submission timed out')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RemoteTurnClaim:
+    """同一回合正在另一个进程中生成；wait 轮询共享缓存中的结果"""
+
+    def __init__(self, coalescer, sid, turn_index, action):
+        self.coalescer = coalescer
+        self.sid = sid
+        self.turn_index = turn_index
+        self.action = action
+
+    def wait(self, timeout=TURN_WAIT_TIMEOUT):
+        shared = self.coalescer.shared
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            result = self.coalescer.replay(self.sid, self.turn_index, self.action)
+            if result is not None:
+                return result
+            if shared.holder(self.coalescer.lease_name(self.sid, self.turn_index)) is None:
+                # 租约已释放却没有结果：另一个进程生成失败
+                raise RuntimeError('the turn failed in another worker, please retry')
+            time.sleep(shared.poll_interval)
+        raise TimeoutError('waiting for a duplicate submission timed out')
+
+
+class TurnCoalescer:
+
+    def __init__(self, replay_ttl=TURN_REPLAY_TTL, wait_timeout=TURN_WAIT_TIMEOUT, shared=None):
+        self.replay_ttl = replay_ttl
+        self.wait_timeout = wait_timeout
+        self.shared = shared
+        self._claims = {}  # (sid, turn_index) -> TurnClaim
+        self._lock = threading.Lock()
+        self._stats = {'leaders': 0, 'coalesced': 0, 'conflicts': 0}
+
+    @staticmethod
+    def lease_name(sid, turn_index):
+        return f"turn:{sid}:{turn_index}"
+
+    def claim(self, sid, turn_index, action):
+        """
+        返回 (claim, 是否由本次提交生成)。
+
+        相同行动正在生成或刚完成时返回已有的 claim；其他行动正在生成时抛出 TurnConflict。
+        """
+        key = (sid, turn_index)
+        with self._lock:
+            self._prune(time.time())
+            existing = self._claims.get(key)
+            if existing is not None and not (existing.done and existing.error is not None):
+                if existing.action == action:
+                    self._stats['coalesced'] += 1
+                    return existing, False
+                if not existing.done:
+                    self._stats['conflicts'] += 1
+                    raise TurnConflict(f"turn {turn_index} is already being generated")
+            claim = TurnClaim(action)
+            if self.shared is not None:
+                remote = self._claim_shared(sid, turn_index, claim)
+                if remote is not None:
+                    return remote, False
+            self._claims[key] = claim
+            self._stats['leaders'] += 1
+            return claim, True
+
+    def _claim_shared(self, sid, turn_index, claim):
+        # 调用方需持有锁；取得跨进程租约时返回 None，同一回合正在其他进程生成时返回 RemoteTurnClaim
+        name = self.lease_name(sid, turn_index)
+        token = self.shared.acquire(name, self.wait_timeout, holder=claim.action)
+        if token is None:
+            holder = self.shared.holder(name)
+            if holder == claim.action:
+                self._stats['coalesced'] += 1
+                return RemoteTurnClaim(self, sid, turn_index, claim.action)
+            if holder is not None:
+                self._stats['conflicts'] += 1
+                raise TurnConflict(f"turn {turn_index} is already being generated")
+            # 租约恰好被释放
+            token = self.shared.acquire(name, self.wait_timeout, holder=claim.action)
+            if token is None:
+                self._stats['conflicts'] += 1
+                raise TurnConflict(f"turn {turn_index} is already being generated")
+
+        def publish(finished):
+            if finished.error is None:
+                self.shared.put('turn', f"{sid}:{turn_index}", {'action': finished.action, 'result': finished.result},
+                                ttl=self.replay_ttl)
+            self.shared.release(name, token)
+
+        claim.on_finish = publish
+        return None
+
+    def replay(self, sid, turn_index, action):
+        """该回合刚以相同行动完成时返回其结果，否则返回 None"""
+        with self._lock:
+            claim = self._claims.get((sid, turn_index))
+        if claim is None and self.shared is not None:
+            # 在其他进程完成的回合
+            entry = self.shared.get('turn', f"{sid}:{turn_index}")
+            return entry['result'] if entry is not None and entry['action'] == action else None
+        if claim is None or claim.action != action or not claim.done or claim.error is not None:
+            return None
+        return claim.result
+
+    def _prune(self, now):
+        # 调用方需持有锁；未完成的 claim 超过等待上限也一并清理（生成方异常退出未标记时）
+        expired = [
+            k for k, c in self._claims.items()
+            if (c.done and now - c.finished_at > self.replay_ttl) or now - c.created_at > self.wait_timeout
+        ]
+        for key in expired:
+            del self._claims[key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['inflight'] = sum(1 for c in self._claims.values() if not c.done)
+        return stats
+
+
+class RateLimiter:
+    """
+    令牌桶：每个键最多积累 burst 个令牌，每分钟补充 per_minute 个。
+
+    传入 shared 时桶保存在共享存储中（name 区分不同的限流器），所有进程共用。
+    """
+
+    def __init__(self, per_minute, burst, shared=None, name='rate'):
+        self.rate = per_minute / 60.0
+        self.burst = max(burst, 1)
+        self.shared = shared
+        self.name = name
+        self._buckets = {}  # key -> [令牌数, 上次补充时间]
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def acquire(self, key):
+        """取一个令牌；成功返回 0，否则返回需要等待的秒数（不消耗令牌）"""
+        if not self.enabled:
+            return 0
+        if self.shared is not None:
+            return self.shared.take_token(f"{self.name}:{key}", self.rate, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = [tokens - 1, now]
+                self._maybe_prune(now)
+                return 0
+            self._buckets[key] = [tokens, now]
+            return (1 - tokens) / self.rate
+
+    def refund(self, key):
+        """退回 acquire 取走的令牌（同时检查多个桶而后一个拒绝时）"""
+        if self.shared is not None:
+            self.shared.refund_token(f"{self.name}:{key}", self.burst)
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+
+    def _maybe_prune(self, now):
+        # 调用方需持有锁；已经补满的桶与新桶等价，可以丢弃
+        if len(self._buckets) < 10000:
+            return
+        full_after = self.burst / self.rate
+        for key in [k for k, (_, updated) in self._buckets.items() if now - updated > full_after]:
+            del self._buckets[key]